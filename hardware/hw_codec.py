@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Telemetry 紧凑二进制编码（MicroPython，只依赖 struct）。
+
+说明：
+- hello 里声明 protocol=2，server 回 hello_ok 的 protocol>=2 后，telemetry / telemetry_batch
+  改用二进制帧发送（只传数值，不传键名），一条样本从约 170 字节降到约 25 字节。
+- 帧格式与字段表见 server/codec.py，两边必须一致（只能在末尾追加字段）。
+- 无法用字段表表示的记录（未知传感器/字段、越界、status 不在枚举里）encode() 返回 None，
+  调用方照常发 JSON。
+"""
+
+import struct
+
+PROTOCOL = 2
+
+MAGIC = 0xB7
+VERSION = 1
+KIND_TELEMETRY = 1
+KIND_BATCH = 2
+
+_SEQ_NONE = 0xFFFFFFFF
+
+SENSORS = ("bmp280", "light")
+
+# (传感器, 字段, struct 格式, 缩放)；缩放为 None 表示枚举（STATUS_ENUM 下标）
+FIELDS = (
+	("bmp280", "temp", "h", 100),
+	("bmp280", "pressure", "I", 10000),
+	("bmp280", "status", "B", None),
+	("light", "raw", "H", 1),
+	("light", "voltage", "H", 100),
+	("light", "percent", "B", 1),
+)
+
+STATUS_ENUM = ("ok", "init", "unavailable")
+
+_LIMITS = {"h": (-32768, 32767), "H": (0, 65535), "B": (0, 255), "I": (0, 0xFFFFFFFF)}
+_KNOWN = set((f[0], f[1]) for f in FIELDS)
+
+
+def _boot_to_wire(boot_id):
+	if isinstance(boot_id, str) and len(boot_id) == 8:
+		try:
+			return int(boot_id, 16)
+		except ValueError:
+			return None
+	return None
+
+
+def _encode_sample(sample, ts, frame_buffered, frame_boot, fmt, args):
+	"""把一条样本追加到 fmt/args；无法表示时返回 None。"""
+	seq = sample.get("seq")
+	if seq is None:
+		seq = _SEQ_NONE
+	elif not isinstance(seq, int) or isinstance(seq, bool) or seq < 0 or seq >= _SEQ_NONE:
+		return None
+	if ts is None:
+		ts = 0
+	elif not isinstance(ts, (int, float)) or isinstance(ts, bool) or ts <= 0 or ts > 0xFFFFFFFF or ts != int(ts):
+		return None
+
+	sflags = 1 if sample.get("is_buffered", frame_buffered) else 0
+	extra_boot = None
+	boot = sample.get("boot_id")
+	if boot is not None:
+		wire = _boot_to_wire(boot)
+		if wire is None:
+			return None
+		if wire != frame_boot:
+			sflags |= 2
+			extra_boot = wire
+	elif frame_boot is not None:
+		return None
+
+	env = sample.get("environment") or {}
+	if not isinstance(env, dict):
+		return None
+	for name in env:
+		if name not in SENSORS:
+			return None
+	sensors = 0
+	for i, name in enumerate(SENSORS):
+		data = env.get(name)
+		if data is None:
+			continue
+		if not isinstance(data, dict):
+			return None
+		for key in data:
+			if (name, key) not in _KNOWN:
+				return None
+		sensors |= 1 << i
+
+	fields = 0
+	values_fmt = ""
+	values = []
+	for i, (sensor, field, code, scale) in enumerate(FIELDS):
+		data = env.get(sensor)
+		v = data.get(field) if isinstance(data, dict) else None
+		if v is None:
+			continue
+		if scale is None:
+			if v not in STATUS_ENUM:
+				return None
+			w = STATUS_ENUM.index(v)
+		else:
+			if not isinstance(v, (int, float)) or isinstance(v, bool):
+				return None
+			if scale == 1 and not isinstance(v, int):
+				return None
+			w = int(round(v * scale))
+			lo, hi = _LIMITS[code]
+			if w < lo or w > hi:
+				return None
+		fields |= 1 << i
+		values_fmt += code
+		values.append(w)
+
+	fmt.append("IIB")
+	args.extend((seq, int(ts), sflags))
+	if extra_boot is not None:
+		fmt.append("I")
+		args.append(extra_boot)
+	fmt.append("BH" + values_fmt)
+	args.extend((sensors, fields))
+	args.extend(values)
+	return True
+
+
+def encode(msg):
+	"""telemetry / telemetry_batch 消息（与 JSON 上报同形）-> bytes；无法表示时返回 None。"""
+	kind = msg.get("type")
+	buffered = bool(msg.get("is_buffered", False))
+	boot = msg.get("boot_id")
+	frame_boot = _boot_to_wire(boot) if boot is not None else None
+	if boot is not None and frame_boot is None:
+		return None
+
+	fmt = ["<BBBB"]
+	args = [MAGIC, VERSION, KIND_TELEMETRY if kind == "telemetry" else KIND_BATCH, (1 if buffered else 0) | (2 if frame_boot is not None else 0)]
+	if frame_boot is not None:
+		fmt.append("I")
+		args.append(frame_boot)
+
+	try:
+		if kind == "telemetry":
+			# 单条：boot_id 只放在帧头
+			sample = {
+				"seq": msg.get("seq"),
+				"environment": msg.get("environment"),
+				"is_buffered": buffered,
+			}
+			if _encode_sample(sample, msg.get("timestamp"), buffered, None, fmt, args) is None:
+				return None
+		elif kind == "telemetry_batch":
+			samples = msg.get("samples")
+			if not isinstance(samples, list) or not samples or len(samples) > 0xFFFF:
+				return None
+			fmt.append("H")
+			args.append(len(samples))
+			base = msg.get("ts_base")
+			for s in samples:
+				if not isinstance(s, dict):
+					return None
+				ts = s.get("timestamp")
+				if ts is None and base is not None and s.get("dt") is not None:
+					ts = base + s["dt"]
+				if "boot_id" not in s and boot is not None:
+					s = dict(s)
+					s["boot_id"] = boot
+				if _encode_sample(s, ts, buffered, frame_boot, fmt, args) is None:
+					return None
+		else:
+			return None
+		return struct.pack("".join(fmt), *args)
+	except Exception:
+		return None
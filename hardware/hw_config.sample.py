@@ -46,6 +46,7 @@ WIFI_PASSWORD = "YOUR_PASSWORD"  # WiFi 密码
 
 # ============ 服务端地址 ============
 SERVER_URL = "http://127.0.0.1:5000/api/telemetry"  # HTTP 备用上报通道（与 Server /api/telemetry 对齐）
+# SERVER_BULK_URL = "http://127.0.0.1:5000/api/telemetry/bulk"  # 可选：TF 队列批量补发地址（默认由 SERVER_URL 推出）
 
 # ============ WebSocket 直连（路线A）===========
 # ESP32 直连服务端 WebSocket（telemetry 通道）
@@ -60,6 +61,8 @@ FIRMWARE_VERSION = "0.1.0"
 
 # ============ 采样与上报频率 ============
 SAMPLE_INTERVAL_SEC = 1  # 采样间隔（秒）
+WS_BATCH_SAMPLES = 1  # WS 每攒 N 个采样合成一帧 telemetry_batch 发送（1 = 逐条；增大可减少无线发送次数）
+WS_BINARY = True  # WS 上报使用紧凑二进制编码（server 在 hello_ok 中确认 protocol>=2 后生效，否则仍发 JSON）
 
 # ============ 预警阈值（后续模块会用）===========
 TEMP_ALERT_C = 30  # 温度预警阈值（摄氏度）
@@ -86,6 +86,8 @@ class SdTelemetryQueue:
 
         self._normalize_meta()
         self._persist_meta()
+        # 已发出、等待 server 累计 ack 的批次：[(seq, 读完该条后的 offset), ...]；None 表示没有在途批次
+        self._inflight = None
 
     def _normalize_meta(self):
         def _to_int(v, d):
@@ -150,6 +152,8 @@ class SdTelemetryQueue:
             self.meta["read_idx"] = min(widx, ridx + 1)
             self.meta["read_offset"] = 0
             self._persist_meta()
+            # 在途批次所在分片已删除，它记下的 offset 不再有效
+            self._inflight = None
 
     def enqueue(self, record):
         """追加一条记录到队列。record 必须是 dict。"""
@@ -188,6 +192,8 @@ class SdTelemetryQueue:
         sent = 0
         if not callable(send_func):
             return 0, "send_func_required"
+        # 换成同步补发：之后再到的在途批次回复已不对应当前读位置
+        self._inflight = None
 
         for _ in range(int(max_items or 0)):
             ok, record = self._peek_one()
@@ -205,6 +211,162 @@ class SdTelemetryQueue:
 
         return sent, "ok"
 
+    def flush_batch(self, send_batch_func, max_items=10):
+        """整批补发队列头部（同一分片内最多 max_items 条）。
+
+        send_batch_func(records) -> bool：一次发出整批（例如一帧 telemetry_batch）；
+        成功后一次性推进读位置（meta 只写一次），失败则整批保留，下次重发。
+        """
+        if not callable(send_batch_func):
+            return 0, "send_func_required"
+        self._inflight = None
+
+        records, offsets = self._peek_many(int(max_items or 0))
+        if not offsets:
+            return 0, "ok"
+
+        # 损坏行跳过，但读位置照常推进
+        records = [r for r in records if not r.get("_corrupt")]
+        if records:
+            try:
+                if not send_batch_func(records):
+                    return 0, "ok"
+            except Exception:
+                return 0, "ok"
+
+        self._commit_offset(offsets[-1])
+        return len(records), "ok"
+
+    def send_batch(self, send_batch_func, max_items=10):
+        """整批发出队列头部，但不推进读位置：等 server 回复后由 on_reply() 提交。
+
+        用于 WS telemetry_batch：send_batch_func 返回 True 只说明帧已写进 socket，server 写队列满时
+        可能只收下前一部分（ack 覆盖不到整批，另回 busy + retry_from）。
+        已有在途批次时不再发送（返回 0, "inflight"）；超时/断线由调用方 drop_inflight() 后重发。
+        """
+        if self._inflight is not None:
+            return 0, "inflight"
+        if not callable(send_batch_func):
+            return 0, "send_func_required"
+
+        records, offsets = self._peek_many(int(max_items or 0))
+        if not offsets:
+            return 0, "ok"
+
+        good = []
+        inflight = []
+        for rec, off in zip(records, offsets):
+            if rec.get("_corrupt"):
+                continue
+            good.append(rec)
+            inflight.append((rec.get("seq"), off))
+        if not good:
+            # 全是损坏行：直接跳过
+            self._commit_offset(offsets[-1])
+            return 0, "ok"
+
+        try:
+            if not send_batch_func(good):
+                return 0, "ok"
+        except Exception:
+            return 0, "ok"
+
+        # 批尾的损坏行随最后一条有效记录一起出队
+        inflight[-1] = (inflight[-1][0], offsets[-1])
+        self._inflight = inflight
+        return len(good), "ok"
+
+    def inflight(self):
+        return self._inflight is not None
+
+    def drop_inflight(self):
+        """放弃等待在途批次的回复（超时/断线）：读位置不动，下次从同一位置重发（server 按 boot_id+seq 去重）。"""
+        self._inflight = None
+
+    def on_reply(self, msg):
+        """处理 server 对 telemetry_batch 的回复，返回出队条数。
+
+        - {"type":"ack","ack_upto":..,"count":..}：count 等于整批条数且 ack_upto 是整批最大 seq 时整批出队；
+          只覆盖前一部分时后面还会有 busy，等 busy 再提交
+        - {"type":"error","error":"busy","retry_from":seq,"count":..}：retry_from 之前的记录出队，
+          其余留在队列里，下次补发从 retry_from 重新开始
+        不是针对在途批次的回复（实时上报的 ack 等）count/seq 对不上，忽略。
+        """
+        inflight = self._inflight
+        if not inflight or not isinstance(msg, dict):
+            return 0
+
+        if msg.get("type") == "ack":
+            seqs = [s for s, _ in inflight if isinstance(s, int)]
+            if msg.get("count") != len(inflight) or msg.get("ack_upto") != (max(seqs) if seqs else None):
+                return 0
+            self._inflight = None
+            self._commit_offset(inflight[-1][1])
+            return len(inflight)
+
+        if msg.get("type") == "error" and msg.get("error") == "busy" and "retry_from" in msg:
+            start = len(inflight) - msg.get("count", -1)
+            if start < 0 or start >= len(inflight) or inflight[start][0] != msg.get("retry_from"):
+                return 0
+            self._inflight = None
+            if start > 0:
+                self._commit_offset(inflight[start - 1][1])
+            return start
+
+        return 0
+
+    def _peek_many(self, max_items):
+        """从读位置起顺序读取最多 max_items 条，返回 (records, offsets)：offsets[i] 为读完第 i 行后的 offset；
+        没有数据时两者都为空。"""
+        for _ in range(2):
+            ridx = int(self.meta.get("read_idx", 1))
+            widx = int(self.meta.get("write_idx", 1))
+            if ridx > widx or max_items <= 0:
+                return [], []
+
+            p = self._seg_path(ridx)
+            records = []
+            offsets = []
+            off = int(self.meta.get("read_offset", 0))
+            try:
+                with open(p, "r") as f:
+                    f.seek(off)
+                    while len(records) < max_items:
+                        line = f.readline()
+                        if not line:
+                            break
+                        try:
+                            off = f.tell()
+                        except Exception:
+                            off += len(line)
+                        offsets.append(off)
+                        try:
+                            if isinstance(line, bytes):
+                                line = line.decode()
+                            obj = json.loads(line)
+                            records.append(obj if isinstance(obj, dict) else {"_corrupt": True})
+                        except Exception:
+                            records.append({"_corrupt": True})
+            except Exception:
+                records = []
+                offsets = []
+
+            if records:
+                return records, offsets
+            if ridx < widx:
+                # 旧分片已读完（或不存在）：推进到下一个分片再试一次
+                self._advance_segment()
+                continue
+            return [], []
+        return [], []
+
+    def _commit_offset(self, new_off):
+        self.meta["read_offset"] = int(new_off)
+        self._persist_meta()
+        p = self._seg_path(int(self.meta.get("read_idx", 1)))
+        if _stat_size(p) <= int(self.meta.get("read_offset", 0)):
+            self._advance_segment()
+
     def _peek_one(self):
         ridx = int(self.meta.get("read_idx", 1))
         widx = int(self.meta.get("write_idx", 1))
@@ -289,6 +451,7 @@ class SdTelemetryQueue:
                 pass
         self.meta = {"write_idx": 1, "read_idx": 1, "read_offset": 0}
         self._persist_meta()
+        self._inflight = None
         return True
 
     def stats(self):
@@ -41,14 +41,46 @@ try:
 except ImportError:
     requests = None
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# 可选：批量补发时 gzip 压缩（MicroPython 1.21+ 的 deflate 模块，且固件需带压缩支持）
+try:
+    import deflate
+    import io
+except ImportError:
+    deflate = None
+
+# 批量补发接口：默认由 SERVER_URL（.../api/telemetry）推出 .../api/telemetry/bulk
+try:
+    from hw_config import SERVER_BULK_URL
+except Exception:
+    SERVER_BULK_URL = None
+
+
+def _gzip(data):
+    """尽力 gzip 压缩；固件不支持时返回 None。"""
+    if deflate is None:
+        return None
+    try:
+        buf = io.BytesIO()
+        with deflate.DeflateIO(buf, deflate.GZIP) as g:
+            g.write(data)
+        return buf.getvalue()
+    except Exception:
+        return None
+
 
 class WifiUploader:
     """WiFi 连接管理 + 上报封装（非阻塞调度）。"""
 
-    def __init__(self, ssid=WIFI_SSID, password=WIFI_PASSWORD, url=SERVER_URL):
+    def __init__(self, ssid=WIFI_SSID, password=WIFI_PASSWORD, url=SERVER_URL, bulk_url=SERVER_BULK_URL):
         self.ssid = ssid
         self.password = password
         self.url = url
+        self.bulk_url = bulk_url or ((url.rstrip("/") + "/bulk") if url else None)
         self.wlan = network.WLAN(network.STA_IF) if network else None
         self._next_retry = 0
         self._retry_interval_ms = 3000
@@ -146,6 +178,9 @@ class WifiUploader:
                 socket.setdefaulttimeout(self._timeout_s)
             except Exception:
                 pass
+            # 5xx（例如 server 写队列已满回 503 busy）：这条没有落库，按失败处理，调用方会保留并重发
+            if status >= 500:
+                return False, status
             return True, status
         except Exception as exc:
             try:
@@ -154,6 +189,56 @@ class WifiUploader:
                 pass
             return False, str(exc)
 
+    def post_bulk(self, records, timeout=5):
+        """批量补发：一次 POST 多条（NDJSON，固件支持时 gzip）。
+
+        返回 (ok, ack_upto)：server 按 (device_id, boot_id, seq) 去重（不带 boot_id 的记录不去重），ok=True 即整批已落库（含重复），可以从队列删除。
+        """
+        if not self.is_connected():
+            return False, "wifi-disconnected"
+        if requests is None:
+            return False, "urequests-missing"
+        if not self.bulk_url:
+            return False, "bulk-url-missing"
+
+        body = "\n".join([json.dumps(r) for r in records]).encode()
+        headers = {"Content-Type": "application/x-ndjson"}
+        if self._auth_header:
+            headers.update(self._auth_header)
+        packed = _gzip(body)
+        if packed is not None and len(packed) < len(body):
+            body = packed
+            headers["Content-Encoding"] = "gzip"
+
+        resp = None
+        try:
+            try:
+                socket.setdefaulttimeout(int(timeout) if timeout else self._timeout_s)
+            except Exception:
+                pass
+            resp = requests.post(self.bulk_url, data=body, headers=headers)
+            status = resp.status_code
+            if status != 200:
+                return False, status
+            ack_upto = None
+            try:
+                ack_upto = resp.json().get("ack_upto")
+            except Exception:
+                pass
+            return True, ack_upto
+        except Exception as exc:
+            return False, str(exc)
+        finally:
+            if resp is not None:
+                try:
+                    resp.close()
+                except Exception:
+                    pass
+            try:
+                socket.setdefaulttimeout(self._timeout_s)
+            except Exception:
+                pass
+
 
 def demo_send_once():
     """简单自测：连接 WiFi 并发送测试包。"""
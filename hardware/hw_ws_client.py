@@ -29,6 +29,12 @@ try:
 except Exception:
 	_websocket = None
 
+# 可选：紧凑二进制编码（hello 协商 protocol>=2 后用于 telemetry）
+try:
+	import hw_codec as _codec
+except Exception:
+	_codec = None
+
 # 项目内置：最小 WS 客户端兜底（当固件自带 websocket 库不提供 connect() 时使用）
 try:
 	from hw_ws_min_client import MinimalWsClient as _MinimalWsClient
@@ -36,6 +42,37 @@ except Exception:
 	_MinimalWsClient = None
 
 
+def build_telemetry_batch(device_id, records, is_buffered=False):
+	"""把多条 telemetry 记录打成一帧 telemetry_batch。
+
+	时间戳改写为相对首条的 dt、boot_id 提到帧上（帧更短）；服务端整帧只回一条 {"type":"ack","ack_upto":seq}。
+	"""
+	ts_base = None
+	boot_id = records[0].get("boot_id") if records else None
+	samples = []
+	for rec in records:
+		ts = rec.get("timestamp")
+		sample = {"seq": rec.get("seq"), "environment": rec.get("environment") or {}}
+		if isinstance(ts, (int, float)):
+			if ts_base is None:
+				ts_base = ts
+			sample["dt"] = ts - ts_base
+		else:
+			sample["timestamp"] = ts
+		if bool(rec.get("is_buffered", is_buffered)) != bool(is_buffered):
+			sample["is_buffered"] = bool(rec.get("is_buffered"))
+		if rec.get("boot_id") != boot_id:
+			# TF 队列里可能混有上一次上电的记录
+			sample["boot_id"] = rec.get("boot_id")
+		samples.append(sample)
+	msg = {"type": "telemetry_batch", "device_id": device_id, "is_buffered": bool(is_buffered), "samples": samples}
+	if ts_base is not None:
+		msg["ts_base"] = ts_base
+	if boot_id is not None:
+		msg["boot_id"] = boot_id
+	return msg
+
+
 class WsTelemetryClient:
 	def __init__(self, url, hello_payload, connect_timeout_s=2, io_timeout_s=0.3):
 		self.url = url
@@ -49,6 +86,8 @@ class WsTelemetryClient:
 		self.last_connect_ok_ms = 0
 		self._next_retry_ms = 0
 		self._retry_ms = 2000
+		# server 回 hello_ok 且 protocol>=2 后置位；每次重连清零
+		self.binary = False
 		self._max_retry_ms = 20000
 		_u_ok = bool(_uwebsocket and hasattr(_uwebsocket, "connect"))
 		_w_ok = bool(_websocket and hasattr(_websocket, "connect"))
@@ -128,6 +167,7 @@ class WsTelemetryClient:
 		try:
 			self.last_connect_ms = now_ms
 			self.ws = self._connect_impl()
+			self.binary = False
 			self._set_ws_socket_timeout()
 			# 连接成功，立刻发 hello
 			self.send_json(self.hello_payload)
@@ -159,6 +199,30 @@ class WsTelemetryClient:
 			self.close()
 			return False
 
+	def on_hello_ok(self, msg):
+		"""server 确认 protocol>=2 且当前连接能发二进制帧时，telemetry 改用紧凑编码。"""
+		try:
+			proto = int(msg.get("protocol") or 1)
+		except Exception:
+			proto = 1
+		self.binary = bool(
+			_codec and proto >= 2 and (self.hello_payload or {}).get("protocol", 1) >= 2 and hasattr(self.ws, "send_binary")
+		)
+
+	def send_telemetry(self, msg):
+		"""发送 telemetry / telemetry_batch：已协商二进制时先尝试紧凑编码，编码不了（字段表外的数据）再发 JSON。"""
+		if self.binary and self.ws:
+			frame = _codec.encode(msg)
+			if frame is not None:
+				try:
+					self._set_ws_socket_timeout()
+					self.ws.send_binary(frame)
+					return True
+				except Exception:
+					self.close()
+					return False
+		return self.send_json(msg)
+
 	def recv_once(self):
 		"""尽力读取一条消息；无消息/异常返回 None。"""
 		if not self.ws:
@@ -233,16 +233,23 @@ class MinimalWsClient:
 		return bytes(out)
 
 	def send(self, text: str):
-		if not self._ws:
-			raise OSError("not_connected")
 		if isinstance(text, str):
 			payload = text.encode()
 		else:
 			payload = bytes(text)
-
 		# FIN + text frame
+		self._send_frame(0x81, payload)
+
+	def send_binary(self, data: bytes):
+		"""发送二进制帧（紧凑编码的 telemetry，见 hw_codec）。"""
+		# FIN + binary frame
+		self._send_frame(0x82, bytes(data))
+
+	def _send_frame(self, first_byte: int, payload: bytes):
+		if not self._ws:
+			raise OSError("not_connected")
 		head = bytearray()
-		head.append(0x81)
+		head.append(first_byte)
 		ln = len(payload)
 		mask_bit = 0x80
 		if ln < 126:
@@ -47,6 +47,12 @@ try:
 except ImportError:
 	WsTelemetryClient = None
 
+try:
+	from hw_ws_client import build_telemetry_batch
+except ImportError:
+	# 旧版 hw_ws_client：退回逐条 telemetry
+	build_telemetry_batch = None
+
 try:
 	from hw_ble_server import BleUartServer
 except ImportError:
@@ -88,9 +94,39 @@ ENQUEUE_COOLDOWN_MS = 3000  # 断网入队冷却时间
 
 # TF 持久化队列：补发节奏
 SD_FLUSH_INTERVAL_MS = 2000  # 每 2s 尝试补发
-SD_FLUSH_MAX_ITEMS = 10  # 每次最多补发 10 条
+SD_FLUSH_MAX_ITEMS = 10  # 每次最多补发 10 条（WS 在线时合并为一帧 telemetry_batch）
+SD_BULK_MAX_ITEMS = 100  # WS 不可用时走 HTTP 批量接口（/api/telemetry/bulk），每次最多 100 条
+SD_DRAIN_INTERVAL_MS = 200  # 积压较多（上一轮发满）时加快补发节奏
+SD_ACK_TIMEOUT_MS = 10000  # WS 补发批次等 server ack 的最长时间，超时从同一位置重发
+WS_RECV_MAX_PER_TICK = 4  # 每个上报周期最多读几条 server 消息（ack/busy/command），读空即止
 SD_QUEUE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
 
+# WS 实时上报攒批：每 N 个采样合成一帧 telemetry_batch（1 = 逐条发送，实时性最好）
+try:
+	from hw_config import WS_BATCH_SAMPLES
+except ImportError:
+	WS_BATCH_SAMPLES = 1
+WS_BATCH_SAMPLES = max(1, int(WS_BATCH_SAMPLES)) if build_telemetry_batch else 1
+
+# WS 紧凑二进制编码：hello 声明 protocol=2，server 确认后 telemetry 改发二进制帧（见 hw_codec）
+try:
+	from hw_config import WS_BINARY
+except ImportError:
+	WS_BINARY = True
+try:
+	import hw_codec  # noqa: F401
+	WS_PROTOCOL = 2 if WS_BINARY else 1
+except ImportError:
+	WS_PROTOCOL = 1
+
+def new_boot_id():
+	"""本次上电的会话号：seq 每次上电从 0 开始，server 按 (device_id, boot_id, seq) 去重补发。"""
+	try:
+		return "%08x" % int.from_bytes(os.urandom(4), "big")
+	except Exception:
+		return "%08x" % (time.ticks_cpu() & 0xFFFFFFFF)
+
+
 def toggle_channel(current):
 	"""在 WIFI 与 BLE 之间切换。"""
 	return "BLE" if current == "WIFI" else "WIFI"
@@ -103,6 +139,14 @@ def enqueue(queue, item):
 	queue.append(item)  # 追加最新
 
 
+def enqueue_buffered(records, sd_queue, queue):
+	"""未发出的样本标记为补发并入队：优先 TF 队列，失败再退回内存队列。"""
+	for rec in records:
+		rec["is_buffered"] = True
+		if not (sd_queue and sd_queue.enqueue(rec)[0]):
+			enqueue(queue, rec)
+
+
 def set_wifi_enabled(enable):
 	"""按需启用/禁用 WiFi，避免与 BLE 干扰。"""
 	if not network:
@@ -162,6 +206,7 @@ def main():
 	# WebSocket 直连（优先使用；如配置缺失或模块不可用则跳过）
 	ws_client = None
 	seq = 0
+	boot_id = new_boot_id()
 	if channel == "WIFI" and WsTelemetryClient:
 		try:
 			from hw_config import SERVER_WS_URL, API_KEY, FIRMWARE_VERSION
@@ -173,7 +218,7 @@ def main():
 				"device_id": DEVICE_ID,
 				"api_key": API_KEY,
 				"firmware_version": FIRMWARE_VERSION or "0.0.0",
-				"protocol": 1,
+				"protocol": WS_PROTOCOL,
 				"capabilities": {"bmp280": True, "light": True},
 			}
 			ws_client = WsTelemetryClient(url=SERVER_WS_URL, hello_payload=hello, connect_timeout_s=2, io_timeout_s=0.3)
@@ -182,6 +227,7 @@ def main():
 		print("ble ready:", ble.is_ready())  # 打印 BLE 可用状态
 
 	retry_queue = []  # 失败数据缓存
+	ws_batch = []  # 攒批中、尚未发出的 WS 样本（WS_BATCH_SAMPLES > 1 时）
 	last_send = time.ticks_ms()  # 上次上报时间
 	last_mem = time.ticks_ms()  # 上次内存日志时间
 	last_status_log = time.ticks_ms()  # 上次网络状态日志时间
@@ -200,6 +246,7 @@ def main():
 	last_gc = time.ticks_ms()  # 上次 GC 时间
 	last_enqueue_fail = time.ticks_ms()  # 上次入队失败时间
 	last_sd_flush = time.ticks_ms()  # 上次 TF 队列补发时间
+	sd_inflight_ms = 0  # WS 补发批次发出的时间（等待 ack_upto / busy）
 	last_ble_report = time.ticks_ms()  # BLE 状态输出时间
 	last_sd_log = time.ticks_ms()	#上次挂载的时间
 
@@ -246,7 +293,7 @@ def main():
 									"device_id": DEVICE_ID,
 									"api_key": API_KEY,
 									"firmware_version": FIRMWARE_VERSION or "0.0.0",
-									"protocol": 1,
+									"protocol": WS_PROTOCOL,
 									"capabilities": {"bmp280": True, "light": True},
 								}
 								ws_client = WsTelemetryClient(url=SERVER_WS_URL, hello_payload=hello)
@@ -301,7 +348,7 @@ def main():
 								"device_id": DEVICE_ID,
 								"api_key": API_KEY,
 								"firmware_version": FIRMWARE_VERSION or "0.0.0",
-								"protocol": 1,
+								"protocol": WS_PROTOCOL,
 								"capabilities": {"bmp280": True, "light": True},
 							}
 							ws_client = WsTelemetryClient(url=SERVER_WS_URL, hello_payload=hello)
@@ -432,20 +479,44 @@ def main():
 					"timestamp": payload.get("timestamp"),
 					"environment": payload.get("environment"),
 					"seq": seq,
+					"boot_id": boot_id,
 					"is_buffered": False,
 				}
 
+				# WS 断开时：攒批中的样本按失败处理（开启缓存时入队补发，否则丢弃）
+				if ws_batch and not (ws_client and ws_client.is_connected()):
+					if cache_enabled:
+						enqueue_buffered(ws_batch, sd_queue, retry_queue)
+					ws_batch = []
+
 				# 优先使用 WebSocket 直连
-				if ws_client and ws_client.is_connected():
+				if ws_client and ws_client.is_connected() and WS_BATCH_SAMPLES > 1:
+					# 攒满 WS_BATCH_SAMPLES 个采样才发一帧，server 整帧回一条 ack_upto
+					ws_batch.append(http_payload)
+					if len(ws_batch) < WS_BATCH_SAMPLES:
+						ok, info = True, "ws-batched"
+					else:
+						ok = ws_client.send_telemetry(build_telemetry_batch(DEVICE_ID, ws_batch))
+						info = "ws-batch" if ok else "ws-fail"
+						_older = ws_batch[:-1]
+						ws_batch = []
+						if not ok:
+							# 之前攒下的样本按失败入队；本次样本走下面的 HTTP 备用
+							if cache_enabled:
+								enqueue_buffered(_older, sd_queue, retry_queue)
+							ok, info = uploader.post_json(http_payload)
+							info = "http-after-ws" if ok else info
+				elif ws_client and ws_client.is_connected():
 					ws_msg = {
 						"type": "telemetry",
 						"device_id": DEVICE_ID,
 						"seq": seq,
+						"boot_id": boot_id,
 						"timestamp": payload.get("timestamp"),
 						"environment": payload.get("environment"),
 						"is_buffered": False,
 					}
-					ok = ws_client.send_json(ws_msg)
+					ok = ws_client.send_telemetry(ws_msg)
 					info = "ws" if ok else "ws-fail"
 					# WS 发送失败时：立刻尝试 HTTP 备用
 					if not ok:
@@ -475,10 +546,12 @@ def main():
 							enqueue(retry_queue, http_payload)
 						last_enqueue_fail = now
 
-				# 尽力读取服务器消息：command（不强依赖）
+				# 尽力读取服务器消息：ack / busy（TF 补发批次按此出队）与 command（不强依赖）
 				if ws_client and ws_client.is_connected():
-					raw = ws_client.recv_once()
-					if raw:
+					for _ in range(WS_RECV_MAX_PER_TICK):
+						raw = ws_client.recv_once()
+						if not raw:
+							break
 						try:
 							if isinstance(raw, bytes):
 								raw = raw.decode()
@@ -486,6 +559,14 @@ def main():
 						except Exception:
 							msg = None
 
+						if isinstance(msg, dict) and msg.get("type") == "hello_ok":
+							ws_client.on_hello_ok(msg)
+
+						if isinstance(msg, dict) and sd_queue and msg.get("type") in ("ack", "error"):
+							_acked = sd_queue.on_reply(msg)
+							if _acked:
+								print("sd flush acked:", _acked)
+
 						if isinstance(msg, dict) and msg.get("type") == "command":
 							cmd_id = msg.get("cmd_id")
 							cmd = msg.get("command")
@@ -665,14 +746,30 @@ def main():
 			if time.ticks_diff(now, last_sd_flush) >= SD_FLUSH_INTERVAL_MS:
 				last_sd_flush = now
 
+				def try_send_batch(recs):
+					"""WS 在线：整批一帧 telemetry_batch（发出即返回 True，出队等 server 回 ack_upto）。返回 bool。"""
+					try:
+						return bool(ws_client.send_telemetry(build_telemetry_batch(DEVICE_ID, recs, is_buffered=True)))
+					except Exception:
+						return False
+
+				def try_post_bulk(recs):
+					"""HTTP 批量接口：整批一次 POST（server 去重，重复补发无副作用）。返回 bool。"""
+					try:
+						_ok_bulk, _ = uploader.post_bulk(recs)
+						return bool(_ok_bulk)
+					except Exception:
+						return False
+
 				def try_send_one(rec):
 					"""优先 WS，失败再 HTTP。返回 bool。"""
 					try:
 						if ws_client and ws_client.is_connected():
-							_ok_ws = ws_client.send_json({
+							_ok_ws = ws_client.send_telemetry({
 								"type": "telemetry",
 								"device_id": DEVICE_ID,
 								"seq": rec.get("seq"),
+								"boot_id": rec.get("boot_id"),
 								"timestamp": rec.get("timestamp"),
 								"environment": rec.get("environment") or {},
 								"is_buffered": bool(rec.get("is_buffered", False)),
@@ -688,9 +785,26 @@ def main():
 						return False
 
 				try:
-					sent, _ = sd_queue.flush(try_send_one, max_items=SD_FLUSH_MAX_ITEMS)
+					_ws_ok = bool(ws_client and ws_client.is_connected())
+					if sd_queue.inflight() and ((not _ws_ok) or time.ticks_diff(now, sd_inflight_ms) >= SD_ACK_TIMEOUT_MS):
+						# 断线或迟迟等不到 ack：放弃这一批的回复，从原位置重发（server 去重）
+						sd_queue.drop_inflight()
+					if build_telemetry_batch and _ws_ok:
+						_max = SD_FLUSH_MAX_ITEMS
+						sent, _ = sd_queue.send_batch(try_send_batch, max_items=_max)
+						if sent:
+							sd_inflight_ms = now
+					elif hasattr(uploader, "post_bulk"):
+						_max = SD_BULK_MAX_ITEMS
+						sent, _ = sd_queue.flush_batch(try_post_bulk, max_items=_max)
+					else:
+						_max = SD_FLUSH_MAX_ITEMS
+						sent, _ = sd_queue.flush(try_send_one, max_items=_max)
 					if sent:
 						print("sd flush sent:", sent)
+					if sent >= _max:
+						# 还有积压：下一轮提前到 SD_DRAIN_INTERVAL_MS 之后
+						last_sd_flush = time.ticks_add(now, SD_DRAIN_INTERVAL_MS - SD_FLUSH_INTERVAL_MS)
 				except Exception:
 					pass
 
@@ -1,98 +1,254 @@
 from __future__ import annotations
 
-import json
+import atexit
+import csv
+import io
+import itertools
+import os
+import secrets
+import signal
+import socket
+import sqlite3
+import sys
 import threading
 import time
-from dataclasses import dataclass, field
-from typing import Any, Dict, Optional, Set
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_sock import Sock
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.serving import make_server
 
 try:
 	from . import config  # type: ignore
 	from . import db  # type: ignore
+	from .downsample import lttb  # type: ignore
+	from .fanout import ALL, DashboardHub, Subscription, parse_subscription, project_metrics  # type: ignore
+	from .registry import DeviceRegistry, DeviceState  # type: ignore
+	from .timers import TimerWheel  # type: ignore
+	from .auth import ApiKeyAuth, bearer_token, load_device_keys  # type: ignore
+	from . import cluster  # type: ignore
+	from . import codec  # type: ignore
+	from . import compression  # type: ignore
+	from . import serialization  # type: ignore
 except Exception:
 	# 兼容直接运行：python server/app.py 或在 server 目录下 python app.py
 	import config  # type: ignore
 	import db  # type: ignore
+	from downsample import lttb  # type: ignore
+	from fanout import ALL, DashboardHub, Subscription, parse_subscription, project_metrics  # type: ignore
+	from registry import DeviceRegistry, DeviceState  # type: ignore
+	from timers import TimerWheel  # type: ignore
+	from auth import ApiKeyAuth, bearer_token, load_device_keys  # type: ignore
+	import cluster  # type: ignore
+	import codec  # type: ignore
+	import compression  # type: ignore
+	import serialization  # type: ignore
 
 
-app = Flask(__name__)
-sock = Sock(app)
+class _JSONProvider(DefaultJSONProvider):
+	"""jsonify / request.get_json 也走 serialization（orjson 等）；日期等类型仍由 default() 处理。"""
+
+	def dumps(self, obj: Any, **kwargs: Any) -> str:
+		return serialization.dumps(obj, default=kwargs.get("default", self.default))
+
+	def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+		return serialization.loads(s)
 
 
-@dataclass
-class DeviceState:
-	device_id: str
-	status: str = "offline"  # online/offline
-	last_seen: Optional[int] = None
-	firmware_version: Optional[str] = None
-	capabilities: Dict[str, Any] = field(default_factory=dict)
+app = Flask(__name__)
+app.json = _JSONProvider(app)
+sock = Sock(app)
 
 
-_lock = threading.Lock()
-_devices: Dict[str, DeviceState] = {}
-_latest_telemetry: Dict[str, Dict[str, Any]] = {}
-_dashboard_clients: Set[Any] = set()  # flask-sock WebSocket objects
+def _cfg_int(name: str, default: int) -> int:
+	try:
+		return int(getattr(config, name, default))
+	except Exception:
+		return default
+
+
+# 热路径用的设置与鉴权：启动时解析一次，SIGHUP 时整体替换（见 reload_settings）
+_settings = config.load_settings()
+_auth = ApiKeyAuth(_settings.api_keys, load_device_keys(_settings.device_keys_file))
+
+# 设备状态与最新 telemetry：按设备分片加锁，状态对象写时复制（见 registry.py）。
+# 状态版本：设备状态/最新 telemetry 每变化一次 +1，并记到该设备上（DeviceState.version）。
+_registry = DeviceRegistry(ttl_sec=_settings.device_offline_ttl_sec)
+# 离线判定：每个在线设备在时间轮上挂一个 last_seen + TTL 的定时器，每次上报只是 O(1) 地挪到新槽；
+# 到期时置为 offline 并推送一次 device_status（见 _expire_device）
+_offline_timers = TimerWheel(lambda device_id, deadline: _expire_device(device_id, deadline))
+# dashboard 连接：每个客户端一条有界发送队列 + 写线程，广播不在上报线程里做网络 IO
+_dashboard_hub = DashboardHub(
+	max_queue=getattr(config, "DASHBOARD_QUEUE_MAX", 256),
+	policy=getattr(config, "DASHBOARD_DROP_POLICY", "coalesce_latest"),
+	dumps=serialization.dumps,
+)
+_ws_lock = threading.Lock()  # 只保护 _device_ws
 _device_ws: Dict[str, Any] = {}  # device_id -> /ws/telemetry WebSocket
+_cmd_lock = threading.Lock()  # 只保护命令状态
 _pending_cmd: Dict[str, Dict[str, Any]] = {}  # cmd_id -> {device_id, command, ts}
 _cmd_results: Dict[str, Dict[str, Any]] = {}  # cmd_id -> {device_id, ok, result, error, command, ts}
-_cmd_counter = 0
+_cmd_counter = itertools.count(1)
+
+# epoch 每次进程启动随机生成，重启后旧版本号一律作废（客户端回退到全量快照）。
+_epoch = secrets.token_hex(6)
+# REST 响应缓存：name -> (版本号, etag, body, {编码: 压缩后的 body})
+_rest_cache: Dict[str, tuple] = {}
+# 多进程模式（config.BROKER_ADDR）下的 broker 连接；None 表示单进程
+_cluster: Optional["cluster.BrokerClient"] = None
 
 
 def _now_ts() -> int:
 	return int(time.time())
 
 
-def _effective_status(status: str, last_seen: Optional[int]) -> str:
-	"""基于 last_seen 的离线判定。
-
-	WS 连接断开时我们会主动设置 offline；但 HTTP 兜底没有“断开事件”，
-	因此需要用 TTL 进行推断。
-	"""
-	try:
-		ttl = int(getattr(config, "DEVICE_OFFLINE_TTL_SEC", 30))
-	except Exception:
-		ttl = 30
-	if ttl <= 0:
-		return status
-	if not last_seen:
-		return "offline"
-	return "offline" if (_now_ts() - int(last_seen)) > ttl else status
-
-
 def _device_to_dict(d: DeviceState) -> dict[str, Any]:
 	return {
 		"device_id": d.device_id,
-		"status": _effective_status(d.status, d.last_seen),
+		# 离线判定：WS 断开会主动置 offline；HTTP 兜底由时间轮在 last_seen + TTL 到期时置 offline
+		"status": d.status,
 		"last_seen": d.last_seen,
 		"firmware_version": d.firmware_version,
 		"capabilities": d.capabilities,
 	}
 
 
-def _auth_ok(api_key: Optional[str]) -> bool:
-	if not api_key:
-		return False
-	return api_key in config.API_KEYS
+def _auth_ok(api_key: Optional[str], device_id: Optional[str] = None) -> bool:
+	"""共享 key，或（给出 device_id 时）该设备自己的 key。"""
+	return _auth.check(api_key, device_id)
+
+
+def _request_token() -> str:
+	"""Authorization: Bearer <api_key>"""
+	return bearer_token(request.headers.get("Authorization"))
+
+
+def reload_settings() -> None:
+	"""重新加载配置与 API Key（SIGHUP）；只影响热路径设置，端口/线程数/数据库等需要重启。"""
+	global _settings, _auth
+	try:
+		settings = config.reload()
+		auth = ApiKeyAuth(settings.api_keys, load_device_keys(settings.device_keys_file))
+	except Exception as exc:
+		# 在信号处理里执行：不能把异常抛出去（会中断正在运行的 server），保留原配置
+		print(f"reload settings failed, keeping previous settings: {exc!r}", file=sys.stderr, flush=True)
+		return
+	_registry.ttl_sec = settings.device_offline_ttl_sec
+	_settings, _auth = settings, auth
+
+
+def _install_reload_signal() -> None:
+	if not hasattr(signal, "SIGHUP"):
+		return
+	try:
+		signal.signal(signal.SIGHUP, lambda *_: reload_settings())
+	except ValueError:
+		# 不在主线程（例如被嵌入到其他 server 里）：不装信号处理
+		pass
 
 
 def _db_enabled() -> bool:
 	"""是否启用 SQLite（允许在未部署 DB 时保持链路不报错中断）。"""
+	return _settings.enable_sqlite
+
+
+# telemetry_batch 单帧样本数上限
+_TELEMETRY_BATCH_MAX = max(1, _cfg_int("TELEMETRY_BATCH_MAX", 200))
+# /api/telemetry/bulk 单次请求的记录数 / 解压后字节数上限
+_TELEMETRY_BULK_MAX = max(1, _cfg_int("TELEMETRY_BULK_MAX", 10000))
+_TELEMETRY_BULK_MAX_BYTES = max(1024, _cfg_int("TELEMETRY_BULK_MAX_BYTES", 16 * 1024 * 1024))
+# 压缩：WebSocket permessage-deflate 开关；REST 响应体超过该字节数才压缩（0 关闭）
+_WS_DEFLATE = bool(getattr(config, "WS_DEFLATE", True))
+_HTTP_COMPRESS_MIN_BYTES = _cfg_int("HTTP_COMPRESS_MIN_BYTES", 1024)
+
+# 请求体上限（含 chunked 上传，werkzeug 读取时截断并回 413）：最大的合法请求就是 bulk
+app.config["MAX_CONTENT_LENGTH"] = _TELEMETRY_BULK_MAX_BYTES
+
+
+def _store_telemetry(record: dict[str, Any]) -> bool:
+	"""telemetry 落库：交给 db 写线程异步攒批，不在请求线程等待 commit。
+
+	返回 False 表示没有交出去（写队列已满或同步写入失败）：调用方不能确认这条，要让设备保留并稍后重发。
+	"""
+	if not _db_enabled():
+		return True
 	try:
-		return bool(getattr(config, "ENABLE_SQLITE", True))
+		return db.submit_telemetry(record)
 	except Exception:
-		return True
+		return False
 
 
-def _cmd_status_ttl_sec() -> int:
+# 写队列满时回给设备的重试间隔
+_BUSY_RETRY_AFTER_SEC = 1
+
+
+def _busy_response():
+	resp = jsonify({"ok": False, "error": "busy", "retry_after": _BUSY_RETRY_AFTER_SEC})
+	resp.headers["Retry-After"] = str(_BUSY_RETRY_AFTER_SEC)
+	return resp, 503
+
+
+def _store_blocks() -> bool:
+	"""落库是否会阻塞调用线程（启用了 SQLite 但写线程没在运行，submit 退回同步写入）。"""
+	return _db_enabled() and not db.writer_running()
+
+
+def _start_db_writer() -> None:
+	db.start_writer(
+		max_queue=_cfg_int("DB_WRITE_QUEUE_MAX", 10000),
+		batch_max=_cfg_int("DB_WRITE_BATCH_MAX", 200),
+		flush_interval_ms=_cfg_int("DB_WRITE_FLUSH_MS", 200),
+	)
+
+
+def _init_storage() -> None:
+	if not _db_enabled():
+		return
 	try:
-		v = int(getattr(config, "COMMAND_STATUS_TTL_SEC", 600))
-		return 600 if v <= 0 else v
+		db.configure_pool(
+			max_idle=_cfg_int("DB_POOL_MAX_IDLE", 8),
+			cached_statements=_cfg_int("DB_STATEMENT_CACHE", 64),
+		)
+		if not getattr(config, "DB_MIGRATED", False):
+			# 多进程部署时迁移已由 server.cluster 在启动 worker 前做过
+			db.init_db()
+		db.configure_dedup(window=_cfg_int("DEDUP_WINDOW", 512))
+		_start_db_writer()
+		if _cfg_int("WORKER_INDEX", 0) != 0:
+			# 多进程部署：保留期任务只在 0 号 worker 上跑
+			return
+		db.start_retention(
+			{
+				"raw": _cfg_int("RETENTION_RAW_DAYS", 0),
+				"1m": _cfg_int("RETENTION_1M_DAYS", 0),
+				"1h": _cfg_int("RETENTION_1H_DAYS", 0),
+				"1d": _cfg_int("RETENTION_1D_DAYS", 0),
+			},
+			interval_sec=_cfg_int("RETENTION_INTERVAL_SEC", 600),
+			batch_size=_cfg_int("RETENTION_BATCH_SIZE", 2000),
+			pause_ms=_cfg_int("RETENTION_BATCH_PAUSE_MS", 50),
+			vacuum_pages=_cfg_int("RETENTION_VACUUM_PAGES", 1000),
+		)
 	except Exception:
-		return 600
+		pass
+
+
+def _shutdown_storage() -> None:
+	# 先停保留期任务、排空写队列（避免丢失尚未提交的 telemetry），再关闭池中连接
+	db.stop_retention()
+	db.stop_writer()
+	db.close_pool()
+
+
+atexit.register(_shutdown_storage)
+
+
+def _cmd_status_ttl_sec() -> int:
+	return _settings.command_status_ttl_sec
 
 
 def _cleanup_cmd_maps(now_ts: Optional[int] = None) -> None:
@@ -100,7 +256,7 @@ def _cleanup_cmd_maps(now_ts: Optional[int] = None) -> None:
 	if now_ts is None:
 		now_ts = _now_ts()
 	ttl = _cmd_status_ttl_sec()
-	with _lock:
+	with _cmd_lock:
 		for cmd_id, rec in list(_pending_cmd.items()):
 			try:
 				if (now_ts - int(rec.get("ts") or 0)) > ttl:
@@ -116,67 +272,347 @@ def _cleanup_cmd_maps(now_ts: Optional[int] = None) -> None:
 
 
 def _broadcast_dashboard(message: dict[str, Any]) -> None:
-	payload = json.dumps(message, separators=(",", ":"), ensure_ascii=False)
-	dead = []
-	for ws in list(_dashboard_clients):
-		try:
-			ws.send(payload)
-		except Exception:
-			dead.append(ws)
-	for ws in dead:
-		_dashboard_clients.discard(ws)
+	# 按订阅索引只投递给相关客户端（非阻塞入队）；慢客户端不会拖慢设备上报
+	_dashboard_hub.broadcast(message)
+
+
+def _resume_version(epoch: Any, since_version: Any) -> Optional[int]:
+	"""客户端带来的 (epoch, version) 可用于增量同步时返回该版本号，否则返回 None（需要全量）。"""
+	if epoch != _epoch:
+		return None
+	try:
+		v = int(since_version)
+	except Exception:
+		return None
+	return v if 0 <= v <= _registry.version else None
 
 
-def _broadcast_command_status(message: dict[str, Any]) -> None:
+def _dashboard_snapshot(sub: Subscription = ALL, since_version: Optional[int] = None) -> dict[str, Any]:
+	"""设备状态与最新 telemetry 的快照（按订阅过滤设备与指标）。
+
+	since_version 不为 None 时只返回该版本之后变化过的设备（snapshot_delta）。
+	"""
+	version, devs, latest = _registry.snapshot(since_version)
+	devices = [_device_to_dict(d) for d in devs]
+	if sub.device_ids is not None:
+		devices = [d for d in devices if d["device_id"] in sub.device_ids]
+		latest = [t for t in latest if t.get("device_id") in sub.device_ids]
+	if sub.metrics is not None:
+		latest = [project_metrics(t, sub.metrics) for t in latest]
+	return {
+		"type": "snapshot" if since_version is None else "snapshot_delta",
+		"epoch": _epoch,
+		"version": version,
+		"devices": devices,
+		"latest": latest,
+	}
+
+
+def _cached_json(name: str, build: Any) -> Response:
+	"""按状态版本缓存 REST 响应体，并支持 ETag / If-None-Match（命中返回 304）。
+
+	build() 返回 (版本号, body 对象)；离线判定也会推进版本号，因此版本号不变就可以直接复用 body。
+	"""
+	hit = _rest_cache.get(name)
+	if hit is None or hit[0] != _registry.version:
+		version, obj = build()
+		body = serialization.dumps_bytes(obj)
+		hit = (version, f"{_epoch}-{version}", body, {})
+		_rest_cache[name] = hit
+	# 压缩结果跟着 body 一起缓存：同一版本只压一次
+	encoding = _response_encoding(len(hit[2]))
+	if encoding is None:
+		resp = Response(hit[2], mimetype="application/json")
+		resp.set_etag(hit[1])
+	else:
+		packed = hit[3].get(encoding)
+		if packed is None:
+			packed = hit[3][encoding] = compression.compress(hit[2], encoding)
+		resp = Response(packed, mimetype="application/json")
+		resp.headers["Content-Encoding"] = encoding
+		resp.set_etag(hit[1], weak=True)
+	resp.vary.add("Accept-Encoding")
+	return resp.make_conditional(request)
+
+
+def _response_encoding(size: Optional[int]) -> Optional[str]:
+	"""本次响应要用的压缩编码；size 为 None 表示流式响应（总是压缩）。"""
+	if _HTTP_COMPRESS_MIN_BYTES <= 0 or (size is not None and size < _HTTP_COMPRESS_MIN_BYTES):
+		return None
+	return compression.choose(request.headers.get("Accept-Encoding", ""))
+
+
+@app.after_request
+def _compress_response(resp: Response) -> Response:
+	"""REST 响应压缩：JSON/NDJSON/CSV 超过阈值且客户端接受时按 br/gzip 压缩（流式响应逐块压缩）。"""
+	if (
+		request.method == "HEAD"
+		or resp.status_code < 200
+		or resp.status_code in (204, 206, 304)
+		or resp.direct_passthrough
+		or "Content-Encoding" in resp.headers
+		or resp.mimetype not in compression.COMPRESSIBLE
+	):
+		return resp
+	resp.vary.add("Accept-Encoding")
+	if resp.is_streamed:
+		encoding = _response_encoding(None)
+		if encoding is None:
+			return resp
+		resp.response = compression.stream(resp.iter_encoded(), encoding)
+		resp.headers.pop("Content-Length", None)
+	else:
+		data = resp.get_data()
+		encoding = _response_encoding(len(data))
+		if encoding is None:
+			return resp
+		resp.set_data(compression.compress(data, encoding))
+	resp.headers["Content-Encoding"] = encoding
+	# 压缩后字节不同：强 ETag 降为弱 ETag（If-None-Match 按弱比较，仍能命中 304）
+	etag, weak = resp.get_etag()
+	if etag and not weak:
+		resp.set_etag(etag, weak=True)
+	return resp
+
+
+@app.before_request
+def _ws_deflate_toggle() -> None:
+	"""WS_DEFLATE=0 时去掉握手里的 permessage-deflate 提议（simple-websocket 默认会接受）。"""
+	if not _WS_DEFLATE and request.path in ("/ws/dashboard", "/ws/telemetry"):
+		request.environ.pop("HTTP_SEC_WEBSOCKET_EXTENSIONS", None)
+
+
+def _command_message(message: dict[str, Any]) -> dict[str, Any]:
 	# 命令面向 dashboard 推送，结构与 telemetry/device_status 一致
 	message = dict(message)
 	message.setdefault("server_ts", _now_ts())
-	_broadcast_dashboard(message)
+	return message
 
 
 def _next_cmd_id() -> str:
-	global _cmd_counter
-	with _lock:
-		_cmd_counter += 1
-		c = _cmd_counter
+	c = next(_cmd_counter)
+	if _cluster is not None:
+		# 多个 worker 各自计数，带上 worker 序号避免 cmd_id 冲突
+		return f"cmd_{_now_ts()}_{_cfg_int('WORKER_INDEX', 0)}_{c}"
 	return f"cmd_{_now_ts()}_{c}"
 
 
 def _set_device_status(device_id: str, status: str) -> None:
-	with _lock:
-		state = _devices.get(device_id) or DeviceState(device_id=device_id)
-		state.status = status
-		if status == "online":
-			state.last_seen = _now_ts()
-		_devices[device_id] = state
-
-	_broadcast_dashboard(
+	patch: Dict[str, Any] = {"status": status}
+	if status == "online":
+		patch["last_seen"] = _now_ts()
+	_emit({"device_id": device_id, "patch": patch, "status": True})
+
+
+def _emit(event: dict[str, Any]) -> None:
+	"""提交一条状态事件（字段含义见 cluster.Broker）。
+
+	单进程直接应用；多进程交给 broker 排序、分配版本号后再回放到每个 worker（含本进程）。
+	broker 暂时不可用时退化为本地应用，重连后以 broker 的完整状态为准。
+	"""
+	if _cluster is not None and _cluster.publish(event):
+		return
+	_apply_event(event)
+
+
+def _apply_event(event: dict[str, Any]) -> None:
+	"""把一条状态事件应用到本进程的状态，并推送给本进程的 dashboard 连接。"""
+	device_id = event.get("device_id")
+	telemetry = event.get("telemetry")
+	message = event.get("message")
+	if device_id and (event.get("patch") is not None or event.get("config") is not None or telemetry is not None):
+		# 只锁该设备所在的分片
+		before, state = _registry.apply(
+			device_id,
+			patch=event.get("patch"),
+			config=event.get("config"),
+			telemetry=telemetry,
+			version=event.get("version"),
+			expect=event.get("expect"),
+		)
+		if state is None:
+			# 条件不满足（例如离线定时器到期前设备又上报了）：整条事件作废
+			return
+		_schedule_offline(state)
+		# status 有变化就推送（例如离线定时器到期后设备又经 HTTP 上报），不依赖调用方是否标了 status
+		if event.get("status") or (before.status if before is not None else "offline") != state.status:
+			message = {
+				"type": "device_status",
+				"device_id": device_id,
+				"status": state.status,
+				"last_seen": state.last_seen,
+				"version": state.version,
+			}
+	pending = event.get("pending")
+	result = event.get("result")
+	if pending or result:
+		with _cmd_lock:
+			if pending:
+				_pending_cmd[pending["cmd_id"]] = pending
+			if result:
+				_cmd_results[result["cmd_id"]] = result
+				# pending 消费掉，避免增长
+				_pending_cmd.pop(result["cmd_id"], None)
+
+	if telemetry is not None:
+		_broadcast_dashboard(telemetry)
+	if message:
+		_broadcast_dashboard(message)
+
+
+def _schedule_offline(state: DeviceState) -> None:
+	if state.status != "offline" and state.expires_at is not None:
+		# 与原先的判定一致：now - last_seen > TTL 即离线，也就是 expires_at 的下一秒
+		_offline_timers.schedule(state.device_id, state.expires_at + 1)
+	else:
+		_offline_timers.cancel(state.device_id)
+
+
+def _expire_device(device_id: str, deadline: int) -> None:
+	"""离线定时器到期（时间轮线程）：last_seen 没有再前进就置为 offline，并推送 device_status。"""
+	state = _registry.get(device_id)
+	if state is None or state.status == "offline" or state.expires_at is None or state.expires_at + 1 != deadline:
+		return
+	# expect：只在期间没有新上报时生效；多进程下每个 worker 都会到期，broker 只采纳第一条
+	_emit(
 		{
-			"type": "device_status",
 			"device_id": device_id,
-			"status": status,
-			"last_seen": _devices[device_id].last_seen,
+			"patch": {"status": "offline"},
+			"status": True,
+			"expect": {"status": state.status, "last_seen": state.last_seen},
 		}
 	)
 
 
+def _cluster_load_state(state: dict[str, Any]) -> None:
+	"""（重新）连上 broker：用 broker 的完整状态替换本地副本，并重新登记本进程持有的设备连接。"""
+	global _epoch
+	changed_epoch = state.get("epoch") != _epoch
+	_epoch = state.get("epoch") or _epoch
+	_registry.load(
+		state.get("devices") or [],
+		state.get("latest") or [],
+		state.get("versions") or {},
+		int(state.get("version") or 0),
+	)
+	for d in _registry.snapshot()[1]:
+		_schedule_offline(d)
+	with _cmd_lock:
+		_pending_cmd.clear()
+		_pending_cmd.update({c["cmd_id"]: c for c in state.get("pending") or []})
+		_cmd_results.clear()
+		_cmd_results.update({c["cmd_id"]: c for c in state.get("results") or []})
+	_rest_cache.clear()
+	with _ws_lock:
+		local = list(_device_ws)
+	if changed_epoch:
+		# broker 重启过：本进程 dashboard 手里的版本号已无效，断开让它们重连拿全量快照
+		_dashboard_hub.close_all()
+	for device_id in local:
+		_emit({"device_id": device_id, "patch": {"status": "online", "last_seen": _now_ts()}, "status": True, "own": True})
+
+
+def _deliver_command(device_id: str, text: str) -> Optional[str]:
+	"""其他 worker 经 broker 转来的命令：发给本进程持有的设备连接。"""
+	with _ws_lock:
+		ws = _device_ws.get(device_id)
+	if ws is None:
+		return "device_offline"
+	try:
+		ws.send(text)
+	except Exception:
+		with _ws_lock:
+			_device_ws.pop(device_id, None)
+		return "send_failed"
+	return None
+
+
+def _evict_device(device_id: str) -> None:
+	# 设备已在其他 worker 重连：旧连接之后断开时不再把它置为 offline
+	with _ws_lock:
+		_device_ws.pop(device_id, None)
+
+
+def _start_cluster() -> None:
+	"""配置了 BROKER_ADDR 时作为 worker 连接 broker（多进程部署，见 server/cluster.py）。"""
+	global _cluster
+	addr = (getattr(config, "BROKER_ADDR", "") or "").strip()
+	if not addr or _cluster is not None:
+		return
+	authkey = cluster.broker_authkey()
+	if not authkey:
+		raise SystemExit("SLS_BROKER_ADDR 已配置但 SLS_BROKER_AUTHKEY 为空：请配置与 broker 相同的 authkey")
+	_cluster = cluster.BrokerClient(
+		cluster.parse_address(addr),
+		authkey,
+		worker_id=f"{socket.gethostname()}-{os.getpid()}",
+		on_state=_cluster_load_state,
+		on_event=_apply_event,
+		on_deliver=_deliver_command,
+		on_evict=_evict_device,
+	)
+	_cluster.start()
+
+
 @app.get("/health")
 def health():
 	return jsonify({"ok": True, "ts": _now_ts()})
 
 
+@app.get("/api/metrics")
+def metrics():
+	"""运行时指标（排障用）：写队列深度/丢弃数/批量提交耗时、连接池命中等。"""
+	return jsonify(
+		{
+			"ok": True,
+			"ts": _now_ts(),
+			"db_writer": db.writer_stats(),
+			"db_dedup": db.dedup_stats(),
+			"db_pool": db.pool_stats(),
+			"retention": db.retention_stats(),
+			"dashboard": _dashboard_hub.stats(),
+			"offline_timers": {"pending": len(_offline_timers), **_offline_timers.stats},
+			"auth": _auth.stats(),
+			"json_backend": serialization.BACKEND,
+			"http_compression": compression.stats(),
+			"cluster": None if _cluster is None else {"connected": _cluster.connected, **_cluster.stats},
+		}
+	)
+
+
 @app.get("/api/devices")
 def list_devices():
-	with _lock:
-		items = [_device_to_dict(d) for d in _devices.values()]
-	return jsonify({"items": sorted(items, key=lambda x: x["device_id"])})
+	# 状态未变化时复用上次的响应体；带 If-None-Match 的请求直接 304
+	def build():
+		version, devs, _ = _registry.snapshot()
+		items = [_device_to_dict(d) for d in devs]
+		return version, {"items": sorted(items, key=lambda x: x["device_id"]), "version": version}
+
+	return _cached_json("devices", build)
 
 
 @app.get("/api/telemetry/latest")
 def telemetry_latest():
-	with _lock:
-		items = list(_latest_telemetry.values())
-	return jsonify({"items": items})
+	def build():
+		version, _, latest = _registry.snapshot()
+		return version, {"items": latest, "version": version}
+
+	return _cached_json("telemetry_latest", build)
+
+
+def _arg_int(name: str) -> Optional[int]:
+	v = (request.args.get(name) or "").strip()
+	if not v:
+		return None
+	try:
+		return int(float(v))
+	except Exception:
+		return None
+
+
+def _arg_time_field() -> str:
+	"""时间口径参数 time：event（默认，事件时间）/ arrival（服务器到达时间）。"""
+	return (request.args.get("time") or "event").strip().lower()
 
 
 @app.get("/api/telemetry/history")
@@ -184,33 +620,225 @@ def telemetry_history():
 	"""查询 telemetry 历史（SQLite）。
 
 	参数：
-	- device_id (required)
+	- device_id (required；或改用 device_ids)
+	- device_ids (optional, 逗号分隔，最多 200 个)：一次查询多个设备，返回 items_by_device，
+	  limit 为每设备条数（总行数上限 20000，超出时按设备数下调）
 	- since (optional, unix seconds)
 	- until (optional, unix seconds)
 	- limit (optional, default 200, max 2000)
+	- time (optional, event|arrival，默认 event)：since/until 与排序按事件时间 event_ts
+	  （设备时间可信时为设备时间，否则为到达时间）还是按服务器到达时间 server_ts
+	- cursor (optional)：出现该参数（首页可为空串）即进入 keyset 分页模式，
+	  按时间升序返回 limit 条并带 next_cursor（为 null 表示到底）
+	- points (optional, 点数预算)：原始行数超出预算时自动改读 rollup（1m/1h/1d 中桶数
+	  不超预算的最细一档），此时 items 为聚合桶（结构同 /api/telemetry/aggregate 的 buckets），
+	  并返回 resolution；未指定 since 时默认最近 24 小时（time=arrival 时总是返回原始行）
+	"""
+	device_id = (request.args.get("device_id") or "").strip()
+	device_ids = [d.strip() for d in (request.args.get("device_ids") or "").split(",") if d.strip()]
+	if not device_id and not device_ids:
+		return jsonify({"ok": False, "error": "device_id_required"}), 400
+	if not _db_enabled():
+		return jsonify({"ok": False, "error": "sqlite_disabled"}), 503
+
+	since_ts = _arg_int("since")
+	until_ts = _arg_int("until")
+	limit = _arg_int("limit") or 200
+	points = _arg_int("points")
+	time_field = _arg_time_field()
+
+	try:
+		if device_ids:
+			by_device = db.query_telemetry_multi(
+				device_ids=device_ids, since_ts=since_ts, until_ts=until_ts, limit=limit, time_field=time_field
+			)
+			return jsonify({"ok": True, "resolution": "raw", "items_by_device": by_device})
+		if "cursor" in request.args:
+			items, next_cursor = db.query_telemetry_page(
+				device_id=device_id,
+				since_ts=since_ts,
+				until_ts=until_ts,
+				limit=limit,
+				cursor=(request.args.get("cursor") or "").strip() or None,
+				time_field=time_field,
+			)
+			return jsonify({"ok": True, "resolution": "raw", "items": items, "next_cursor": next_cursor})
+		if points and points > 0:
+			until_ts = until_ts or _now_ts()
+			if since_ts is None:
+				since_ts = until_ts - 24 * 3600
+			# 原始行最多返回 2000 条，预算再大也按 2000 判断是否需要改读 rollup；
+			# rollup 按事件时间分桶，arrival 口径只能查原始行
+			resolution = None
+			if time_field == "event":
+				resolution = db.choose_resolution(device_id, since_ts, until_ts, min(points, 2000))
+			if resolution is not None:
+				result = db.aggregate_rollup(
+					device_id, since_ts, until_ts, db.ROLLUP_RESOLUTIONS[resolution]
+				)
+				return jsonify(
+					{
+						"ok": True,
+						"resolution": resolution,
+						"bucket": result["bucket"],
+						"metrics": result["metrics"],
+						"items": result["buckets"],
+					}
+				)
+			limit = 2000
+
+		items = db.query_telemetry(
+			device_id=device_id, since_ts=since_ts, until_ts=until_ts, limit=limit, time_field=time_field
+		)
+		return jsonify({"ok": True, "resolution": "raw", "items": items})
+	except ValueError as exc:
+		return jsonify({"ok": False, "error": str(exc)}), 400
+	except Exception as exc:
+		return jsonify({"ok": False, "error": str(exc)}), 500
+
+
+_EXPORT_CSV_COLUMNS = (
+	"device_id",
+	"timestamp",
+	"server_ts",
+	"event_ts",
+	"seq",
+	"is_buffered",
+	"bmp280.temp",
+	"bmp280.pressure",
+	"bmp280.status",
+	"light.raw",
+	"light.voltage",
+	"light.percent",
+	"extra",
+)
+
+
+def _csv_line(values: list[Any]) -> str:
+	buf = io.StringIO()
+	csv.writer(buf, lineterminator="\n").writerow(["" if v is None else v for v in values])
+	return buf.getvalue()
+
+
+def _export_csv_row(item: dict[str, Any]) -> str:
+	env = dict(item.get("environment") or {})
+	bmp = env.pop("bmp280", None) or {}
+	light = env.pop("light", None) or {}
+	if not isinstance(bmp, dict) or not isinstance(light, dict):
+		bmp, light, env = {}, {}, dict(item.get("environment") or {})
+	return _csv_line(
+		[
+			item.get("device_id"),
+			item.get("timestamp"),
+			item.get("server_ts"),
+			item.get("event_ts"),
+			item.get("seq"),
+			1 if item.get("is_buffered") else 0,
+			bmp.get("temp"),
+			bmp.get("pressure"),
+			bmp.get("status"),
+			light.get("raw"),
+			light.get("voltage"),
+			light.get("percent"),
+			serialization.dumps(env) if env else None,
+		]
+	)
+
+
+@app.get("/api/telemetry/export")
+def telemetry_export():
+	"""流式导出 telemetry（NDJSON / CSV），内存占用与导出行数无关。
+
+	参数：
+	- device_id (required)
+	- since/until (optional, unix seconds)
+	- time (optional, event|arrival，默认 event；同 /api/telemetry/history)
+	- format (optional, ndjson|csv，默认 ndjson)
 	"""
 	device_id = (request.args.get("device_id") or "").strip()
 	if not device_id:
 		return jsonify({"ok": False, "error": "device_id_required"}), 400
 	if not _db_enabled():
 		return jsonify({"ok": False, "error": "sqlite_disabled"}), 503
+	fmt = (request.args.get("format") or "ndjson").strip().lower()
+	if fmt not in ("ndjson", "csv"):
+		return jsonify({"ok": False, "error": "invalid_format"}), 400
+	time_field = _arg_time_field()
+	if time_field not in db.TIME_FIELDS:
+		return jsonify({"ok": False, "error": "invalid_time_field"}), 400
+
+	since_ts = _arg_int("since")
+	until_ts = _arg_int("until")
+
+	def generate():
+		if fmt == "csv":
+			yield _csv_line(list(_EXPORT_CSV_COLUMNS))
+		for item in db.iter_telemetry(device_id=device_id, since_ts=since_ts, until_ts=until_ts, time_field=time_field):
+			if fmt == "csv":
+				yield _export_csv_row(item)
+			else:
+				yield serialization.dumps_bytes(item) + b"\n"
+
+	mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+	filename = f"telemetry_{device_id}.{fmt}"
+	return Response(
+		generate(),
+		mimetype=mimetype,
+		headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+	)
 
-	def _to_int(name: str) -> Optional[int]:
-		v = (request.args.get(name) or "").strip()
-		if not v:
-			return None
-		try:
-			return int(float(v))
-		except Exception:
-			return None
 
-	since_ts = _to_int("since")
-	until_ts = _to_int("until")
-	limit = _to_int("limit") or 200
+@app.get("/api/telemetry/aggregate")
+def telemetry_aggregate():
+	"""按桶聚合 telemetry 历史（SQLite GROUP BY），返回体积与时间范围无关。
+
+	参数：
+	- device_id (required)
+	- since/until (optional, unix seconds；默认最近 24 小时)
+	- time (optional, event|arrival，默认 event；arrival 口径不走 rollup，总是扫原始行)
+	- bucket (optional, 桶宽秒数；默认按 ~300 个桶自动选择，桶数上限 2000)
+	- metrics (optional, 逗号分隔，如 bmp280.temp,light.percent；默认全部数值指标)
+	- lttb (optional, 额外返回每个指标 LTTB 降采样后的至多 n 个原始点，n<=5000)
+	"""
+	device_id = (request.args.get("device_id") or "").strip()
+	if not device_id:
+		return jsonify({"ok": False, "error": "device_id_required"}), 400
+	if not _db_enabled():
+		return jsonify({"ok": False, "error": "sqlite_disabled"}), 503
+
+	until_ts = _arg_int("until") or _now_ts()
+	since_ts = _arg_int("since")
+	if since_ts is None:
+		since_ts = until_ts - 24 * 3600
+	if since_ts > until_ts:
+		return jsonify({"ok": False, "error": "invalid_range"}), 400
+	bucket = _arg_int("bucket") or max(1, (until_ts - since_ts) // 300)
+	metrics = [m.strip() for m in (request.args.get("metrics") or "").split(",") if m.strip()]
+	lttb_n = _arg_int("lttb")
+	time_field = _arg_time_field()
 
 	try:
-		items = db.query_telemetry(device_id=device_id, since_ts=since_ts, until_ts=until_ts, limit=limit)
-		return jsonify({"ok": True, "items": items})
+		result = db.aggregate_telemetry(
+			device_id=device_id,
+			since_ts=since_ts,
+			until_ts=until_ts,
+			bucket_sec=bucket,
+			metrics=metrics,
+			time_field=time_field,
+		)
+		resp: Dict[str, Any] = {"ok": True, "device_id": device_id, "since": since_ts, "until": until_ts, **result}
+		if lttb_n and lttb_n > 0:
+			raw = db.query_metric_points(
+				device_id=device_id,
+				since_ts=since_ts,
+				until_ts=until_ts,
+				metrics=result["metrics"],
+				time_field=time_field,
+			)
+			resp["points"] = {name: lttb(pts, min(lttb_n, 5000)) for name, pts in raw.items()}
+		return jsonify(resp)
+	except ValueError as exc:
+		return jsonify({"ok": False, "error": str(exc)}), 400
 	except Exception as exc:
 		return jsonify({"ok": False, "error": str(exc)}), 500
 
@@ -222,13 +850,11 @@ def telemetry_ingest_http():
 	- 用于设备端在 WS 不可用时的兜底
 	- 认证方式：Authorization: Bearer <api_key>
 	"""
-	auth = request.headers.get("Authorization", "")
-	token = auth[7:].strip() if auth.startswith("Bearer ") else ""
-	if not _auth_ok(token):
-		return jsonify({"ok": False, "error": "unauthorized"}), 401
-
 	body = request.get_json(silent=True) or {}
 	device_id = (body.get("device_id") or "").strip()
+	# 设备 key 只对 body 里的 device_id 有效
+	if not _auth_ok(_request_token(), device_id or None):
+		return jsonify({"ok": False, "error": "unauthorized"}), 401
 	if not device_id:
 		return jsonify({"ok": False, "error": "device_id_required"}), 400
 
@@ -240,37 +866,200 @@ def telemetry_ingest_http():
 		"type": "telemetry",
 		"device_id": device_id,
 		"seq": body.get("seq"),
+		"boot_id": body.get("boot_id"),
 		"timestamp": body.get("timestamp"),
 		"environment": env,
 		"is_buffered": bool(body.get("is_buffered", False)),
 		"server_ts": _now_ts(),
 	}
 
-	with _lock:
-		_latest_telemetry[device_id] = record
-		state = _devices.get(device_id) or DeviceState(device_id=device_id)
-		state.status = "online"
-		state.last_seen = _now_ts()
-		_devices[device_id] = state
+	_emit({"device_id": device_id, "patch": {"status": "online", "last_seen": _now_ts()}, "telemetry": record})
+	if not _store_telemetry(record):
+		return _busy_response()
+	return jsonify({"ok": True, "server_ts": _now_ts()})
+
 
-	_broadcast_dashboard(record)
-	if _db_enabled():
+def _read_body(limit: int) -> bytes:
+	"""读取请求体（含 chunked 上传），超过 limit 抛 ValueError("payload_too_large")，不会把截断的 body 当完整的处理。"""
+	chunks = []
+	size = 0
+	try:
+		while size <= limit:
+			chunk = request.stream.read(min(64 * 1024, limit + 1 - size))
+			if not chunk:
+				break
+			chunks.append(chunk)
+			size += len(chunk)
+	except RequestEntityTooLarge:
+		# MAX_CONTENT_LENGTH 截断：读到上限后还有数据
+		raise ValueError("payload_too_large")
+	if size > limit:
+		raise ValueError("payload_too_large")
+	return b"".join(chunks)
+
+
+def _decompress_body(body: bytes, encoding: str, limit: int) -> bytes:
+	"""按 Content-Encoding 解压请求体（gzip / deflate），解压结果超过 limit 抛 ValueError。"""
+	encoding = encoding.strip().lower()
+	if encoding in ("", "identity"):
+		if len(body) > limit:
+			raise ValueError("payload_too_large")
+		return body
+	if encoding in ("gzip", "x-gzip"):
+		candidates = [16 + zlib.MAX_WBITS]
+	elif encoding == "deflate":
+		# 标准是 zlib 封装；部分客户端发裸 deflate，失败时再试一次
+		candidates = [zlib.MAX_WBITS, -zlib.MAX_WBITS]
+	else:
+		raise ValueError("unsupported_content_encoding")
+	for wbits in candidates:
+		d = zlib.decompressobj(wbits)
 		try:
-			db.insert_telemetry(record)
+			out = d.decompress(body, limit + 1)
+		except zlib.error:
+			continue
+		if len(out) > limit or d.unconsumed_tail:
+			raise ValueError("payload_too_large")
+		return out
+	raise ValueError("invalid_compressed_body")
+
+
+def _parse_bulk_body(data: bytes) -> Tuple[List[Any], int]:
+	"""JSON 数组或 NDJSON -> (条目列表, 无法解析的行数)；首个非空白字符为 '[' 时按数组解析。"""
+	stripped = data.lstrip()
+	if stripped[:1] == b"[":
+		try:
+			items = serialization.loads(stripped)
 		except Exception:
-			pass
-	return jsonify({"ok": True, "server_ts": _now_ts()})
+			raise ValueError("invalid_json")
+		if not isinstance(items, list):
+			raise ValueError("invalid_json")
+		return items, 0
+	items: List[Any] = []
+	bad = 0
+	for line in data.splitlines():
+		if not line.strip():
+			continue
+		try:
+			items.append(serialization.loads(line))
+		except Exception:
+			bad += 1
+	return items, bad
+
+
+def _bulk_record(item: Any, server_ts: int) -> Optional[dict[str, Any]]:
+	"""校验一条批量补发记录（字段同 POST /api/telemetry），不合法返回 None。"""
+	if not isinstance(item, dict):
+		return None
+	device_id = item.get("device_id")
+	if not isinstance(device_id, str) or not device_id.strip():
+		return None
+	seq = item.get("seq")
+	if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+		return None
+	ts = item.get("timestamp")
+	if ts is not None and (not isinstance(ts, (int, float)) or isinstance(ts, bool)):
+		return None
+	env = item.get("environment")
+	return {
+		"type": "telemetry",
+		"device_id": device_id.strip(),
+		"seq": seq,
+		"boot_id": item.get("boot_id"),
+		"timestamp": ts,
+		"environment": env if isinstance(env, dict) else {},
+		"is_buffered": bool(item.get("is_buffered", True)),
+		"server_ts": server_ts,
+	}
 
 
-@app.post("/api/devices/register")
-def register_device():
-	auth = request.headers.get("Authorization", "")
-	token = auth[7:].strip() if auth.startswith("Bearer ") else ""
-	if not _auth_ok(token):
+@app.post("/api/telemetry/bulk")
+def telemetry_ingest_bulk():
+	"""批量上报（设备断网积压的补发）。
+
+	- Body：NDJSON（每行一条）或 JSON 数组，每条字段同 POST /api/telemetry；可用 Content-Encoding: gzip/deflate 压缩
+	- 整批在一个事务内写入，按 (device_id, boot_id, seq) 去重（重复补发不会重复落库）
+	- 返回 ack_upto：已接受（含重复）的最大 seq，设备可删除 <= 该 seq 的积压；devices 为按设备的最大 seq
+	- 认证：共享 key，或设备 key（此时批内所有记录都必须属于该设备）
+	"""
+	token = _request_token()
+	# 先鉴权再读 body：不认识的 token 不解压、不解析
+	if not _auth.known(token):
+		return jsonify({"ok": False, "error": "unauthorized"}), 401
+	shared_ok = _auth_ok(token)
+	if not _db_enabled():
+		return jsonify({"ok": False, "error": "sqlite_disabled"}), 503
+	if (request.content_length or 0) > _TELEMETRY_BULK_MAX_BYTES:
+		return jsonify({"ok": False, "error": "payload_too_large"}), 413
+
+	try:
+		data = _decompress_body(_read_body(_TELEMETRY_BULK_MAX_BYTES), request.headers.get("Content-Encoding", ""), _TELEMETRY_BULK_MAX_BYTES)
+		items, rejected = _parse_bulk_body(data)
+	except ValueError as exc:
+		code = 413 if str(exc) == "payload_too_large" else 400
+		return jsonify({"ok": False, "error": str(exc)}), code
+	if len(items) > _TELEMETRY_BULK_MAX:
+		return jsonify({"ok": False, "error": "too_many_records", "max": _TELEMETRY_BULK_MAX}), 413
+
+	now = _now_ts()
+	records = []
+	for item in items:
+		record = _bulk_record(item, now)
+		if record is None:
+			rejected += 1
+		else:
+			records.append(record)
+
+	device_ids = {r["device_id"] for r in records}
+	if not shared_ok and (not device_ids or not all(_auth_ok(token, d) for d in device_ids)):
 		return jsonify({"ok": False, "error": "unauthorized"}), 401
 
+	try:
+		inserted = db.insert_telemetry_batch(records)
+	except sqlite3.OperationalError:
+		# 库被占用（database is locked 等）：整批都没写入，让设备保留积压稍后重发
+		return _busy_response()
+	except Exception as exc:
+		return jsonify({"ok": False, "error": str(exc)}), 500
+
+	acked: Dict[str, int] = {}
+	live: Dict[str, dict[str, Any]] = {}
+	for r in records:
+		seq = r["seq"]
+		if seq is not None and seq > acked.get(r["device_id"], seq - 1):
+			acked[r["device_id"]] = seq
+		if not r["is_buffered"]:
+			live[r["device_id"]] = r
+	# 设备在线状态照常更新；积压数据不覆盖 dashboard 上的最新值，只有非补发记录才作为最新 telemetry
+	for device_id in device_ids:
+		event: Dict[str, Any] = {"device_id": device_id, "patch": {"status": "online", "last_seen": now}}
+		if device_id in live:
+			event["telemetry"] = live[device_id]
+		else:
+			event["status"] = True
+		_emit(event)
+
+	return jsonify(
+		{
+			"ok": True,
+			"accepted": len(records),
+			"inserted": inserted,
+			"duplicates": len(records) - inserted,
+			"rejected": rejected,
+			"ack_upto": max(acked.values()) if acked else None,
+			"devices": acked,
+			"server_ts": now,
+		}
+	)
+
+
+@app.post("/api/devices/register")
+def register_device():
 	body = request.get_json(silent=True) or {}
 	device_id = (body.get("device_id") or "").strip()
+	# 设备 key 只对 body 里的 device_id 有效
+	if not _auth_ok(_request_token(), device_id or None):
+		return jsonify({"ok": False, "error": "unauthorized"}), 401
 	if not device_id:
 		return jsonify({"ok": False, "error": "device_id_required"}), 400
 
@@ -279,12 +1068,12 @@ def register_device():
 	if not isinstance(capabilities, dict):
 		capabilities = {}
 
-	with _lock:
-		state = _devices.get(device_id) or DeviceState(device_id=device_id)
-		state.firmware_version = firmware_version or state.firmware_version
-		state.capabilities = capabilities or state.capabilities
-		state.last_seen = _now_ts()
-		_devices[device_id] = state
+	patch: Dict[str, Any] = {"last_seen": _now_ts()}
+	if firmware_version:
+		patch["firmware_version"] = firmware_version
+	if capabilities:
+		patch["capabilities"] = capabilities
+	_emit({"device_id": device_id, "patch": patch})
 
 	return jsonify({"ok": True})
 
@@ -296,9 +1085,7 @@ def send_command():
 	Header：Authorization: Bearer <api_key>
 	Body：{ device_id, command: { type: 'set_threshold'|'set_sample_interval', ... } }
 	"""
-	auth = request.headers.get("Authorization", "")
-	token = auth[7:].strip() if auth.startswith("Bearer ") else ""
-	if not _auth_ok(token):
+	if not _auth_ok(_request_token()):
 		return jsonify({"ok": False, "error": "unauthorized"}), 401
 
 	body = request.get_json(silent=True) or {}
@@ -312,33 +1099,44 @@ def send_command():
 	if not cmd_type:
 		return jsonify({"ok": False, "error": "command_type_required"}), 400
 
-	with _lock:
+	with _ws_lock:
 		ws = _device_ws.get(device_id)
-		state = _devices.get(device_id)
-		status = state.status if state else "offline"
+	state = _registry.get(device_id)
+	status = state.status if state else "offline"
 
-	if not ws or _effective_status(status, state.last_seen if state else None) != "online":
+	# 多进程模式下设备连接可能在其他 worker 上，交给 broker 路由
+	if (not ws and _cluster is None) or status != "online":
 		return jsonify({"ok": False, "error": "device_offline"}), 409
 
 	cmd_id = _next_cmd_id()
 	payload = {"type": "command", "cmd_id": cmd_id, "command": command}
+	text = serialization.dumps(payload)
 
-	try:
-		ws.send(json.dumps(payload, separators=(",", ":"), ensure_ascii=False))
-	except Exception:
-		with _lock:
-			_device_ws.pop(device_id, None)
-		return jsonify({"ok": False, "error": "send_failed"}), 500
-
-	with _lock:
-		_pending_cmd[cmd_id] = {"cmd_id": cmd_id, "device_id": device_id, "command": command, "ts": _now_ts()}
-
-	_broadcast_command_status(
+	if ws:
+		try:
+			ws.send(text)
+		except Exception:
+			with _ws_lock:
+				_device_ws.pop(device_id, None)
+			return jsonify({"ok": False, "error": "send_failed"}), 500
+	else:
+		error = _cluster.route_command(device_id, text)  # type: ignore[union-attr]
+		if error == "device_offline":
+			return jsonify({"ok": False, "error": "device_offline"}), 409
+		if error:
+			return jsonify({"ok": False, "error": "send_failed"}), 500
+
+	_emit(
 		{
-			"type": "command_sent",
-			"device_id": device_id,
-			"cmd_id": cmd_id,
-			"command": command,
+			"pending": {"cmd_id": cmd_id, "device_id": device_id, "command": command, "ts": _now_ts()},
+			"message": _command_message(
+				{
+					"type": "command_sent",
+					"device_id": device_id,
+					"cmd_id": cmd_id,
+					"command": command,
+				}
+			),
 		}
 	)
 	return jsonify({"ok": True, "cmd_id": cmd_id})
@@ -351,9 +1149,7 @@ def get_command_status():
 	Header：Authorization: Bearer <api_key>
 	Query：cmd_id
 	"""
-	auth = request.headers.get("Authorization", "")
-	token = auth[7:].strip() if auth.startswith("Bearer ") else ""
-	if not _auth_ok(token):
+	if not _auth_ok(_request_token()):
 		return jsonify({"ok": False, "error": "unauthorized"}), 401
 
 	cmd_id = (request.args.get("cmd_id") or "").strip()
@@ -362,7 +1158,7 @@ def get_command_status():
 
 	_cleanup_cmd_maps()
 
-	with _lock:
+	with _cmd_lock:
 		if cmd_id in _cmd_results:
 			rec = dict(_cmd_results[cmd_id])
 			return jsonify({"ok": True, "status": "acked", **rec})
@@ -372,201 +1168,357 @@ def get_command_status():
 	return jsonify({"ok": True, "status": "unknown", "cmd_id": cmd_id})
 
 
-@sock.route("/ws/dashboard")
-def ws_dashboard(ws):
-	_dashboard_clients.add(ws)
+def _dashboard_open(client: Any, epoch: Any = None, since_version: Any = None) -> None:
+	"""dashboard 连接建立：推一份设备快照（便于首屏）。
 
-	# 连接即推一份设备快照（便于首屏）
+	重连时客户端带上 epoch/since_version，只补发这之后变化过的设备（snapshot_delta）。
+	"""
 	try:
-		with _lock:
-			snapshot = {
-				"type": "snapshot",
-				"devices": [_device_to_dict(d) for d in _devices.values()],
-				"latest": list(_latest_telemetry.values()),
-			}
-		ws.send(json.dumps(snapshot, separators=(",", ":"), ensure_ascii=False))
+		since = _resume_version(epoch, since_version)
+		snapshot = _dashboard_snapshot(since_version=since)
+		client.enqueue(serialization.dumps(snapshot))
 	except Exception:
 		pass
 
+
+def _dashboard_on_message(client: Any, raw: Any) -> None:
+	"""处理 dashboard 发来的一条消息（subscribe/ping），回复都经 client 的发送队列。
+
+	与传输无关：flask-sock 线程与 asyncio 入口（server/asgi.py）共用。
+	"""
+	try:
+		data = serialization.loads(raw)
+	except Exception:
+		return
+	if not isinstance(data, dict):
+		return
+	msg_type = data.get("type")
+
+	if msg_type == "ping":
+		client.enqueue(serialization.dumps({"type": "pong", "server_ts": _now_ts()}))
+		return
+
+	if msg_type == "subscribe":
+		# 订阅整体替换：{"type":"subscribe","device_ids":[...],"metrics":[...],"types":[...]}
+		# 字段缺省/为 null 表示不过滤；回 subscribed 确认。
+		# 连接建立时已推过一份全量（或增量）快照，任何订阅都是它的子集，所以只在客户端
+		# 明确要求（"snapshot": true）时才补发按订阅过滤的快照（带 epoch/since_version 时为增量快照）
+		try:
+			sub = parse_subscription(data)
+		except ValueError as exc:
+			client.enqueue(serialization.dumps({"type": "error", "error": str(exc)}))
+			return
+		_dashboard_hub.subscribe(client, sub)
+		client.enqueue(serialization.dumps({"type": "subscribed", "subscription": sub.to_dict()}))
+		if data.get("snapshot") is True and sub.wants("snapshot"):
+			since = _resume_version(data.get("epoch"), data.get("since_version"))
+			snapshot = _dashboard_snapshot(sub, since_version=since)
+			client.enqueue(serialization.dumps(snapshot))
+		return
+
+	# 其他消息：忽略
+
+
+@sock.route("/ws/dashboard")
+def ws_dashboard(ws):
+	# 该 ws 的所有 send 都由 hub 的写线程完成，本线程只负责读
+	client = _dashboard_hub.add(ws.send, close=ws.close)
+	_dashboard_open(client, request.args.get("epoch"), request.args.get("since_version"))
+
 	# 阻塞读取，直到断开
 	try:
 		while True:
 			msg = ws.receive()
 			if msg is None:
 				break
-			# MVP：只接受 subscribe/ping，其他忽略
-			# 这里不做严格校验，避免前端联调卡住
+			_dashboard_on_message(client, msg)
 	finally:
-		_dashboard_clients.discard(ws)
+		_dashboard_hub.remove(client)
 
 
-@sock.route("/ws/telemetry")
-def ws_telemetry(ws):
-	device_id: Optional[str] = None
-	authed = False
+class TelemetrySession:
+	"""/ws/telemetry 单个连接的协议状态机（hello / cmd_ack / telemetry）。
 
-	try:
-		while True:
-			raw = ws.receive()
-			if raw is None:
-				break
+	与传输无关：handle() 返回需要回给设备的消息，由调用方发送；
+	sender 需提供线程安全的 send(text)，会登记到 _device_ws 供命令下发使用。
+	hello 协商 protocol >= 2 后，telemetry / telemetry_batch 也可以是二进制帧（见 codec.py），
+	解码后与 JSON 消息走同一套处理。
+	"""
 
+	def __init__(self, sender: Any):
+		self.sender = sender
+		self.device_id: Optional[str] = None
+		self.authed = False
+		self.protocol = 1
+
+	def handle(self, raw: Any) -> list[str]:
+		if codec.is_frame(raw):
+			if self.protocol < 2:
+				return [serialization.dumps({"type": "error", "error": "binary_not_negotiated"})]
+			try:
+				data = codec.decode(raw)
+			except ValueError as exc:
+				return [serialization.dumps({"type": "error", "error": str(exc)})]
+		else:
 			try:
-				data = json.loads(raw)
+				data = serialization.loads(raw)
 			except Exception:
+				return []
+		if not isinstance(data, dict):
+			return []
+
+		msg_type = data.get("type")
+		if msg_type == "hello":
+			return self._on_hello(data)
+		if msg_type == "telemetry_batch":
+			return self._on_telemetry_batch(data)
+		if msg_type == "cmd_ack":
+			self._on_cmd_ack(data)
+			return []
+		if msg_type == "telemetry":
+			return self._on_telemetry(data)
+		# 其他消息：忽略
+		return []
+
+	def close(self) -> None:
+		device_id = self.device_id
+		if not device_id:
+			return
+		with _ws_lock:
+			# 同一设备已经用新连接重连时，不要把新连接注销/置为离线
+			owned = _device_ws.get(device_id) is self.sender
+			if owned:
+				_device_ws.pop(device_id, None)
+		if owned:
+			# if_owner：设备已在其他 worker 重连时 broker 会忽略这条 offline
+			_emit({"device_id": device_id, "patch": {"status": "offline"}, "status": True, "own": False, "if_owner": True})
+
+	def _on_hello(self, data: dict[str, Any]) -> list[str]:
+		device_id = (data.get("device_id") or "").strip() or None
+		api_key = (data.get("api_key") or "").strip() or None
+		if not device_id:
+			return [serialization.dumps({"type": "error", "error": "device_id_required"})]
+		# 一个连接只对应一个设备：已认证后不允许换 device_id 重新 hello
+		if self.authed and device_id != self.device_id:
+			return [serialization.dumps({"type": "error", "error": "device_id_mismatch"})]
+		# 先用局部变量校验，认证失败不改动会话状态
+		if not _auth_ok(api_key, device_id):
+			return [serialization.dumps({"type": "error", "error": "unauthorized"})]
+		self.device_id = device_id
+
+		firmware_version = (data.get("firmware_version") or "").strip() or None
+		capabilities = data.get("capabilities") or {}
+		if not isinstance(capabilities, dict):
+			capabilities = {}
+
+		with _ws_lock:
+			_device_ws[device_id] = self.sender
+
+		patch: Dict[str, Any] = {"status": "online", "last_seen": _now_ts()}
+		if firmware_version:
+			patch["firmware_version"] = firmware_version
+		if capabilities:
+			patch["capabilities"] = capabilities
+		# own：登记本进程持有该设备连接（多进程模式下命令按此路由）
+		_emit({"device_id": device_id, "patch": patch, "status": True, "own": True})
+		self.authed = True
+		protocol = data.get("protocol")
+		if isinstance(protocol, int) and not isinstance(protocol, bool):
+			self.protocol = max(1, min(protocol, codec.PROTOCOL))
+		return [serialization.dumps({"type": "hello_ok", "ts": _now_ts(), "protocol": self.protocol})]
+
+	def _on_cmd_ack(self, data: dict[str, Any]) -> None:
+		device_id = self.device_id
+		if (not self.authed) or (not device_id):
+			return
+		cmd_id = (data.get("cmd_id") or "").strip()
+		ok = bool(data.get("ok", False))
+		result = data.get("result")
+		err = data.get("error")
+		if not cmd_id:
+			return
+
+		with _cmd_lock:
+			pending = _pending_cmd.get(cmd_id)
+		command = pending.get("command") if isinstance(pending, dict) else None
+		event: Dict[str, Any] = {
+			"device_id": device_id,
+			# 记录结果，供轮询查询（同时消费掉 pending）
+			"result": {
+				"cmd_id": cmd_id,
+				"device_id": device_id,
+				"ok": ok,
+				"result": result,
+				"error": err,
+				"command": command,
+				"ts": _now_ts(),
+			},
+			"message": _command_message(
+				{
+					"type": "command_ack",
+					"device_id": device_id,
+					"cmd_id": cmd_id,
+					"ok": ok,
+					"error": err,
+					"result": result,
+					"command": command,
+				}
+			),
+		}
+		# 根据下发命令更新“最后已知配置”（MVP：仅记录阈值/采样间隔）
+		if pending and ok:
+			cmd = command or {}
+			t = (cmd.get("type") or "").strip()
+			cfg: Dict[str, Any] = {}
+			if t == "set_threshold":
+				cfg["temp_high"] = cmd.get("temp_high")
+				cfg["temp_low"] = cmd.get("temp_low")
+			if t == "set_sample_interval":
+				cfg["sample_interval_sec"] = cmd.get("sample_interval_sec")
+			event["config"] = cfg
+		_emit(event)
+
+	def _on_telemetry(self, data: dict[str, Any]) -> list[str]:
+		device_id = self.device_id
+		# 必须先 hello 认证，避免匿名写入
+		if (not self.authed) or (not device_id):
+			return []
+
+		record = _telemetry_record(device_id, data, data.get("timestamp"), bool(data.get("is_buffered", False)))
+		seq = record["seq"]
+
+		_emit({"device_id": device_id, "patch": {"status": "online", "last_seen": _now_ts()}, "telemetry": record})
+		if not _store_telemetry(record):
+			# 没有入队：不回 ack，设备保留这条稍后重发
+			return [serialization.dumps({"type": "error", "error": "busy", "seq": seq, "retry_after": _BUSY_RETRY_AFTER_SEC})]
+
+		# ACK：只要带 seq 就回（已交给写线程）
+		if seq is not None:
+			return [serialization.dumps({"type": "ack", "seq": seq, "server_ts": _now_ts()})]
+		return []
+
+	def _on_telemetry_batch(self, data: dict[str, Any]) -> list[str]:
+		"""一帧多条样本：{"type":"telemetry_batch","ts_base"?,"is_buffered"?,"samples":[{seq,timestamp|dt,environment},...]}
+
+		样本的 timestamp 缺省时取 ts_base + dt，boot_id 缺省时取帧上的 boot_id；设备字段以 hello 为准（与单条 telemetry 一致）。
+		全部落库，但只有最后一条作为最新 telemetry 推给 dashboard；整帧只回一条累计 ack：
+		{"type":"ack","ack_upto":<已入队部分的最大 seq>,"count":<入队条数>,"rejected":<格式错误、被丢弃的样本数>}。
+		写队列满时按帧内顺序入队到第一条失败为止，其余样本不入队，另回
+		{"type":"error","error":"busy","retry_from":<第一条未入队样本的 seq>}，设备从该条起重发。
+		"""
+		device_id = self.device_id
+		if (not self.authed) or (not device_id):
+			return []
+
+		samples = data.get("samples")
+		if not isinstance(samples, list) or not samples:
+			return []
+		if len(samples) > _TELEMETRY_BATCH_MAX:
+			return [serialization.dumps({"type": "error", "error": "telemetry_batch_too_large", "max": _TELEMETRY_BATCH_MAX})]
+
+		ts_base = data.get("ts_base")
+		if not isinstance(ts_base, (int, float)) or isinstance(ts_base, bool):
+			ts_base = None
+		buffered = bool(data.get("is_buffered", False))
+		boot_id = data.get("boot_id")
+		records = []
+		rejected = 0
+		for sample in samples:
+			if not isinstance(sample, dict):
+				rejected += 1
 				continue
-
-			msg_type = data.get("type")
-			if msg_type == "hello":
-				device_id = (data.get("device_id") or "").strip() or None
-				api_key = (data.get("api_key") or "").strip() or None
-				if not device_id:
-					ws.send(json.dumps({"type": "error", "error": "device_id_required"}))
-					continue
-				if not _auth_ok(api_key):
-					ws.send(json.dumps({"type": "error", "error": "unauthorized"}))
-					continue
-
-				firmware_version = (data.get("firmware_version") or "").strip() or None
-				capabilities = data.get("capabilities") or {}
-				if not isinstance(capabilities, dict):
-					capabilities = {}
-
-				with _lock:
-					state = _devices.get(device_id) or DeviceState(device_id=device_id)
-					state.firmware_version = firmware_version or state.firmware_version
-					state.capabilities = capabilities or state.capabilities
-					state.status = "online"
-					state.last_seen = _now_ts()
-					_devices[device_id] = state
-					_device_ws[device_id] = ws
-
-				_set_device_status(device_id, "online")
-				authed = True
-				ws.send(json.dumps({"type": "hello_ok", "ts": _now_ts()}))
-				continue
-
-			if msg_type == "cmd_ack":
-				if (not authed) or (not device_id):
-					continue
-				cmd_id = (data.get("cmd_id") or "").strip()
-				ok = bool(data.get("ok", False))
-				result = data.get("result")
-				err = data.get("error")
-				if not cmd_id:
-					continue
-
-				pending = None
-				with _lock:
-					pending = _pending_cmd.get(cmd_id)
-					# 记录结果，供轮询查询
-					_cmd_results[cmd_id] = {
-						"cmd_id": cmd_id,
-						"device_id": device_id,
-						"ok": ok,
-						"result": result,
-						"error": err,
-						"command": pending.get("command") if isinstance(pending, dict) else None,
-						"ts": _now_ts(),
-					}
-					# pending 消费掉，避免增长
-					_pending_cmd.pop(cmd_id, None)
-					# 根据下发命令更新“最后已知配置”（MVP：仅记录阈值/采样间隔）
-					if pending and ok:
-						cmd = pending.get("command") or {}
-						t = (cmd.get("type") or "").strip()
-						state = _devices.get(device_id) or DeviceState(device_id=device_id)
-						cfg = state.capabilities.get("config") if isinstance(state.capabilities, dict) else None
-						if not isinstance(cfg, dict):
-							cfg = {}
-						if t == "set_threshold":
-							cfg["temp_high"] = cmd.get("temp_high")
-							cfg["temp_low"] = cmd.get("temp_low")
-						if t == "set_sample_interval":
-							cfg["sample_interval_sec"] = cmd.get("sample_interval_sec")
-						state.capabilities["config"] = cfg
-						_devices[device_id] = state
-
-				_broadcast_command_status(
+			ts = sample.get("timestamp")
+			dt = sample.get("dt")
+			if ts is None and ts_base is not None and isinstance(dt, (int, float)):
+				ts = ts_base + dt
+			records.append(_telemetry_record(device_id, sample, ts, bool(sample.get("is_buffered", buffered)), boot_id))
+		if not records:
+			return [serialization.dumps({"type": "error", "error": "invalid_samples", "rejected": rejected})]
+
+		_emit({"device_id": device_id, "patch": {"status": "online", "last_seen": _now_ts()}, "telemetry": records[-1]})
+		# ack_upto 是累计确认：只能覆盖帧内连续入队的前缀，第一条入队失败后的样本一律不确认
+		stored = 0
+		for record in records:
+			if not _store_telemetry(record):
+				break
+			stored += 1
+		accepted = records[:stored]
+
+		replies = []
+		seqs = [r["seq"] for r in accepted if isinstance(r["seq"], int) and not isinstance(r["seq"], bool)]
+		if seqs or rejected:
+			ack: Dict[str, Any] = {"type": "ack", "ack_upto": max(seqs) if seqs else None, "count": stored}
+			if rejected:
+				ack["rejected"] = rejected
+			ack["server_ts"] = _now_ts()
+			replies.append(serialization.dumps(ack))
+		if stored < len(records):
+			replies.append(
+				serialization.dumps(
 					{
-						"type": "command_ack",
-						"device_id": device_id,
-						"cmd_id": cmd_id,
-						"ok": ok,
-						"error": err,
-						"result": result,
-						"command": pending.get("command") if isinstance(pending, dict) else None,
+						"type": "error",
+						"error": "busy",
+						"retry_from": records[stored]["seq"],
+						"count": len(records) - stored,
+						"retry_after": _BUSY_RETRY_AFTER_SEC,
 					}
 				)
-				continue
+			)
+		return replies
 
-			if msg_type == "telemetry":
-				# 必须先 hello 认证，避免匿名写入
-				if (not authed) or (not device_id):
-					continue
 
-				seq = data.get("seq")
-				ts = data.get("timestamp")
-				env = data.get("environment")
-
-				if not isinstance(env, dict):
-					env = {}
-
-				record = {
-					"type": "telemetry",
-					"device_id": device_id,
-					"seq": seq,
-					"timestamp": ts,
-					"environment": env,
-					"is_buffered": bool(data.get("is_buffered", False)),
-					"server_ts": _now_ts(),
-				}
-
-				with _lock:
-					_latest_telemetry[device_id] = record
-					state = _devices.get(device_id) or DeviceState(device_id=device_id)
-					state.status = "online"
-					state.last_seen = _now_ts()
-					_devices[device_id] = state
-
-				_broadcast_dashboard(record)
-
-				if _db_enabled():
-					try:
-						db.insert_telemetry(record)
-					except Exception:
-						pass
-
-				# ACK：只要带 seq 就回
-				if seq is not None:
-					ws.send(json.dumps({"type": "ack", "seq": seq, "server_ts": _now_ts()}))
-				continue
+def _telemetry_record(
+	device_id: str, data: dict[str, Any], ts: Any, is_buffered: bool, boot_id: Any = None
+) -> dict[str, Any]:
+	env = data.get("environment")
+	if not isinstance(env, dict):
+		env = {}
+	return {
+		"type": "telemetry",
+		"device_id": device_id,
+		"seq": data.get("seq"),
+		"boot_id": data.get("boot_id", boot_id),
+		"timestamp": ts,
+		"environment": env,
+		"is_buffered": is_buffered,
+		"server_ts": _now_ts(),
+	}
 
-			# 其他消息：忽略
 
+@sock.route("/ws/telemetry")
+def ws_telemetry(ws):
+	session = TelemetrySession(ws)
+	try:
+		while True:
+			raw = ws.receive()
+			if raw is None:
+				break
+			for reply in session.handle(raw):
+				ws.send(reply)
 	finally:
-		if device_id:
-			with _lock:
-				_device_ws.pop(device_id, None)
-			_set_device_status(device_id, "offline")
+		session.close()
 
 
 def create_app() -> Flask:
-	if _db_enabled():
-		try:
-			db.init_db()
-		except Exception:
-			pass
+	_init_storage()
+	_start_cluster()
 	return app
 
 
-def main() -> None:
-	if _db_enabled():
-		try:
-			db.init_db()
-		except Exception:
-			pass
+def enable_cors() -> None:
 	CORS(app, resources={r"/*": {"origins": config.CORS_ORIGINS}})
+
+
+def main() -> None:
+	_init_storage()
+	_start_cluster()
+	enable_cors()
+	_install_reload_signal()
+	fd = _cfg_int("LISTEN_FD", -1)
+	if fd >= 0:
+		# server.cluster 启动的 worker：直接在父进程创建的监听 socket 上 accept
+		make_server(config.HOST, config.PORT, app, threaded=True, fd=fd).serve_forever()
+		return
 	app.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
 
 
@@ -0,0 +1,341 @@
+"""ASGI（asyncio）入口：与 server/app.py 相同的 /ws/telemetry、/ws/dashboard 与 REST 接口。
+
+- 两个 WebSocket 端点直接跑在事件循环里：每个连接是一个协程（外加一个发送 task），
+  不再是一个阻塞线程；上千个空闲设备连接只占内存，不占线程
+- REST 仍由 Flask 处理：请求在一个小线程池里按 WSGI 调用（SQLite 查询也在这个池里），
+  流式响应（export）逐块回送
+- 协议处理（hello/cmd_ack/telemetry、subscribe/ping）与 app.py 共用同一份代码与内存状态
+
+运行（需要额外安装 ASGI server，例如 uvicorn）：
+    pip install uvicorn
+    python -m server.asgi
+    # 或：uvicorn server.asgi:app --host 0.0.0.0 --port 5000
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+try:
+    from . import app as core  # type: ignore
+    from . import config  # type: ignore
+    from .fanout import AsyncDashboardClient  # type: ignore
+except Exception:
+    # 兼容直接运行：在 server 目录下 python asgi.py
+    import app as core  # type: ignore
+    import config  # type: ignore
+    from fanout import AsyncDashboardClient  # type: ignore
+
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+def _ws_text(message: Dict[str, Any]) -> Optional[str]:
+    text = message.get("text")
+    if text is None and message.get("bytes") is not None:
+        text = message["bytes"].decode("utf-8", "replace")
+    return text
+
+
+def _ws_data(message: Dict[str, Any]) -> Optional[Any]:
+    """设备上行：文本帧返回 str，二进制帧原样返回 bytes（可能是紧凑编码的 telemetry）。"""
+    text = message.get("text")
+    return text if text is not None else message.get("bytes")
+
+
+class _WsSender:
+    """设备连接的发送端：send(text) 可在任意线程调用（REST 线程池里的命令下发），
+    只负责投递到事件循环，由单个 task 按顺序发出。"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, send: Send):
+        self._loop = loop
+        self._send = send
+        self._queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+        self._closed = False
+        self._task = loop.create_task(self._run())
+
+    def send(self, text: str) -> None:
+        if self._closed:
+            raise ConnectionError("websocket closed")
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, text)
+
+    async def _run(self) -> None:
+        while True:
+            text = await self._queue.get()
+            if text is None:
+                return
+            try:
+                await self._send({"type": "websocket.send", "text": text})
+            except Exception:
+                self._closed = True
+                return
+
+    async def aclose(self) -> None:
+        self._closed = True
+        self._queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(self._task, 1.0)
+        except Exception:
+            self._task.cancel()
+
+
+class AsgiApp:
+    def __init__(self, wsgi_app: Any, http_threads: int = 8):
+        self.wsgi_app = wsgi_app
+        self.http_threads = max(1, int(http_threads))
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.http_threads, thread_name_prefix="sls-asgi-http")
+        return self._executor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        kind = scope["type"]
+        if kind == "lifespan":
+            await self._lifespan(receive, send)
+        elif kind == "http":
+            await self._http(scope, receive, send)
+        elif kind == "websocket":
+            path = scope.get("path") or ""
+            if path == "/ws/telemetry":
+                await self._ws_telemetry(scope, receive, send)
+            elif path == "/ws/dashboard":
+                await self._ws_dashboard(scope, receive, send)
+            else:
+                await receive()
+                await send({"type": "websocket.close", "code": 4404})
+
+    # ---- lifespan ----
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # init_db 可能做迁移，放到线程池里执行，不阻塞事件循环
+                await loop.run_in_executor(self.executor, core._init_storage)
+                if core._store_blocks():
+                    # _init_storage 出错时写线程可能没起来：单独再启动一次（落库不能在事件循环里同步 commit）
+                    await loop.run_in_executor(self.executor, core._start_db_writer)
+                await loop.run_in_executor(self.executor, core._start_cluster)
+                core.enable_cors()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # 各 dashboard 的发送 task 退出时发 websocket.close；等它们发完再继续关闭
+                clients = [c for c in core._dashboard_hub.clients() if isinstance(c, AsyncDashboardClient)]
+                core._dashboard_hub.close_all()
+                await asyncio.gather(*(c.wait_closed() for c in clients))
+                await loop.run_in_executor(self.executor, core._shutdown_storage)
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---- WebSocket ----
+
+    async def _accept(self, receive: Receive, send: Send) -> bool:
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return False
+        await send({"type": "websocket.accept"})
+        return True
+
+    async def _ws_telemetry(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not await self._accept(receive, send):
+            return
+        loop = asyncio.get_running_loop()
+        sender = _WsSender(loop, send)
+        session = core.TelemetrySession(sender)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                data = _ws_data(message)
+                if data is None:
+                    continue
+                if core._store_blocks():
+                    # 写线程不在运行（启动失败/正在关闭）：落库会同步 commit，放到线程池里，不阻塞其他连接
+                    replies = await loop.run_in_executor(self.executor, session.handle, data)
+                else:
+                    replies = session.handle(data)
+                for reply in replies:
+                    sender.send(reply)
+        finally:
+            session.close()
+            await sender.aclose()
+
+    async def _ws_dashboard(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not await self._accept(receive, send):
+            return
+
+        async def send_text(text: str) -> None:
+            await send({"type": "websocket.send", "text": text})
+
+        async def close() -> None:
+            await send({"type": "websocket.close"})
+
+        client = core._dashboard_hub.add_async(send_text, asyncio.get_running_loop(), close=close)
+        qs = parse_qs((scope.get("query_string") or b"").decode("latin-1"))
+        core._dashboard_open(client, (qs.get("epoch") or [None])[0], (qs.get("since_version") or [None])[0])
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                text = _ws_text(message)
+                if text is not None:
+                    core._dashboard_on_message(client, text)
+        finally:
+            core._dashboard_hub.remove(client)
+
+    # ---- HTTP（转给 Flask，WSGI 调用在线程池里执行）----
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # 请求体整体缓存后再交给 Flask：与 Flask 的 MAX_CONTENT_LENGTH 同一上限，超过直接 413
+        limit = core.app.config.get("MAX_CONTENT_LENGTH")
+        declared = _content_length(scope)
+        if limit is not None and declared is not None and declared > limit:
+            await _reply_too_large(send)
+            return
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if limit is not None and size > limit:
+                await _reply_too_large(send)
+                return
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+        environ = _build_environ(scope, b"".join(chunks))
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run_wsgi, environ, send, loop)
+
+    def _run_wsgi(self, environ: Dict[str, Any], send: Send, loop: asyncio.AbstractEventLoop) -> None:
+        """在线程池里执行 WSGI 应用，把响应头与每个 body 块同步地交给事件循环发送（天然背压）。"""
+
+        def emit(message: Dict[str, Any]) -> None:
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        started: List[Tuple[str, List[Tuple[str, str]]]] = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> Callable[[bytes], None]:
+            started[:] = [(status, headers)]
+            return lambda data: None
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            head_sent = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not head_sent:
+                    emit(_response_start(*started[0]))
+                    head_sent = True
+                emit({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not head_sent:
+                emit(_response_start(*started[0]))
+            emit({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            close = getattr(result, "close", None)
+            if close:
+                close()
+
+
+def _content_length(scope: Scope) -> Optional[int]:
+    for name, value in scope.get("headers") or []:
+        if name.lower() == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def _reply_too_large(send: Send) -> None:
+    body = core.serialization.dumps_bytes({"ok": False, "error": "payload_too_large"})
+    await send(_response_start("413 Request Entity Too Large", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))]))
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+def _response_start(status: str, headers: List[Tuple[str, str]]) -> Dict[str, Any]:
+    return {
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    }
+
+
+def _build_environ(scope: Scope, body: bytes) -> Dict[str, Any]:
+    """ASGI HTTP scope -> WSGI environ（PEP 3333）。"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    path = scope.get("path") or "/"
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": scope.get("method", "GET"),
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": (scope.get("query_string") or b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]) if server[1] is not None else "80",
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for raw_name, raw_value in scope.get("headers") or []:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name in ("CONTENT_LENGTH", "TRANSFER_ENCODING"):
+            # body 已整体收齐（chunked 也已解开），长度以 CONTENT_LENGTH 为准
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+app = AsgiApp(core.app, http_threads=core._cfg_int("ASGI_HTTP_THREADS", 8))
+
+
+def main() -> None:
+    try:
+        import uvicorn  # type: ignore
+    except ImportError:
+        print("python -m server.asgi 需要 uvicorn：pip install uvicorn", file=sys.stderr)
+        raise SystemExit(1)
+    log_level = "debug" if config.DEBUG else "info"
+    core._install_reload_signal()
+    # permessage-deflate 由 uvicorn 的 WebSocket 实现协商（与 app.py 的 WS_DEFLATE 同一开关）
+    deflate = bool(getattr(config, "WS_DEFLATE", True))
+    fd = core._cfg_int("LISTEN_FD", -1)
+    if fd >= 0:
+        # server.cluster 启动的 worker：共用父进程的监听 socket
+        uvicorn.run(app, fd=fd, log_level=log_level, ws_per_message_deflate=deflate)
+        return
+    uvicorn.run(app, host=config.HOST, port=config.PORT, log_level=log_level, ws_per_message_deflate=deflate)
+
+
+if __name__ == "__main__":
+    main()
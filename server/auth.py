@@ -0,0 +1,108 @@
+"""API Key 鉴权：共享 key（SLS_API_KEYS）+ 按设备的 key（只保存哈希）。
+
+- 比较一律用 hmac.compare_digest（常量时间），不按字符串相等短路
+- 设备 key 文件里只存 sha256 摘要：{"esp32-01": "sha256:<hex>"}，可用 python -m server.auth hash <key> 生成
+- 不缓存校验结果：一次 sha256 加几次等长比较已经够便宜，缓存反而会在内存里留明文 token、
+  让命中路径绕过常量时间比较
+- 设备 key 只能用于该设备自己的上报/hello；命令等控制面接口只认共享 key
+"""
+
+from __future__ import annotations
+
+import hashlib
+import hmac
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from . import serialization  # type: ignore
+except Exception:
+    import serialization  # type: ignore
+
+HASH_PREFIX = "sha256:"
+
+
+def hash_key(key: str) -> str:
+    return HASH_PREFIX + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def bearer_token(header: Optional[str]) -> str:
+    """'Bearer <token>' -> token；格式不符返回空串。"""
+    if not header or not header.startswith("Bearer "):
+        return ""
+    return header[7:].strip()
+
+
+def load_device_keys(path: str) -> Dict[str, str]:
+    """读取设备 key 文件（JSON：device_id -> "sha256:<hex>"）；文件不存在或格式不对时返回空表。"""
+    if not path:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            data = serialization.loads(f.read())
+    except Exception:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    out: Dict[str, str] = {}
+    for device_id, digest in data.items():
+        digest = str(digest or "").strip().lower()
+        if digest.startswith(HASH_PREFIX):
+            digest = digest[len(HASH_PREFIX):]
+        if len(digest) == 64 and all(c in "0123456789abcdef" for c in digest):
+            out[str(device_id)] = digest
+    return out
+
+
+class ApiKeyAuth:
+    def __init__(self, api_keys: Iterable[str], device_keys: Optional[Dict[str, str]] = None):
+        # 共享 key 也只保留摘要：比较的是等长的 sha256，长度不泄露信息
+        self._shared: List[bytes] = [hashlib.sha256(k.encode("utf-8")).digest() for k in api_keys if k]
+        self._device: Dict[str, bytes] = {d: bytes.fromhex(h) for d, h in (device_keys or {}).items()}
+        self._device_digests = frozenset(self._device.values())
+
+    def check(self, token: Optional[str], device_id: Optional[str] = None) -> bool:
+        """token 是共享 key，或者（给出 device_id 时）是该设备自己的 key。"""
+        if not token:
+            return False
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        ok = False
+        # 不短路：无论命中与否都比较完所有共享 key
+        for shared in self._shared:
+            ok |= hmac.compare_digest(digest, shared)
+        if device_id is not None:
+            expected = self._device.get(device_id)
+            if expected is not None:
+                ok |= hmac.compare_digest(digest, expected)
+        return ok
+
+    def known(self, token: Optional[str]) -> bool:
+        """token 是共享 key 或任一设备的 key（读请求体之前的预检，具体设备仍要再 check）。"""
+        if not token:
+            return False
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        ok = digest in self._device_digests
+        for shared in self._shared:
+            ok |= hmac.compare_digest(digest, shared)
+        return ok
+
+    def stats(self) -> Dict[str, int]:
+        return {"shared_keys": len(self._shared), "device_keys": len(self._device)}
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    """运维入口：python -m server.auth hash <key>"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m server.auth", description="SLS API Key 工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_hash = sub.add_parser("hash", help="生成设备 key 文件里使用的摘要")
+    p_hash.add_argument("key")
+
+    args = parser.parse_args(argv)
+    if args.command == "hash":
+        print(hash_key(args.key))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -0,0 +1,613 @@
+"""多进程部署：本地 state broker + 多个 worker 进程共享设备状态。
+
+单进程时设备状态就是 app.py 里的几个 dict；多进程时每个 worker 仍保留一份完整副本
+（REST/快照读本地，不跨进程），所有状态变化以“事件”的形式发给 broker：
+
+- broker 串行化事件并分配全局版本号（所有 worker 的 version/epoch 一致，dashboard 增量同步照常可用），
+  再按同一顺序转发给所有 worker；每个 worker 应用到本地副本并推给自己的 dashboard 连接
+  （即 dashboard 广播跨 worker 扇出）
+- broker 记录 device_id -> 持有该设备 /ws/telemetry 连接的 worker；命令由任意 worker 收到后
+  经 broker 转给该 worker 下发（设备粘在自己连接的 worker 上，不需要负载均衡器做会话保持）
+- worker 断开时 broker 把它持有的设备置为 offline；新 worker 连上时先收到一份完整状态
+
+传输：multiprocessing.connection（Unix socket 或 127.0.0.1 TCP，authkey 鉴权），消息体为 JSON。
+每条连接的发送都走队列 + 写线程，读线程永远不会因为对端缓冲区满而阻塞（避免双向互等）。
+
+运行：
+    python -m server.cluster --workers 4          # 启动 broker + 4 个 worker，共享同一个监听端口
+    python -m server.cluster --workers 4 --asgi   # worker 用 asyncio 入口（需要 uvicorn）
+    python -m server.cluster broker               # 只运行 broker（自行启动 worker 时使用）
+"""
+
+from __future__ import annotations
+
+import os
+import queue
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+try:
+    from . import config  # type: ignore
+    from . import serialization  # type: ignore
+except Exception:
+    # 兼容直接运行：在 server 目录下 python cluster.py
+    import config  # type: ignore
+    import serialization  # type: ignore
+
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(addr: str) -> Address:
+    """'host:port' -> TCP；其他按 Unix socket 路径处理（Windows 盘符路径不会被误判为端口）。"""
+    host, sep, port = addr.rpartition(":")
+    if sep and host and port.isdigit():
+        return (host, int(port))
+    return addr
+
+
+def _encode(msg: Dict[str, Any]) -> bytes:
+    return serialization.dumps_bytes(msg)
+
+
+class _Peer:
+    """一条 broker 连接：recv() 在调用方线程阻塞读；send() 只入队，由写线程发出。"""
+
+    def __init__(self, conn: Connection, name: str):
+        self.conn = conn
+        self.closed = False
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, msg: Dict[str, Any]) -> None:
+        if self.closed:
+            raise ConnectionError("broker connection closed")
+        self.send_raw(_encode(msg))
+
+    def send_raw(self, data: bytes) -> None:
+        """发送已编码好的消息（广播给多个 peer 时只编码一次）。"""
+        if self.closed:
+            raise ConnectionError("broker connection closed")
+        self._queue.put(data)
+
+    def recv(self) -> Dict[str, Any]:
+        msg = serialization.loads(self.conn.recv_bytes())
+        if not isinstance(msg, dict):
+            raise ValueError("invalid_message")
+        return msg
+
+    def _run(self) -> None:
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            try:
+                self.conn.send_bytes(data)
+            except Exception:
+                self.closed = True
+                return
+
+    def close(self) -> None:
+        self.closed = True
+        self._queue.put(None)
+        try:
+            # 另一个线程可能正阻塞在 recv 上，单纯 close 不会让对端看到断开，先 shutdown
+            with socket.socket(fileno=os.dup(self.conn.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+def _new_device(device_id: str) -> Dict[str, Any]:
+    # 字段与 app.DeviceState 一致
+    return {"device_id": device_id, "status": "offline", "last_seen": None, "firmware_version": None, "capabilities": {}}
+
+
+class Broker:
+    """状态 broker：事件排序 + 版本号分配 + 设备归属 + 命令路由。
+
+    事件格式（字段都可选）：
+    - device_id / patch：设备字段覆盖（status、last_seen、firmware_version、capabilities）
+    - config：合并到 capabilities.config（命令 ack 后的“最后已知配置”）
+    - telemetry：最新一条 telemetry（同时推给 dashboard）
+    - status：应用后推一条 device_status
+    - message：原样推给 dashboard（命令事件）
+    - pending / result：命令状态（result 会消费同 cmd_id 的 pending）
+    - own：True 登记 / False 注销设备归属；if_owner：只有归属 worker 发来的事件才生效
+    - expect：条件更新，设备当前字段与之不符时整条事件丢弃
+    有设备字段变化的事件会被分配 version，转发给 worker 时带上。
+    """
+
+    def __init__(self, address: Address, authkey: bytes, cmd_ttl_sec: int = 600):
+        self.address = address
+        self.authkey = authkey
+        self.cmd_ttl_sec = cmd_ttl_sec
+        self.epoch = secrets.token_hex(6)
+        self.version = 0
+        self.devices: Dict[str, Dict[str, Any]] = {}
+        self.latest: Dict[str, Dict[str, Any]] = {}
+        self.versions: Dict[str, int] = {}
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.owners: Dict[str, str] = {}  # device_id -> worker_id
+        self.workers: Dict[str, _Peer] = {}
+        self._calls: Dict[int, Tuple[str, Any]] = {}  # 转发中的命令：broker rid -> (发起 worker, 原 rid)
+        self._call_seq = 0
+        self._lock = threading.Lock()
+        self._listener: Optional[Listener] = None
+        self._stopped = False
+        self.stats = {"events": 0, "commands_routed": 0, "workers_joined": 0, "workers_lost": 0}
+
+    def start(self) -> None:
+        self._listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept_loop, name="sls-broker-accept", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+        with self._lock:
+            peers = list(self.workers.values())
+        for peer in peers:
+            peer.close()
+
+    def _accept_loop(self) -> None:
+        while not self._stopped:
+            try:
+                conn = self._listener.accept()  # type: ignore[union-attr]
+            except OSError:
+                if self._stopped:
+                    return
+                continue
+            except Exception:
+                # authkey 不匹配等：丢弃这条连接
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name="sls-broker-peer", daemon=True).start()
+
+    def _serve(self, conn: Connection) -> None:
+        peer = _Peer(conn, "sls-broker-send")
+        worker_id = None
+        try:
+            hello = peer.recv()
+            worker_id = str(hello.get("worker_id") or "")
+            if hello.get("op") != "hello" or not worker_id:
+                return
+            with self._lock:
+                old = self.workers.get(worker_id)
+                self.workers[worker_id] = peer
+                self.stats["workers_joined"] += 1
+                # 在锁内发送完整状态：之后的事件一定排在它后面
+                peer.send(self._state())
+            if old is not None:
+                old.close()
+            while True:
+                self._handle(worker_id, peer.recv())
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            peer.close()
+            if worker_id:
+                self._drop(worker_id, peer)
+
+    def _handle(self, worker_id: str, msg: Dict[str, Any]) -> None:
+        op = msg.get("op")
+        if op == "event":
+            event = msg.get("event")
+            if isinstance(event, dict):
+                self.publish(worker_id, event)
+        elif op == "command":
+            self._route_command(worker_id, msg)
+        elif op == "delivered":
+            with self._lock:
+                call = self._calls.pop(int(msg.get("rid") or 0), None)
+                origin = self.workers.get(call[0]) if call else None
+            if origin is not None:
+                self._send(origin, {"op": "reply", "rid": call[1], "error": msg.get("error")})  # type: ignore[index]
+
+    def _route_command(self, worker_id: str, msg: Dict[str, Any]) -> None:
+        device_id = msg.get("device_id")
+        with self._lock:
+            origin = self.workers.get(worker_id)
+            owner = self.owners.get(device_id)  # type: ignore[arg-type]
+            target = self.workers.get(owner) if owner else None
+            if target is not None:
+                self._call_seq += 1
+                rid = self._call_seq
+                self._calls[rid] = (worker_id, msg.get("rid"))
+                self.stats["commands_routed"] += 1
+        if target is None:
+            if origin is not None:
+                self._send(origin, {"op": "reply", "rid": msg.get("rid"), "error": "device_offline"})
+            return
+        self._send(target, {"op": "deliver", "rid": rid, "device_id": device_id, "text": msg.get("text")})
+
+    def _send(self, peer: _Peer, msg: Dict[str, Any]) -> None:
+        try:
+            peer.send(msg)
+        except ConnectionError:
+            pass
+
+    def publish(self, worker_id: Optional[str], event: Dict[str, Any]) -> None:
+        with self._lock:
+            device_id = event.get("device_id")
+            if event.get("if_owner") and self.owners.get(device_id) != worker_id:  # type: ignore[arg-type]
+                return
+            own = event.get("own")
+            if own is True and device_id and worker_id:
+                prev = self.owners.get(device_id)
+                self.owners[device_id] = worker_id
+                if prev and prev != worker_id and prev in self.workers:
+                    # 设备换了 worker 重连：让旧 worker 注销它的连接映射，旧连接断开时不会再置 offline
+                    self._send(self.workers[prev], {"op": "evict", "device_id": device_id})
+            elif own is False and device_id:
+                self.owners.pop(device_id, None)
+            if not self._apply(event):
+                return
+            self.stats["events"] += 1
+            if self.stats["events"] % 256 == 0:
+                self._prune_cmds()
+            data = _encode({"op": "event", "event": event})
+            for peer in self.workers.values():
+                try:
+                    peer.send_raw(data)
+                except ConnectionError:
+                    pass
+
+    def _apply(self, event: Dict[str, Any]) -> bool:
+        device_id = event.get("device_id")
+        telemetry = event.get("telemetry")
+        expect = event.get("expect")
+        if expect is not None:
+            # 条件事件（离线到期）：设备在此期间有新上报，或其他 worker 已先置为 offline 时丢弃
+            dev = self.devices.get(device_id)  # type: ignore[arg-type]
+            if dev is None or any(dev.get(k) != v for k, v in expect.items()):
+                return False
+        if device_id and (event.get("patch") is not None or event.get("config") is not None or telemetry is not None):
+            dev = self.devices.get(device_id) or _new_device(device_id)
+            dev.update(event.get("patch") or {})
+            cfg = event.get("config")
+            if cfg is not None:
+                caps = dev["capabilities"]
+                merged = caps.get("config") if isinstance(caps.get("config"), dict) else {}
+                merged.update(cfg)
+                caps["config"] = merged
+            self.devices[device_id] = dev
+            self.version += 1
+            self.versions[device_id] = self.version
+            event["version"] = self.version
+            if telemetry is not None:
+                telemetry["version"] = self.version
+                self.latest[device_id] = telemetry
+        pending = event.get("pending")
+        if pending:
+            self.pending[pending["cmd_id"]] = pending
+        result = event.get("result")
+        if result:
+            self.results[result["cmd_id"]] = result
+            self.pending.pop(result["cmd_id"], None)
+        return True
+
+    def _prune_cmds(self) -> None:
+        cutoff = int(time.time()) - self.cmd_ttl_sec
+        for table in (self.pending, self.results):
+            for cmd_id, rec in list(table.items()):
+                if int(rec.get("ts") or 0) < cutoff:
+                    table.pop(cmd_id, None)
+
+    def _state(self) -> Dict[str, Any]:
+        self._prune_cmds()
+        return {
+            "op": "state",
+            "epoch": self.epoch,
+            "version": self.version,
+            "devices": list(self.devices.values()),
+            "latest": list(self.latest.values()),
+            "versions": self.versions,
+            "pending": list(self.pending.values()),
+            "results": list(self.results.values()),
+        }
+
+    def _drop(self, worker_id: str, peer: _Peer) -> None:
+        with self._lock:
+            if self.workers.get(worker_id) is not peer:
+                return
+            del self.workers[worker_id]
+            self.stats["workers_lost"] += 1
+            orphaned = [d for d, w in self.owners.items() if w == worker_id]
+        # worker 退出/崩溃：它持有的设备连接都已断开
+        for device_id in orphaned:
+            self.publish(
+                worker_id,
+                {"device_id": device_id, "patch": {"status": "offline"}, "status": True, "own": False, "if_owner": True},
+            )
+
+    def snapshot_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                "epoch": self.epoch,
+                "version": self.version,
+                "workers": sorted(self.workers),
+                "owned_devices": len(self.owners),
+            }
+
+
+class BrokerClient:
+    """worker 侧的 broker 连接：断线自动重连，每次（重新）连上时先收到完整状态。
+
+    回调都在读线程里执行，需要快速返回（app 侧只做内存更新 + 非阻塞入队）：
+    - on_state(state)：用 broker 的完整状态替换本地副本
+    - on_event(event)：应用一条已排序的事件
+    - on_deliver(device_id, text) -> error|None：把命令发给本 worker 持有的设备连接（在独立线程里调用）
+    - on_evict(device_id)：设备已在其他 worker 重连
+    """
+
+    def __init__(
+        self,
+        address: Address,
+        authkey: bytes,
+        worker_id: str,
+        on_state: Callable[[Dict[str, Any]], None],
+        on_event: Callable[[Dict[str, Any]], None],
+        on_deliver: Callable[[str, str], Optional[str]],
+        on_evict: Callable[[str], None],
+        reconnect_sec: float = 1.0,
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.worker_id = worker_id
+        self.on_state = on_state
+        self.on_event = on_event
+        self.on_deliver = on_deliver
+        self.on_evict = on_evict
+        self.reconnect_sec = reconnect_sec
+        self._peer: Optional[_Peer] = None
+        self._calls: Dict[int, Any] = {}  # rid -> [threading.Event, error]
+        self._rid = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._ready = threading.Event()
+        self.stats = {"connects": 0, "published": 0, "applied": 0, "commands_routed": 0, "commands_delivered": 0}
+
+    @property
+    def connected(self) -> bool:
+        peer = self._peer
+        return peer is not None and not peer.closed
+
+    def start(self, wait_sec: float = 5.0) -> bool:
+        """启动读线程；等待首次连上（拿到完整状态）最多 wait_sec 秒。"""
+        threading.Thread(target=self._run, name="sls-broker-client", daemon=True).start()
+        return self._ready.wait(wait_sec)
+
+    def stop(self) -> None:
+        self._stopped = True
+        peer = self._peer
+        if peer is not None:
+            peer.close()
+
+    def publish(self, event: Dict[str, Any]) -> bool:
+        """发送一条状态事件；未连上 broker 时返回 False（调用方自行在本地应用）。"""
+        peer = self._peer
+        if peer is None:
+            return False
+        try:
+            peer.send({"op": "event", "event": event})
+        except ConnectionError:
+            return False
+        self.stats["published"] += 1
+        return True
+
+    def route_command(self, device_id: str, text: str, timeout: float = 3.0) -> Optional[str]:
+        """经 broker 把命令交给持有该设备连接的 worker；成功返回 None，否则返回错误码。"""
+        peer = self._peer
+        if peer is None:
+            return "broker_unavailable"
+        done = threading.Event()
+        slot = [done, None]
+        with self._lock:
+            self._rid += 1
+            rid = self._rid
+            self._calls[rid] = slot
+        try:
+            peer.send({"op": "command", "rid": rid, "device_id": device_id, "text": text})
+            if not done.wait(timeout):
+                return "send_timeout"
+        except ConnectionError:
+            return "broker_unavailable"
+        finally:
+            with self._lock:
+                self._calls.pop(rid, None)
+        self.stats["commands_routed"] += 1
+        return slot[1]
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+            except Exception:
+                time.sleep(self.reconnect_sec)
+                continue
+            peer = _Peer(conn, "sls-broker-client-send")
+            try:
+                peer.send({"op": "hello", "worker_id": self.worker_id, "pid": os.getpid()})
+                state = peer.recv()
+                self.stats["connects"] += 1
+                # 先挂上连接再回放状态：on_state 里重新登记设备时要能 publish
+                self._peer = peer
+                self.on_state(state)
+                self._ready.set()
+                while True:
+                    self._dispatch(peer, peer.recv())
+            except (EOFError, OSError, ValueError):
+                pass
+            finally:
+                self._peer = None
+                peer.close()
+                self._fail_calls()
+            if not self._stopped:
+                time.sleep(self.reconnect_sec)
+
+    def _dispatch(self, peer: _Peer, msg: Dict[str, Any]) -> None:
+        op = msg.get("op")
+        if op == "event":
+            self.stats["applied"] += 1
+            self.on_event(msg.get("event") or {})
+        elif op == "deliver":
+            # 设备 socket 的 send 可能阻塞，放到独立线程，不耽误事件回放
+            threading.Thread(target=self._deliver, args=(peer, msg), daemon=True).start()
+        elif op == "reply":
+            with self._lock:
+                slot = self._calls.get(msg.get("rid"))  # type: ignore[arg-type]
+            if slot is not None:
+                slot[1] = msg.get("error")
+                slot[0].set()
+        elif op == "evict":
+            self.on_evict(str(msg.get("device_id") or ""))
+
+    def _deliver(self, peer: _Peer, msg: Dict[str, Any]) -> None:
+        try:
+            error = self.on_deliver(str(msg.get("device_id") or ""), str(msg.get("text") or ""))
+        except Exception:
+            error = "send_failed"
+        if error is None:
+            self.stats["commands_delivered"] += 1
+        try:
+            peer.send({"op": "delivered", "rid": msg.get("rid"), "error": error})
+        except ConnectionError:
+            pass
+
+    def _fail_calls(self) -> None:
+        with self._lock:
+            slots = list(self._calls.values())
+        for slot in slots:
+            slot[1] = "broker_unavailable"
+            slot[0].set()
+
+
+def broker_authkey() -> bytes:
+    """配置的 authkey；为空时返回 b""（serve 模式会随机生成，broker 模式与 worker 则拒绝启动）。"""
+    return str(getattr(config, "BROKER_AUTHKEY", "") or "").encode("utf-8")
+
+
+def _default_broker_addr() -> str:
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(tempfile.gettempdir(), f"sls-broker-{os.getpid()}.sock")
+    return "127.0.0.1:5099"
+
+
+def _listen_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    """运维入口：python -m server.cluster [serve|broker]"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m server.cluster", description="SLS 多进程部署")
+    parser.add_argument("mode", nargs="?", choices=("serve", "broker"), default="serve")
+    parser.add_argument("--workers", type=int, default=int(getattr(config, "CLUSTER_WORKERS", 0) or 0) or (os.cpu_count() or 2))
+    parser.add_argument("--broker-addr", default=getattr(config, "BROKER_ADDR", "") or "")
+    parser.add_argument("--asgi", action="store_true", help="worker 使用 asyncio 入口（server.asgi，需要 uvicorn）")
+    args = parser.parse_args(argv)
+
+    authkey = broker_authkey()
+    if not authkey:
+        if args.mode == "broker":
+            print("broker 模式需要配置 SLS_BROKER_AUTHKEY（worker 用同一个值连接）", file=sys.stderr)
+            return 1
+        # serve 模式：每次启动随机生成，只经环境变量传给本次启动的 worker
+        authkey = secrets.token_hex(32).encode("utf-8")
+
+    addr = args.broker_addr or _default_broker_addr()
+    address = parse_address(addr)
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+    broker = Broker(address, authkey, cmd_ttl_sec=int(getattr(config, "COMMAND_STATUS_TTL_SEC", 600) or 600))
+    broker.start()
+    print(f"broker listening on {addr}", flush=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    if args.mode == "broker":
+        stop.wait()
+        broker.stop()
+        return 0
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("serve 模式依赖继承监听 fd（仅 POSIX）；Windows 上请用 broker 模式并为每个 worker 配置不同端口", file=sys.stderr)
+        broker.stop()
+        return 1
+
+    # 迁移只在启动前做一次，避免多个 worker 同时迁移
+    try:
+        from . import db  # type: ignore
+    except Exception:
+        import db  # type: ignore
+    migrated = False
+    if getattr(config, "ENABLE_SQLITE", True):
+        db.init_db()
+        migrated = True
+
+    listener = _listen_socket(config.HOST, config.PORT)
+    module = "server.asgi" if args.asgi else "server.app"
+    procs: List[subprocess.Popen] = []
+    for index in range(max(1, args.workers)):
+        env = dict(os.environ)
+        env.update(
+            {
+                "SLS_BROKER_ADDR": addr,
+                "SLS_BROKER_AUTHKEY": authkey.decode("utf-8"),
+                "SLS_WORKER_INDEX": str(index),
+                "SLS_DB_MIGRATED": "1" if migrated else "0",
+                "SLS_LISTEN_FD": str(listener.fileno()),
+            }
+        )
+        procs.append(subprocess.Popen([sys.executable, "-m", module], env=env, pass_fds=(listener.fileno(),)))
+    print(f"{len(procs)} workers serving on {config.HOST}:{config.PORT}", flush=True)
+    if hasattr(signal, "SIGHUP"):
+        # 热加载（API Key / TTL）：转发给每个 worker，各自重新读取配置
+        signal.signal(signal.SIGHUP, lambda *_: [p.send_signal(signal.SIGHUP) for p in procs if p.poll() is None])
+
+    while not stop.wait(1.0):
+        if all(p.poll() is not None for p in procs):
+            break
+    for p in procs:
+        if p.poll() is None:
+            p.terminate()
+    for p in procs:
+        try:
+            p.wait(10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+    broker.stop()
+    listener.close()
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -0,0 +1,260 @@
+"""设备上行的紧凑二进制帧（/ws/telemetry，hello 协商 protocol >= 2 后可用）。
+
+JSON 上报每条都带完整的键名（environment.bmp280.temp ...），一条样本约 170 字节；
+二进制帧按下面的字段表只传数值，一条样本约 25 字节。设备端编码见 hardware/hw_codec.py，
+两边的字段表必须一致（只能在末尾追加，不能改已有字段的位置与精度）。
+
+帧格式（小端）：
+- 头：magic(B)=0xB7, version(B)=1, kind(B)=1 telemetry / 2 telemetry_batch, flags(B)
+    - flags bit0：帧级 is_buffered；bit1：后跟帧级 boot_id(I)
+- kind=2 时：样本数(H)
+- 每条样本：seq(I，0xFFFFFFFF=无), timestamp(I，0=无), sflags(B), [boot_id(I)], sensors(B), fields(H), 值...
+    - sflags bit0：本条 is_buffered；bit1：后跟本条 boot_id（覆盖帧级）
+    - sensors：出现了哪些传感器（按 SENSORS 顺序）；fields：哪些字段有值（按 FIELDS 顺序），值依次排列
+    - 出现了的传感器，其没有值的字段还原为 None（与 JSON 上报的形状一致）
+
+boot_id 在线上是 u32，还原为 8 位十六进制字符串（与设备 JSON 上报的 boot_id 相同，去重键一致）。
+无法用字段表表示的样本（未知传感器/字段、越界、status 不在枚举里）由设备端退回 JSON 发送。
+"""
+
+from __future__ import annotations
+
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+# hello 中 protocol >= 2 表示设备会发送二进制帧；server 回 hello_ok 时带上协商结果
+PROTOCOL = 2
+
+MAGIC = 0xB7
+VERSION = 1
+KIND_TELEMETRY = 1
+KIND_BATCH = 2
+
+_SEQ_NONE = 0xFFFFFFFF
+_TS_NONE = 0
+
+SENSORS: Tuple[str, ...] = ("bmp280", "light")
+
+# 字段表：(传感器, 字段, struct 格式, 缩放)；缩放为 None 表示枚举（值为 STATUS_ENUM 的下标）
+FIELDS: Tuple[Tuple[str, str, str, Optional[int]], ...] = (
+    ("bmp280", "temp", "h", 100),  # 0.01 °C
+    ("bmp280", "pressure", "I", 10000),  # 0.0001 hPa
+    ("bmp280", "status", "B", None),
+    ("light", "raw", "H", 1),
+    ("light", "voltage", "H", 100),  # 0.01 V
+    ("light", "percent", "B", 1),
+)
+
+STATUS_ENUM: Tuple[str, ...] = ("ok", "init", "unavailable")
+
+_HEADER = struct.Struct("<BBBB")
+_COUNT = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_SAMPLE = struct.Struct("<IIB")
+_MASKS = struct.Struct("<BH")
+_FIELD_STRUCTS = tuple(struct.Struct("<" + fmt) for _, _, fmt, _ in FIELDS)
+_LIMITS = {"h": (-32768, 32767), "H": (0, 65535), "B": (0, 255), "I": (0, 0xFFFFFFFF)}
+
+
+def is_frame(raw: Any) -> bool:
+    """是否为二进制帧（JSON 文本不会以 0xB7 开头）。"""
+    return isinstance(raw, (bytes, bytearray, memoryview)) and len(raw) > 0 and raw[0] == MAGIC
+
+
+def _boot_to_wire(boot_id: Any) -> Optional[int]:
+    if isinstance(boot_id, str) and len(boot_id) == 8:
+        try:
+            return int(boot_id, 16)
+        except ValueError:
+            return None
+    return None
+
+
+def _encode_sample(
+    sample: Dict[str, Any], ts: Any, frame_buffered: bool, frame_boot: Optional[int]
+) -> Optional[Tuple[str, List[Any]]]:
+    seq = sample.get("seq")
+    if seq is None:
+        seq = _SEQ_NONE
+    elif not isinstance(seq, int) or isinstance(seq, bool) or not 0 <= seq < _SEQ_NONE:
+        return None
+    if ts is None:
+        ts = _TS_NONE
+    elif not isinstance(ts, (int, float)) or isinstance(ts, bool) or not 0 < ts <= 0xFFFFFFFF or ts != int(ts):
+        return None
+
+    fmt = "IIB"
+    sflags = 0
+    args: List[Any] = [seq, int(ts), 0]
+    if bool(sample.get("is_buffered", frame_buffered)):
+        sflags |= 1
+    boot = sample.get("boot_id")
+    if boot is not None:
+        wire = _boot_to_wire(boot)
+        if wire is None:
+            return None
+        if wire != frame_boot:
+            sflags |= 2
+            fmt += "I"
+            args.append(wire)
+    elif frame_boot is not None:
+        return None
+    args[2] = sflags
+
+    env = sample.get("environment") or {}
+    if not isinstance(env, dict) or not set(env).issubset(SENSORS):
+        return None
+    sensors = 0
+    fields = 0
+    values_fmt = ""
+    values: List[Any] = []
+    for i, name in enumerate(SENSORS):
+        data = env.get(name)
+        if data is None:
+            continue
+        if not isinstance(data, dict) or not set(data).issubset(f[1] for f in FIELDS if f[0] == name):
+            return None
+        sensors |= 1 << i
+    for i, (sensor, field, code, scale) in enumerate(FIELDS):
+        data = env.get(sensor)
+        v = data.get(field) if isinstance(data, dict) else None
+        if v is None:
+            continue
+        if scale is None:
+            if v not in STATUS_ENUM:
+                return None
+            w = STATUS_ENUM.index(v)
+        else:
+            if not isinstance(v, (int, float)) or isinstance(v, bool):
+                return None
+            if scale == 1 and not isinstance(v, int):
+                return None
+            w = int(round(v * scale))
+            lo, hi = _LIMITS[code]
+            if not lo <= w <= hi:
+                return None
+        fields |= 1 << i
+        values_fmt += code
+        values.append(w)
+    return fmt + "BH" + values_fmt, args + [sensors, fields] + values
+
+
+def encode(msg: Dict[str, Any]) -> Optional[bytes]:
+    """把 telemetry / telemetry_batch 消息（与 JSON 上报同形）编码为二进制帧；无法表示时返回 None。"""
+    kind = msg.get("type")
+    buffered = bool(msg.get("is_buffered", False))
+    boot = msg.get("boot_id")
+    frame_boot = _boot_to_wire(boot) if boot is not None else None
+    if boot is not None and frame_boot is None:
+        return None
+
+    if kind == "telemetry":
+        samples = [(msg, msg.get("timestamp"))]
+    elif kind == "telemetry_batch":
+        raw = msg.get("samples")
+        if not isinstance(raw, list) or not raw or len(raw) > 0xFFFF:
+            return None
+        base = msg.get("ts_base")
+        samples = []
+        for s in raw:
+            if not isinstance(s, dict):
+                return None
+            ts = s.get("timestamp")
+            if ts is None and base is not None and s.get("dt") is not None:
+                ts = base + s["dt"]
+            samples.append((s, ts))
+    else:
+        return None
+
+    flags = (1 if buffered else 0) | (2 if frame_boot is not None else 0)
+    fmt = "<BBBB"
+    args: List[Any] = [MAGIC, VERSION, KIND_TELEMETRY if kind == "telemetry" else KIND_BATCH, flags]
+    if frame_boot is not None:
+        fmt += "I"
+        args.append(frame_boot)
+    if kind == "telemetry_batch":
+        fmt += "H"
+        args.append(len(samples))
+    for s, ts in samples:
+        # 单条 telemetry 的 boot_id 就是帧级 boot_id，样本里不再重复
+        sample = dict(s, boot_id=None) if kind == "telemetry" else dict(s, boot_id=s.get("boot_id", boot))
+        part = _encode_sample(sample, ts, buffered, frame_boot if kind == "telemetry_batch" else None)
+        if part is None:
+            return None
+        fmt += part[0]
+        args.extend(part[1])
+    return struct.pack(fmt, *args)
+
+
+def _decode_sample(buf: bytes, off: int, frame_buffered: bool, frame_boot: Optional[str]) -> Tuple[Dict[str, Any], int]:
+    seq, ts, sflags = _SAMPLE.unpack_from(buf, off)
+    off += _SAMPLE.size
+    boot = frame_boot
+    if sflags & 2:
+        boot = "%08x" % _U32.unpack_from(buf, off)[0]
+        off += _U32.size
+    sensors, fields = _MASKS.unpack_from(buf, off)
+    off += _MASKS.size
+
+    env: Dict[str, Any] = {}
+    for i, name in enumerate(SENSORS):
+        if sensors & (1 << i):
+            env[name] = {f[1]: None for f in FIELDS if f[0] == name}
+    for i, (sensor, field, _, scale) in enumerate(FIELDS):
+        if not fields & (1 << i):
+            continue
+        w = _FIELD_STRUCTS[i].unpack_from(buf, off)[0]
+        off += _FIELD_STRUCTS[i].size
+        if scale is None:
+            v: Any = STATUS_ENUM[w] if w < len(STATUS_ENUM) else None
+        elif scale == 1:
+            v = w
+        else:
+            v = w / scale
+        env.setdefault(sensor, {f[1]: None for f in FIELDS if f[0] == sensor})[field] = v
+
+    sample: Dict[str, Any] = {
+        "seq": None if seq == _SEQ_NONE else seq,
+        "timestamp": None if ts == _TS_NONE else ts,
+        "environment": env,
+    }
+    if bool(sflags & 1) != frame_buffered:
+        sample["is_buffered"] = bool(sflags & 1)
+    if boot is not None:
+        sample["boot_id"] = boot
+    return sample, off
+
+
+def decode(raw: bytes) -> Dict[str, Any]:
+    """解码二进制帧为与 JSON 上报同形的 dict（telemetry / telemetry_batch）；格式错误抛 ValueError。"""
+    buf = bytes(raw)
+    try:
+        magic, version, kind, flags = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION or kind not in (KIND_TELEMETRY, KIND_BATCH):
+            raise ValueError("bad_frame")
+        off = _HEADER.size
+        buffered = bool(flags & 1)
+        boot = None
+        if flags & 2:
+            boot = "%08x" % _U32.unpack_from(buf, off)[0]
+            off += _U32.size
+
+        if kind == KIND_TELEMETRY:
+            sample, off = _decode_sample(buf, off, buffered, boot)
+            msg = {"type": "telemetry", **sample}
+            msg.setdefault("is_buffered", buffered)
+        else:
+            (count,) = _COUNT.unpack_from(buf, off)
+            off += _COUNT.size
+            samples = []
+            for _ in range(count):
+                sample, off = _decode_sample(buf, off, buffered, None)
+                samples.append(sample)
+            msg = {"type": "telemetry_batch", "is_buffered": buffered, "samples": samples}
+            if boot is not None:
+                msg["boot_id"] = boot
+    except struct.error as exc:
+        raise ValueError("bad_frame") from exc
+    if off != len(buf):
+        raise ValueError("bad_frame")
+    return msg
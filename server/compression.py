@@ -0,0 +1,117 @@
+"""REST 响应压缩：按 Accept-Encoding 选 br / gzip，体积超过阈值才压缩。
+
+- br 需要可选依赖 brotli（或 brotlicffi），未安装时只用 gzip
+- 整块响应用 compress()；流式响应（export）用 stream() 逐块压缩，整个响应共用一个压缩上下文
+- 压缩级别偏向速度（gzip 6 / br 5）：动态响应每次都要压，高级别收益很小但 CPU 成本成倍增加
+
+/ws/dashboard 的 permessage-deflate 由 WebSocket 层协商（simple-websocket / uvicorn），不在这里。
+"""
+
+from __future__ import annotations
+
+import threading
+import zlib
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    try:
+        import brotlicffi as brotli  # type: ignore
+    except ImportError:
+        brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# 流式压缩：累计这么多未压缩字节就 flush 一次（每行都 flush 会明显拉低压缩率）
+STREAM_FLUSH_BYTES = 32 * 1024
+
+# 值得压缩的响应类型（图片等已压缩内容不在此列）
+COMPRESSIBLE = frozenset(
+    ("application/json", "application/x-ndjson", "text/csv", "text/plain", "text/html", "text/css", "application/javascript")
+)
+
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {"responses": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def choose(accept_encoding: str) -> Optional[str]:
+    """解析 Accept-Encoding，返回要使用的编码（优先 br），客户端都不接受时返回 None。"""
+    if not accept_encoding:
+        return None
+    q: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        q[name] = weight
+    best = None
+    best_q = 0.0
+    for enc in ENCODINGS:
+        weight = q.get(enc, q.get("x-gzip" if enc == "gzip" else enc, q.get("*", 0.0)))
+        if weight > best_q:
+            best, best_q = enc, weight
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        out = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        out = c.compress(data) + c.flush()
+    _record(len(data), len(out))
+    return out
+
+
+def stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """逐块压缩流式响应；每累计 STREAM_FLUSH_BYTES 就 flush 一次，客户端可以边下载边解析。"""
+    if encoding == "br":
+        c: Any = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = c.process, c.flush, c.finish
+    else:
+        z = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, flush, finish = z.compress, (lambda: z.flush(zlib.Z_SYNC_FLUSH)), z.flush
+    size_in = size_out = pending = 0
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            size_in += len(chunk)
+            pending += len(chunk)
+            out = process(chunk)
+            if pending >= STREAM_FLUSH_BYTES:
+                out += flush()
+                pending = 0
+            if out:
+                size_out += len(out)
+                yield out
+        out = finish()
+        size_out += len(out)
+        yield out
+    finally:
+        _record(size_in, size_out, streamed=True)
+
+
+def _record(size_in: int, size_out: int, streamed: bool = False) -> None:
+    with _stats_lock:
+        _stats["streamed" if streamed else "responses"] += 1
+        _stats["bytes_in"] += size_in
+        _stats["bytes_out"] += size_out
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        out: Dict[str, Any] = dict(_stats)
+    out["encodings"] = list(ENCODINGS)
+    return out
@@ -8,11 +8,39 @@
 
 from __future__ import annotations
 
+import importlib
 import os
+import sys
+from dataclasses import dataclass
+from typing import Dict, FrozenSet
+
+
+def _read_env_file(path: str) -> Dict[str, str]:
+    """KEY=VALUE 格式的配置文件（# 开头为注释）；SIGHUP 热加载时会重新读取。"""
+    out: Dict[str, str] = {}
+    if not path:
+        return out
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                k, v = line.split("=", 1)
+                out[k.strip()] = v.strip().strip('"').strip("'")
+    except OSError:
+        pass
+    return out
+
+
+# 可选的配置文件：环境变量优先，其次是该文件
+_FILE_ENV = _read_env_file(os.getenv("SLS_ENV_FILE", ""))
 
 
 def _env(name: str, default: str = "") -> str:
     value = os.getenv(name)
+    if value is None:
+        value = _FILE_ENV.get(name)
     return default if value is None else value
 
 
@@ -38,3 +66,108 @@ ENABLE_SQLITE = _env("SLS_ENABLE_SQLITE", "1") == "1"
 
 # 命令状态（pending/acked）在内存中保留的 TTL（秒），用于 Desktop 轮询回执。
 COMMAND_STATUS_TTL_SEC = int(_env("SLS_COMMAND_STATUS_TTL_SEC", "600"))
+
+# telemetry 异步落库（write-behind）：请求线程只入队，由后台线程攒批写入 SQLite。
+# - 队列上限：超过后新记录会被丢弃并计数（见 /api/metrics 的 db_writer.dropped）
+# - 攒批：满 BATCH_MAX 条或等待超过 FLUSH_MS 毫秒即提交一次事务
+DB_WRITE_QUEUE_MAX = int(_env("SLS_DB_WRITE_QUEUE_MAX", "10000"))
+DB_WRITE_BATCH_MAX = int(_env("SLS_DB_WRITE_BATCH_MAX", "200"))
+DB_WRITE_FLUSH_MS = int(_env("SLS_DB_WRITE_FLUSH_MS", "200"))
+
+# telemetry 幂等写入：库里按 (device_id, boot_id, seq) 唯一索引去重；另在内存里为每个设备会话
+# 记住最近 DEDUP_WINDOW 个已写入的 seq，补发风暴中的明显重复不再进写队列/数据库（0 = 关闭）。
+DEDUP_WINDOW = int(_env("SLS_DEDUP_WINDOW", "512"))
+
+# SQLite 连接池：空闲连接上限与每连接的预编译语句缓存大小。
+DB_POOL_MAX_IDLE = int(_env("SLS_DB_POOL_MAX_IDLE", "8"))
+DB_STATEMENT_CACHE = int(_env("SLS_DB_STATEMENT_CACHE", "64"))
+
+# 数据保留期（天，<=0 表示永久保留；默认全部永久保留，按需开启）。
+# 例：原始数据 7 天、1m 聚合 30 天、1h 聚合 365 天、1d 聚合永久。
+RETENTION_RAW_DAYS = int(_env("SLS_RETENTION_RAW_DAYS", "0"))
+RETENTION_1M_DAYS = int(_env("SLS_RETENTION_1M_DAYS", "0"))
+RETENTION_1H_DAYS = int(_env("SLS_RETENTION_1H_DAYS", "0"))
+RETENTION_1D_DAYS = int(_env("SLS_RETENTION_1D_DAYS", "0"))
+# 保留期任务：执行周期（秒）、每批删除行数、批间停顿（毫秒）、每轮增量 vacuum 页数
+RETENTION_INTERVAL_SEC = int(_env("SLS_RETENTION_INTERVAL_SEC", "600"))
+RETENTION_BATCH_SIZE = int(_env("SLS_RETENTION_BATCH_SIZE", "2000"))
+RETENTION_BATCH_PAUSE_MS = int(_env("SLS_RETENTION_BATCH_PAUSE_MS", "50"))
+RETENTION_VACUUM_PAGES = int(_env("SLS_RETENTION_VACUUM_PAGES", "1000"))
+
+# dashboard 广播：每个 dashboard 连接的发送队列上限与队列满时的策略。
+# - drop_oldest：丢弃最旧的一条
+# - coalesce_latest：同一设备的 telemetry/device_status 只保留最新一条（默认）
+DASHBOARD_QUEUE_MAX = int(_env("SLS_DASHBOARD_QUEUE_MAX", "256"))
+DASHBOARD_DROP_POLICY = _env("SLS_DASHBOARD_DROP_POLICY", "coalesce_latest").strip().lower()
+
+# 压缩：WS_DEFLATE=1 时 /ws/dashboard、/ws/telemetry 接受客户端提出的 permessage-deflate
+# （每个连接保留压缩上下文，重复的键名/设备名几乎不占带宽）；
+# REST 响应体（JSON/NDJSON/CSV）超过 HTTP_COMPRESS_MIN_BYTES 且客户端接受时按 br/gzip 压缩，0 关闭
+WS_DEFLATE = _env("SLS_WS_DEFLATE", "1") == "1"
+HTTP_COMPRESS_MIN_BYTES = int(_env("SLS_HTTP_COMPRESS_MIN_BYTES", "1024"))
+
+# ASGI 入口（python -m server.asgi / uvicorn server.asgi:app）：
+# WebSocket 在事件循环中处理；REST 请求与 SQLite 查询在该大小的线程池中执行。
+ASGI_HTTP_THREADS = int(_env("SLS_ASGI_HTTP_THREADS", "8"))
+
+# /ws/telemetry 的 telemetry_batch：单帧最多接受的样本数（超过整帧拒绝，设备应拆成多帧）
+TELEMETRY_BATCH_MAX = int(_env("SLS_TELEMETRY_BATCH_MAX", "200"))
+
+# POST /api/telemetry/bulk：单次请求最多记录数与解压后的最大字节数（防止压缩炸弹）
+TELEMETRY_BULK_MAX = int(_env("SLS_TELEMETRY_BULK_MAX", "10000"))
+TELEMETRY_BULK_MAX_BYTES = int(_env("SLS_TELEMETRY_BULK_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# 多进程部署（python -m server.cluster）：broker 地址为空时单进程运行（状态只在本进程内存）。
+# 地址为 Unix socket 路径或 host:port；authkey 用于 broker 连接鉴权。
+BROKER_ADDR = _env("SLS_BROKER_ADDR", "").strip()
+# 为空时 python -m server.cluster 每次启动随机生成并经环境变量传给 worker；单独运行 broker 时必须配置
+BROKER_AUTHKEY = _env("SLS_BROKER_AUTHKEY", "")
+CLUSTER_WORKERS = int(_env("SLS_CLUSTER_WORKERS", "0"))  # 0 = CPU 核数
+# 以下两项由 server.cluster 启动 worker 时设置：worker 序号（只有 0 号跑保留期任务）与继承的监听 fd
+WORKER_INDEX = int(_env("SLS_WORKER_INDEX", "0"))
+# server.cluster 启动前已做过 SQLite 迁移时设为 1：worker 不再各自迁移
+DB_MIGRATED = _env("SLS_DB_MIGRATED", "0") == "1"
+LISTEN_FD = int(_env("SLS_LISTEN_FD", "-1"))
+
+# 按设备的 API Key（只存 sha256 摘要）：JSON 文件 {"esp32-01": "sha256:<hex>"}，见 server/auth.py
+DEVICE_KEYS_FILE = _env("SLS_DEVICE_KEYS_FILE", "").strip()
+
+
+@dataclass(frozen=True)
+class Settings:
+    """热路径上用到的设置：启动时解析一次，SIGHUP 热加载时整体替换（读方不需要加锁、不做类型转换）。
+
+    端口、线程数、数据库等启动期配置不在这里，修改后需要重启。
+    """
+
+    api_keys: FrozenSet[str]
+    device_keys_file: str
+    device_offline_ttl_sec: int
+    command_status_ttl_sec: int
+    enable_sqlite: bool
+
+
+def load_settings() -> Settings:
+    return Settings(
+        api_keys=frozenset(API_KEYS),
+        device_keys_file=DEVICE_KEYS_FILE,
+        device_offline_ttl_sec=DEVICE_OFFLINE_TTL_SEC,
+        command_status_ttl_sec=COMMAND_STATUS_TTL_SEC if COMMAND_STATUS_TTL_SEC > 0 else 600,
+        enable_sqlite=ENABLE_SQLITE,
+    )
+
+
+def reload() -> Settings:
+    """重新读取环境变量与 SLS_ENV_FILE，返回新的 Settings。
+
+    配置有误（例如数值项不是整数）时抛出异常，模块里的全部设置保持重新加载前的值。
+    """
+    module = sys.modules[__name__]
+    saved = dict(vars(module))
+    try:
+        return importlib.reload(module).load_settings()
+    except Exception:
+        # reload 在原模块对象上重新执行：出错前的赋值已经生效，整体恢复，避免新旧配置混在一起
+        vars(module).clear()
+        vars(module).update(saved)
+        raise
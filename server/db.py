@@ -6,16 +6,31 @@
 - 不引入额外依赖，使用标准库 sqlite3
 
 注意：
-- 采用“每次操作短连接”的方式，避免在 WS/多线程环境下复用连接带来的线程问题。
+- 连接由 ConnectionPool 统一管理：打开一次、PRAGMA 设置一次，借出期间只归一个线程使用。
+- telemetry 写入走 TelemetryWriter（后台线程攒批 executemany），请求线程只负责入队。
+- 已知指标（bmp280/light）存类型化列，未知字段落在 env_json（overflow），读路径基本不需要 json.loads。
 - Phase1 只存 telemetry，不做复杂清洗/聚合。
 """
 
 from __future__ import annotations
 
-import json
+import base64
+import calendar
 import os
+import queue
+import re
 import sqlite3
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from . import serialization  # type: ignore
+except Exception:
+    # 兼容直接运行：在 server 目录下 python db.py
+    import serialization  # type: ignore
 
 
 def _env(name: str, default: str = "") -> str:
@@ -36,10 +51,20 @@ def get_db_path() -> str:
     return os.path.join(data_dir, "sls.db")
 
 
-def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(get_db_path(), timeout=5)
+def _busy_timeout_s() -> float:
+    """写锁被占用时等待的秒数（SLS_DB_BUSY_TIMEOUT_MS，默认 5000）；多进程部署时各 worker 共用一个库文件。"""
+    try:
+        return max(0, int(_env("SLS_DB_BUSY_TIMEOUT_MS", "5000"))) / 1000.0
+    except ValueError:
+        return 5.0
+
+
+def _open_connection(path: str, cached_statements: int) -> sqlite3.Connection:
+    # check_same_thread=False：连接由池统一借出/归还，同一时刻只会被一个线程使用
+    # timeout 即 busy_timeout：其他进程持有写锁时等待，而不是立刻报 database is locked
+    conn = sqlite3.connect(path, timeout=_busy_timeout_s(), check_same_thread=False, cached_statements=cached_statements)
     conn.row_factory = sqlite3.Row
-    # 基础可靠性设置
+    # 基础可靠性设置（每个连接只执行一次）
     try:
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA synchronous=NORMAL;")
@@ -48,37 +73,561 @@ def _connect() -> sqlite3.Connection:
     return conn
 
 
+class ConnectionPool:
+    """SQLite 连接池：连接只打开一次、PRAGMA 只设置一次，按需借出/归还。
+
+    Flask 开发服务器是“每请求一个线程”，线程本地连接几乎无法复用，
+    因此这里用进程级的空闲连接栈（LIFO，尽量复用热连接及其语句缓存）。
+    按文件路径分别维护空闲栈（主库 + 分区文件）。
+    """
+
+    def __init__(self, max_idle: int = 8, cached_statements: int = 64):
+        self.max_idle = max(1, int(max_idle))
+        self.cached_statements = max(0, int(cached_statements))
+        self._lock = threading.Lock()
+        self._idle: Dict[str, List[sqlite3.Connection]] = {}
+        self._stats: Dict[str, int] = {"hits": 0, "opened": 0, "closed": 0, "open": 0, "in_use": 0}
+
+    def _take(self, path: str) -> sqlite3.Connection:
+        conn: Optional[sqlite3.Connection] = None
+        with self._lock:
+            idle = self._idle.get(path)
+            if idle:
+                conn = idle.pop()
+                self._stats["hits"] += 1
+            self._stats["in_use"] += 1
+        if conn is not None:
+            return conn
+
+        try:
+            conn = _open_connection(path, self.cached_statements)
+        except Exception:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            raise
+        with self._lock:
+            self._stats["opened"] += 1
+            self._stats["open"] += 1
+        return conn
+
+    def _give_back(self, path: str, conn: sqlite3.Connection) -> None:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            self._release(path, conn, keep=False)
+            return
+        self._release(path, conn, keep=True)
+
+    def _release(self, path: str, conn: sqlite3.Connection, keep: bool) -> None:
+        with self._lock:
+            self._stats["in_use"] -= 1
+            idle = self._idle.setdefault(path, [])
+            # 文件已被删除（分区过期）时不再复用，避免写进已 unlink 的 inode
+            if keep and len(idle) < self.max_idle and os.path.exists(path):
+                idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["closed"] += 1
+            self._stats["open"] -= 1
+
+    @contextmanager
+    def connection(self, path: Optional[str] = None) -> Iterator[sqlite3.Connection]:
+        path = path or get_db_path()
+        conn = self._take(path)
+        try:
+            yield conn
+        finally:
+            self._give_back(path, conn)
+
+    def close_path(self, path: str) -> None:
+        """关闭某个文件的空闲连接（删除分区文件前调用）。"""
+        with self._lock:
+            idle = self._idle.pop(path, [])
+        for c in idle:
+            self._discard(c)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            self._idle = {}
+        for c in idle:
+            self._discard(c)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._stats)
+            out["idle"] = sum(len(v) for v in self._idle.values())
+            out["files"] = sum(1 for v in self._idle.values() if v)
+        out["max_idle"] = self.max_idle
+        out["cached_statements"] = self.cached_statements
+        return out
+
+
+_pool = ConnectionPool()
+
+
+def configure_pool(max_idle: int = 8, cached_statements: int = 64) -> None:
+    """按配置重建连接池（启动时调用；旧池的空闲连接会被关闭）。"""
+    global _pool
+    old, _pool = _pool, ConnectionPool(max_idle=max_idle, cached_statements=cached_statements)
+    old.close_all()
+
+
+def _connect(path: Optional[str] = None) -> ContextManager[sqlite3.Connection]:
+    """从连接池借一个连接：with _connect() as conn: ...（默认主库，可指定分区文件）"""
+    return _pool.connection(path)
+
+
+def pool_stats() -> Dict[str, Any]:
+    return _pool.stats()
+
+
+def close_pool() -> None:
+    _pool.close_all()
+
+
+# 当前 schema 版本（PRAGMA user_version）。
+# v2：已知指标拆成类型化列，env_json 只保留未知字段（overflow）。
+# v3：新增归一化事件时间列 event_ts（设备时间可信时取设备时间，否则取到达时间）。
+# v4：新增 boot_id 列（设备本次上电的会话号）与 (device_id, boot_id, seq) 唯一索引，写入改为 INSERT OR IGNORE。
+SCHEMA_VERSION = 4
+
+# SensorManager.collect_data() 产出的已知指标：(传感器, 字段, 列名, 列类型)
+_TYPED_FIELDS: Tuple[Tuple[str, str, str, str], ...] = (
+    ("bmp280", "temp", "bmp_temp", "REAL"),
+    ("bmp280", "pressure", "bmp_pressure", "REAL"),
+    ("bmp280", "status", "bmp_status", "TEXT"),
+    ("light", "raw", "light_raw", "INTEGER"),
+    ("light", "voltage", "light_voltage", "REAL"),
+    ("light", "percent", "light_percent", "INTEGER"),
+)
+
+# sensor_mask：标记该行哪些传感器已拆到类型化列（NULL 表示旧格式行，env_json 为完整 environment）
+_SENSOR_BITS: Dict[str, int] = {"bmp280": 1, "light": 2}
+
+_TYPED_COLUMNS = ", ".join(col for _, _, col, _ in _TYPED_FIELDS)
+
+# 可聚合的数值指标：对外名称（sensor.field）-> 列名
+METRICS: Dict[str, str] = {f"{sensor}.{field}": col for sensor, field, col, typ in _TYPED_FIELDS if typ != "TEXT"}
+
+# 单次聚合最多返回的桶数；超过时自动放大桶宽
+MAX_AGGREGATE_BUCKETS = 2000
+
+# 预聚合（rollup）分辨率：名称 -> 桶宽秒数（由细到粗）
+ROLLUP_RESOLUTIONS: Dict[str, int] = {"1m": 60, "1h": 3600, "1d": 86400}
+# rollup 中记录“该桶原始行数”的伪指标
+ROLLUP_ROWS_METRIC = "_rows"
+
+# 行元组中各数值指标的位置（见 _record_to_row：前 6 列为 device_id/ts/server_ts/seq/is_buffered/event_ts，最后一列为 boot_id）
+_ROW_SEQ_INDEX = 3
+_ROW_EVENT_TS_INDEX = 5
+_ROW_BOOT_INDEX = -1
+_ROW_METRIC_INDEX: Tuple[Tuple[str, int], ...] = tuple(
+    (f"{sensor}.{field}", 6 + i) for i, (sensor, field, _, typ) in enumerate(_TYPED_FIELDS) if typ != "TEXT"
+)
+
+# 设备时间的可信范围：早于 2020-01-01 视为未对时（ESP32 未 NTP 时 RTC 从 2000 年起跑），
+# 比服务器时间超前 EVENT_TS_MAX_SKEW_SEC 以上视为时钟错误；不可信时 event_ts 取 server_ts。
+EVENT_TS_MIN = 1577836800
+EVENT_TS_MAX_SKEW_SEC = 300
+
+# 时间查询口径：event = 事件时间（补传的积压数据落在采集时刻），arrival = 服务器到达时间
+TIME_FIELDS: Dict[str, str] = {"event": "event_ts", "arrival": "server_ts"}
+
+# 写线程遇到库被占用时的重试次数（每次在 busy_timeout 之外再退避 0.1s、0.2s、0.4s）
+_WRITE_RETRIES = 3
+
+
+def normalize_event_ts(ts: Optional[int], server_ts: Optional[int]) -> Optional[int]:
+    """计算 event_ts：设备 ts 可信时取 ts，否则退回 server_ts（两者都没有时为 None）。"""
+    if ts is not None and ts >= EVENT_TS_MIN and (server_ts is None or ts <= server_ts + EVENT_TS_MAX_SKEW_SEC):
+        return ts
+    return server_ts if server_ts is not None else ts
+
+
+def _time_column(time_field: Optional[str]) -> str:
+    """time_field（event/arrival，默认 event）-> 列名；未知取值抛 ValueError。"""
+    col = TIME_FIELDS.get(time_field or "event")
+    if col is None:
+        raise ValueError("invalid_time_field")
+    return col
+
+
+def _ensure_columns(conn: sqlite3.Connection, table: str, columns: Iterable[Tuple[str, str]]) -> None:
+    """为旧库补齐缺失列（ALTER TABLE ADD COLUMN，只改 schema 不重写数据）。"""
+    existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _fill_event_ts(conn: sqlite3.Connection, batch_size: int = 5000) -> int:
+    """为 v3 之前的行补算 event_ts（按 id 区间分批，每批一个短事务），返回更新的行数。
+
+    规则与 normalize_event_ts() 一致，直接用 SQL 计算，不把行读回 Python。
+    """
+    lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM telemetry").fetchone()
+    if lo is None:
+        return 0
+    sql = (
+        "UPDATE telemetry SET event_ts = CASE "
+        "WHEN ts >= ? AND (server_ts IS NULL OR ts <= server_ts + ?) THEN ts "
+        "ELSE COALESCE(server_ts, ts) END "
+        "WHERE id >= ? AND id < ? AND event_ts IS NULL"
+    )
+    done = 0
+    for start in range(lo, hi + 1, batch_size):
+        with conn:
+            done += conn.execute(sql, (EVENT_TS_MIN, EVENT_TS_MAX_SKEW_SEC, start, start + batch_size)).rowcount
+    return done
+
+
+def _enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    """切换到 auto_vacuum=INCREMENTAL（需要一次完整 VACUUM 才生效；新库上几乎零成本）。"""
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def _create_telemetry_table(conn: sqlite3.Connection) -> bool:
+    """建 telemetry 表及索引（主库与分区文件共用同一份结构）；返回本次是否做了 v3 迁移。"""
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS telemetry (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            ts INTEGER,
+            server_ts INTEGER,
+            seq INTEGER,
+            is_buffered INTEGER DEFAULT 0,
+            event_ts INTEGER,
+            {", ".join(f"{col} {typ}" for _, _, col, typ in _TYPED_FIELDS)},
+            sensor_mask INTEGER,
+            env_json TEXT NOT NULL DEFAULT '{{}}',
+            boot_id TEXT
+        );
+        """
+    )
+    # 旧库（v1）迁移：只加列；历史行的拆分由 backfill_typed_columns() 分批完成
+    _ensure_columns(
+        conn,
+        "telemetry",
+        [(col, typ) for _, _, col, typ in _TYPED_FIELDS]
+        + [("sensor_mask", "INTEGER"), ("event_ts", "INTEGER"), ("boot_id", "TEXT")],
+    )
+    migrated = conn.execute("PRAGMA user_version").fetchone()[0] < 3
+    if migrated:
+        # v2 -> v3：event_ts 由 SQL 直接补算（新建的空表上为空操作）
+        _fill_event_ts(conn)
+    # 时间查询都走 (device_id, 时间列) 索引：索引本身隐含 rowid，范围过滤、排序与 keyset 翻页
+    # （ORDER BY 时间, id）都在索引内完成，只有命中的行才回表取值
+    conn.execute("DROP INDEX IF EXISTS idx_telemetry_device_ts;")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_device_event ON telemetry(device_id, event_ts);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_device_arrival ON telemetry(device_id, server_ts);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_server_ts ON telemetry(server_ts);")
+    # 幂等写入：设备每次上电 seq 从 0 重新计数，所以唯一键是 (device_id, boot_id, seq)。
+    # 部分索引只覆盖带 boot_id 与 seq 的行；v4 之前的历史行 boot_id 都是 NULL，建索引时不会冲突，也不占索引空间
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_telemetry_dedup ON telemetry(device_id, boot_id, seq) "
+        "WHERE boot_id IS NOT NULL AND seq IS NOT NULL;"
+    )
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return migrated
+
+
 def init_db() -> None:
-    conn = _connect()
-    try:
+    with _connect() as conn:
+        is_new = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='telemetry'").fetchone() is None
+        _create_telemetry_table(conn)
+        # 预聚合表：每 (分辨率, 设备, 指标, 桶) 一行，写入时增量 UPSERT
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS telemetry (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE IF NOT EXISTS telemetry_rollup (
+                resolution INTEGER NOT NULL,
                 device_id TEXT NOT NULL,
-                ts INTEGER,
-                server_ts INTEGER,
-                seq INTEGER,
-                is_buffered INTEGER DEFAULT 0,
-                env_json TEXT NOT NULL
-            );
+                metric TEXT NOT NULL,
+                bucket_ts INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                sum REAL NOT NULL,
+                min REAL,
+                max REAL,
+                PRIMARY KEY (resolution, device_id, metric, bucket_ts)
+            ) WITHOUT ROWID;
             """
         )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_device_ts ON telemetry(device_id, ts);")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_server_ts ON telemetry(server_ts);")
+        # 保留期清理按分辨率 + 桶时间删除
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_telemetry_rollup_res_bucket ON telemetry_rollup(resolution, bucket_ts);"
+        )
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
         conn.commit()
-    finally:
-        conn.close()
+        if is_new:
+            # 新库直接启用增量 vacuum；旧库需执行一次 python -m server.db vacuum
+            _enable_incremental_vacuum(conn)
+    # 已有分区文件在启动时一并迁移，避免首次查询时才补算
+    for _, _, path in list_partitions():
+        _ensure_partition(path)
 
 
-def insert_telemetry(record: Dict[str, Any]) -> None:
-    """写入一条 telemetry。
+# ---- 按时间分区（可选）----
+# SLS_DB_PARTITION=day|week 时，原始 telemetry 按时间写入独立的 SQLite 文件
+# （<db>_parts/telemetry_d_YYYYMMDD.db / telemetry_w_YYYYMMDD.db，UTC，周从周一开始）；
+# 主库保留 rollup 与启用分区前的历史行。查询按 since/until 只打开相关分区，
+# 原始数据过期直接删除整个文件。
 
-    record 格式：与 server 广播的 record 对齐（type/device_id/timestamp/environment/...）。
+_PARTITION_SPANS: Dict[str, int] = {"d": 86400, "w": 7 * 86400}
+# 1970-01-05 是周一：周分区按它对齐
+_WEEK_ANCHOR = 4 * 86400
+_PARTITION_RE = re.compile(r"^telemetry_([dw])_(\d{8})\.db$")
+
+_ready_partitions: set = set()
+_ready_lock = threading.Lock()
+
+
+def get_partition_mode() -> str:
+    """none / day / week（环境变量 SLS_DB_PARTITION，默认 none）。"""
+    mode = _env("SLS_DB_PARTITION", "none").strip().lower()
+    return mode if mode in ("day", "week") else "none"
+
+
+def _partition_dir() -> str:
+    return os.path.splitext(get_db_path())[0] + "_parts"
+
+
+def _partition_for(ts: int, mode: str) -> Tuple[int, str]:
+    """返回 ts 所在分区的 (起始时间, 文件路径)。"""
+    kind = mode[0]
+    span = _PARTITION_SPANS[kind]
+    anchor = _WEEK_ANCHOR if kind == "w" else 0
+    start = (ts - anchor) // span * span + anchor
+    name = f"telemetry_{kind}_{time.strftime('%Y%m%d', time.gmtime(start))}.db"
+    return start, os.path.join(_partition_dir(), name)
+
+
+def list_partitions() -> List[Tuple[int, int, str]]:
+    """列出现有分区文件：[(起始, 结束(不含), 路径)]，按起始时间升序。"""
+    d = _partition_dir()
+    out: List[Tuple[int, int, str]] = []
+    try:
+        names = os.listdir(d)
+    except OSError:
+        return out
+    for name in names:
+        m = _PARTITION_RE.match(name)
+        if not m:
+            continue
+        try:
+            start = calendar.timegm(time.strptime(m.group(2), "%Y%m%d"))
+        except ValueError:
+            continue
+        out.append((start, start + _PARTITION_SPANS[m.group(1)], os.path.join(d, name)))
+    out.sort()
+    return out
+
+
+def _partition_range(
+    since_ts: Optional[int], until_ts: Optional[int], time_col: str = "event_ts"
+) -> Tuple[Optional[int], Optional[int]]:
+    """把查询时间范围换算成分区裁剪用的 event_ts 范围。
+
+    分区按 event_ts 划分；按到达时间查询时，event_ts <= server_ts + EVENT_TS_MAX_SKEW_SEC，
+    但补传数据的 event_ts 可以任意早，所以下界不能裁剪。
+    """
+    if time_col == "event_ts":
+        return since_ts, until_ts
+    return None, (until_ts + EVENT_TS_MAX_SKEW_SEC if until_ts is not None else None)
+
+
+def _query_partitions(
+    since_ts: Optional[int], until_ts: Optional[int], time_col: str = "event_ts"
+) -> List[Tuple[int, int, str]]:
+    """与查询时间范围相交的分区（已确保迁移到当前 schema）。"""
+    lo, hi = _partition_range(since_ts, until_ts, time_col)
+    parts = [
+        (start, end, p)
+        for start, end, p in list_partitions()
+        if (lo is None or end > lo) and (hi is None or start <= hi)
+    ]
+    for _, _, p in parts:
+        _ensure_partition(p)
+    return parts
+
+
+def _raw_sources(
+    since_ts: Optional[int] = None,
+    until_ts: Optional[int] = None,
+    newest_first: bool = False,
+    time_col: str = "event_ts",
+) -> List[str]:
+    """查询原始行需要访问的文件：主库（启用分区前的历史行）+ 与时间范围相交的分区（分区裁剪）。"""
+    parts = [p for _, _, p in _query_partitions(since_ts, until_ts, time_col)]
+    if newest_first:
+        parts.reverse()
+    return [get_db_path()] + parts
+
+
+def _ensure_partition(path: str) -> None:
+    if path in _ready_partitions:
+        return
+    with _ready_lock:
+        if path in _ready_partitions:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _connect(path) as conn:
+            migrated = _create_telemetry_table(conn)
+            conn.commit()
+        _ready_partitions.add(path)
+    if migrated:
+        _relocate_partition_rows(path)
+
+
+def _relocate_partition_rows(path: str, batch_size: int = 5000) -> int:
+    """v3 迁移：旧分区按设备 ts 路由，未对时设备的行会落在错误的分区里；
+    把 event_ts 不在本分区范围内的行分批搬到所属分区，返回搬动的行数。"""
+    m = _PARTITION_RE.match(os.path.basename(path))
+    if not m:
+        return 0
+    kind = m.group(1)
+    mode = "day" if kind == "d" else "week"
+    start = calendar.timegm(time.strptime(m.group(2), "%Y%m%d"))
+    end = start + _PARTITION_SPANS[kind]
+    # _ITEM_COLUMNS + boot_id 与 _INSERT_SQL 的列顺序一致
+    select_sql = (
+        f"SELECT id, {_ITEM_COLUMNS}, boot_id FROM telemetry WHERE event_ts < ? OR event_ts >= ? ORDER BY id LIMIT ?"
+    )
+    moved = 0
+    while True:
+        with _connect(path) as conn:
+            rows = conn.execute(select_sql, (start, end, batch_size)).fetchall()
+        if not rows:
+            break
+        by_path: Dict[str, List[Tuple[Any, ...]]] = {}
+        for r in rows:
+            _, target = _partition_for(r["event_ts"], mode)
+            by_path.setdefault(target, []).append(tuple(r)[1:])
+        for target, part_rows in by_path.items():
+            _ensure_partition(target)
+            with _connect(target) as conn:
+                with conn:
+                    conn.executemany(_INSERT_SQL, part_rows)
+        with _connect(path) as conn:
+            with conn:
+                conn.executemany("DELETE FROM telemetry WHERE id = ?", [(r["id"],) for r in rows])
+        moved += len(rows)
+    return moved
+
+
+def _drop_partition(path: str) -> None:
+    with _ready_lock:
+        _ready_partitions.discard(path)
+    _pool.close_path(path)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+def _is_number(v: Any) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _typed_value_ok(value: Any, typ: str) -> bool:
+    if value is None:
+        return True
+    if typ == "REAL":
+        return _is_number(value)
+    if typ == "INTEGER":
+        # float 放进 INTEGER 列会被 SQLite 改写（30.0 -> 30），为保证无损只接受 int
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, str)
+
+
+def split_environment(env: Dict[str, Any]) -> Tuple[List[Any], int, Dict[str, Any]]:
+    """把 environment 拆成（类型化列值, sensor_mask, overflow）。
+
+    只有字段集合与类型都符合预期的传感器才会拆列；其余原样留在 overflow，
+    保证读回时 environment 与写入时一致。
     """
+    values: List[Any] = [None] * len(_TYPED_FIELDS)
+    mask = 0
+    overflow = dict(env)
+
+    for sensor, bit in _SENSOR_BITS.items():
+        data = env.get(sensor)
+        if not isinstance(data, dict):
+            continue
+        fields = [(i, f) for i, f in enumerate(_TYPED_FIELDS) if f[0] == sensor]
+        known = {f[1] for _, f in fields}
+        if not set(data).issubset(known):
+            continue
+        if not all(_typed_value_ok(data.get(f[1]), f[3]) for _, f in fields):
+            continue
+        for i, f in fields:
+            values[i] = data.get(f[1])
+        mask |= bit
+        overflow.pop(sensor, None)
+
+    return values, mask, overflow
+
+
+def _dump_overflow(overflow: Dict[str, Any]) -> str:
+    if not overflow:
+        return "{}"
+    return serialization.dumps(overflow)
+
+
+def _row_environment(r: sqlite3.Row) -> Dict[str, Any]:
+    """从一行还原 environment：类型化列直接取值，只有存在 overflow 时才解析 JSON。"""
+    raw = r["env_json"]
+    mask = r["sensor_mask"]
+    if mask is None:
+        # 旧格式行（尚未 backfill）：env_json 是完整 environment
+        try:
+            return serialization.loads(raw) if raw else {}
+        except Exception:
+            return {}
+
+    env: Dict[str, Any] = {}
+    for sensor, bit in _SENSOR_BITS.items():
+        if mask & bit:
+            env[sensor] = {f[1]: r[f[2]] for f in _TYPED_FIELDS if f[0] == sensor}
+    if raw and raw != "{}":
+        try:
+            env.update(serialization.loads(raw))
+        except Exception:
+            pass
+    return env
+
+
+def _boot_id(value: Any) -> Optional[str]:
+    """设备上报的 boot_id 统一成字符串（int/str 都接受）；缺失或不合法时为 None（该行不参与去重）。"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, str) and 0 < len(value) <= 64:
+        return value
+    return None
+
+
+def _seq(value: Any) -> Optional[int]:
+    return int(value) if _is_number(value) else None
+
+
+def _record_to_row(record: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """把广播用的 record 转成 telemetry 表的一行；device_id 缺失时返回 None。"""
     device_id = (record.get("device_id") or "").strip()
     if not device_id:
-        return
+        return None
 
     ts = record.get("timestamp")
     server_ts = record.get("server_ts")
@@ -87,23 +636,703 @@ def insert_telemetry(record: Dict[str, Any]) -> None:
     env = record.get("environment")
     if not isinstance(env, dict):
         env = {}
+    values, mask, overflow = split_environment(env)
+    ts = int(ts) if _is_number(ts) else None
+    server_ts = int(server_ts) if _is_number(server_ts) else None
 
-    conn = _connect()
-    try:
-        conn.execute(
-            "INSERT INTO telemetry(device_id, ts, server_ts, seq, is_buffered, env_json) VALUES(?,?,?,?,?,?)",
-            (
-                device_id,
-                int(ts) if isinstance(ts, (int, float)) else None,
-                int(server_ts) if isinstance(server_ts, (int, float)) else None,
-                int(seq) if isinstance(seq, (int, float)) else None,
-                int(is_buffered),
-                json.dumps(env, ensure_ascii=False, separators=(",", ":")),
-            ),
+    return (
+        device_id,
+        ts,
+        server_ts,
+        _seq(seq),
+        int(is_buffered),
+        normalize_event_ts(ts, server_ts),
+        *values,
+        mask,
+        _dump_overflow(overflow),
+        _boot_id(record.get("boot_id")),
+    )
+
+
+# OR IGNORE：命中 idx_telemetry_dedup 的重复行静默跳过（重复补发不报错、不重复落库）
+_INSERT_SQL = (
+    "INSERT OR IGNORE INTO telemetry"
+    f"(device_id, ts, server_ts, seq, is_buffered, event_ts, {_TYPED_COLUMNS}, sensor_mask, env_json, boot_id) "
+    f"VALUES({','.join('?' * (9 + len(_TYPED_FIELDS)))})"
+)
+
+
+def backfill_typed_columns(batch_size: int = 1000, max_batches: Optional[int] = None) -> int:
+    """把旧格式行（sensor_mask IS NULL）拆分到类型化列，返回处理的行数。
+
+    按 id 递增分批处理，每批一个短事务，避免长时间持有写锁；可重复执行。
+    """
+    batch_size = max(1, int(batch_size))
+    update_sql = (
+        f"UPDATE telemetry SET {', '.join(f'{col} = ?' for _, _, col, _ in _TYPED_FIELDS)}, "
+        "sensor_mask = ?, env_json = ? WHERE id = ?"
+    )
+    done = 0
+    batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        with _connect() as conn:
+            rows = conn.execute(
+                "SELECT id, env_json FROM telemetry WHERE sensor_mask IS NULL AND id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size),
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for r in rows:
+                try:
+                    env = serialization.loads(r["env_json"]) if r["env_json"] else {}
+                except Exception:
+                    env = None
+                if not isinstance(env, dict):
+                    # 无法解析的历史数据：只打标记，原文保留在 env_json
+                    updates.append((*([None] * len(_TYPED_FIELDS)), 0, r["env_json"] or "{}", r["id"]))
+                    continue
+                values, mask, overflow = split_environment(env)
+                updates.append((*values, mask, _dump_overflow(overflow), r["id"]))
+            with conn:
+                conn.executemany(update_sql, updates)
+        last_id = rows[-1]["id"]
+        done += len(rows)
+        batches += 1
+    return done
+
+
+_ROLLUP_UPSERT_SQL = (
+    "INSERT INTO telemetry_rollup(resolution, device_id, metric, bucket_ts, count, sum, min, max) "
+    "VALUES(?,?,?,?,?,?,?,?) "
+    "ON CONFLICT(resolution, device_id, metric, bucket_ts) DO UPDATE SET "
+    "count = count + excluded.count, sum = sum + excluded.sum, "
+    "min = MIN(min, excluded.min), max = MAX(max, excluded.max)"
+)
+
+
+def _rollup_rows(rows: Iterable[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+    """先在内存里把一批行合并到各分辨率的桶，再一次性 UPSERT（每桶一条语句）。"""
+    acc: Dict[Tuple[int, str, str, int], List[Any]] = {}
+
+    def _add(key: Tuple[int, str, str, int], value: float) -> None:
+        cur = acc.get(key)
+        if cur is None:
+            acc[key] = [1, value, value, value]
+            return
+        cur[0] += 1
+        cur[1] += value
+        if value < cur[2]:
+            cur[2] = value
+        if value > cur[3]:
+            cur[3] = value
+
+    for row in rows:
+        device_id, ts = row[0], row[_ROW_EVENT_TS_INDEX]
+        if ts is None:
+            continue
+        for res in ROLLUP_RESOLUTIONS.values():
+            bucket = ts - ts % res
+            _add((res, device_id, ROLLUP_ROWS_METRIC, bucket), 0.0)
+            for name, idx in _ROW_METRIC_INDEX:
+                v = row[idx]
+                if v is not None:
+                    _add((res, device_id, name, bucket), float(v))
+
+    out = []
+    for (res, device_id, metric, bucket), (cnt, total, vmin, vmax) in acc.items():
+        if metric == ROLLUP_ROWS_METRIC:
+            vmin = vmax = None
+        out.append((res, device_id, metric, bucket, cnt, total, vmin, vmax))
+    return out
+
+
+def _dedup_key(row: Tuple[Any, ...]) -> Optional[Tuple[str, str, int]]:
+    """行的幂等键 (device_id, boot_id, seq)；缺 boot_id 或 seq 时为 None（无法区分重启前后，不去重）。"""
+    boot_id, seq = row[_ROW_BOOT_INDEX], row[_ROW_SEQ_INDEX]
+    if boot_id is None or seq is None:
+        return None
+    return row[0], boot_id, seq
+
+
+class RecentSeqs:
+    """每个 (device_id, boot_id) 最近写入的 seq 窗口（有界环形），在进库前挡掉明显的重复补发。
+
+    - 只记录已提交的行，所以窗口命中一定是库里已有的行
+    - 判重以唯一索引为准：窗口外（或其他进程写入）的重复仍由 INSERT OR IGNORE 兜底
+    - 会话数超过 max_sessions 时淘汰最久未写入的会话
+    """
+
+    def __init__(self, window: int = 512, max_sessions: int = 4096):
+        self.window = max(0, int(window))
+        self.max_sessions = max(1, int(max_sessions))
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[Tuple[str, str], Tuple[deque, set]]" = OrderedDict()
+        self._hits = 0
+
+    def seen(self, device_id: str, boot_id: Optional[str], seq: Optional[int]) -> bool:
+        if not self.window or boot_id is None or seq is None:
+            return False
+        with self._lock:
+            s = self._sessions.get((device_id, boot_id))
+            if s is None or seq not in s[1]:
+                return False
+            self._hits += 1
+            return True
+
+    def filter(self, rows: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+        """去掉窗口内已写入的行。"""
+        if not self.window:
+            return rows
+        out = []
+        with self._lock:
+            for row in rows:
+                key = _dedup_key(row)
+                if key is not None:
+                    s = self._sessions.get(key[:2])
+                    if s is not None and key[2] in s[1]:
+                        self._hits += 1
+                        continue
+                out.append(row)
+        return out
+
+    def add(self, rows: Iterable[Tuple[Any, ...]]) -> None:
+        """记录已提交的行。"""
+        if not self.window:
+            return
+        with self._lock:
+            for row in rows:
+                key = _dedup_key(row)
+                if key is None:
+                    continue
+                s = self._sessions.get(key[:2])
+                if s is None:
+                    s = self._sessions[key[:2]] = (deque(), set())
+                    if len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+                else:
+                    self._sessions.move_to_end(key[:2])
+                order, members = s
+                if key[2] in members:
+                    continue
+                order.append(key[2])
+                members.add(key[2])
+                if len(order) > self.window:
+                    members.discard(order.popleft())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"window": self.window, "sessions": len(self._sessions), "hits": self._hits}
+
+
+_recent = RecentSeqs()
+_ignored = 0
+_ignored_lock = threading.Lock()
+
+
+def configure_dedup(window: int = 512, max_sessions: int = 4096) -> None:
+    """设置内存去重窗口（每个设备会话记住最近 window 个 seq；0 = 关闭，只靠唯一索引）。"""
+    global _recent
+    _recent = RecentSeqs(window=window, max_sessions=max_sessions)
+
+
+def dedup_stats() -> Dict[str, Any]:
+    """hits：内存窗口挡掉的重复；ignored：进库后被唯一索引忽略的重复。"""
+    out = _recent.stats()
+    with _ignored_lock:
+        out["ignored"] = _ignored
+    return out
+
+
+def _insert_rows(conn: sqlite3.Connection, rows: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+    """在调用方的事务里写入原始行（INSERT OR IGNORE），返回实际写入的行（rollup 只累加这些行）。
+
+    常见情况没有重复，total_changes 的增量等于行数，直接返回；有行被忽略时，
+    本事务从第一条 INSERT 起就持有写锁、id 单调递增，所以最新的 n 行正是本次写入的行。
+    """
+    keys = set()
+    unique = []
+    for row in rows:
+        key = _dedup_key(row)
+        if key is not None:
+            if key in keys:
+                continue
+            keys.add(key)
+        unique.append(row)
+
+    before = conn.total_changes
+    conn.executemany(_INSERT_SQL, unique)
+    n = conn.total_changes - before
+    if n == len(unique):
+        return unique
+    written = set()
+    if n > 0:
+        written = {
+            tuple(r)
+            for r in conn.execute("SELECT device_id, boot_id, seq FROM telemetry ORDER BY id DESC LIMIT ?", (n,))
+        }
+    return [row for row in unique if _dedup_key(row) is None or _dedup_key(row) in written]
+
+
+def insert_telemetry_batch(records: Iterable[Dict[str, Any]]) -> int:
+    """在一个事务内批量写入 telemetry（executemany）并增量更新 rollup，返回实际写入条数。
+
+    按 (device_id, boot_id, seq) 幂等：先过内存窗口，再由唯一索引兜底，重复行不落库也不计入 rollup。
+    """
+    global _ignored
+    rows = [r for r in (_record_to_row(rec) for rec in records) if r is not None]
+    rows = _recent.filter(rows)
+    if not rows:
+        return 0
+
+    mode = get_partition_mode()
+    if mode == "none":
+        with _connect() as conn:
+            with conn:
+                written = _insert_rows(conn, rows)
+                if written:
+                    conn.executemany(_ROLLUP_UPSERT_SQL, _rollup_rows(written))
+    else:
+        # 分区模式：原始行按 event_ts 落到各自分区文件，rollup 仍写主库（跨文件不是同一事务）。
+        # 唯一索引只在单个分区文件内生效；未对时设备的 event_ts 取到达时间，跨分区的重复只能靠内存窗口挡住
+        by_path: Dict[str, List[Tuple[Any, ...]]] = {}
+        for row in rows:
+            t = row[_ROW_EVENT_TS_INDEX]
+            _, path = _partition_for(t if t is not None else int(time.time()), mode)
+            by_path.setdefault(path, []).append(row)
+        written = []
+        for path, part_rows in by_path.items():
+            _ensure_partition(path)
+            with _connect(path) as conn:
+                with conn:
+                    written.extend(_insert_rows(conn, part_rows))
+        if written:
+            with _connect() as conn:
+                with conn:
+                    conn.executemany(_ROLLUP_UPSERT_SQL, _rollup_rows(written))
+
+    _recent.add(written)
+    if len(written) < len(rows):
+        with _ignored_lock:
+            _ignored += len(rows) - len(written)
+    return len(written)
+
+
+def rebuild_rollups(device_id: Optional[str] = None, batch_size: int = 5000) -> int:
+    """从原始行重建 rollup（上线前的历史数据 / backfill 之后执行），返回扫描的行数。
+
+    先清空对应 rollup，再按 id 分批读取原始行累加，每批一个短事务。
+    """
+    batch_size = max(1, int(batch_size))
+    select_sql = (
+        f"SELECT id, device_id, ts, server_ts, seq, is_buffered, event_ts, {_TYPED_COLUMNS} FROM telemetry "
+        "WHERE id > ? AND sensor_mask IS NOT NULL"
+    )
+    params_extra: List[Any] = []
+    if device_id:
+        select_sql += " AND device_id = ?"
+        params_extra.append(device_id)
+    select_sql += " ORDER BY id LIMIT ?"
+
+    with _connect() as conn:
+        with conn:
+            if device_id:
+                conn.execute("DELETE FROM telemetry_rollup WHERE device_id = ?", (device_id,))
+            else:
+                conn.execute("DELETE FROM telemetry_rollup")
+
+    done = 0
+    for path in _raw_sources():
+        last_id = 0
+        while True:
+            with _connect(path) as conn:
+                rows = conn.execute(select_sql, (last_id, *params_extra, batch_size)).fetchall()
+            if not rows:
+                break
+            with _connect() as conn:
+                with conn:
+                    conn.executemany(_ROLLUP_UPSERT_SQL, _rollup_rows(tuple(r)[1:] for r in rows))
+            last_id = rows[-1]["id"]
+            done += len(rows)
+    return done
+
+
+def insert_telemetry(record: Dict[str, Any]) -> None:
+    """写入一条 telemetry。
+
+    record 格式：与 server 广播的 record 对齐（type/device_id/timestamp/environment/...）。
+    """
+    insert_telemetry_batch([record])
+
+
+class TelemetryWriter:
+    """write-behind 写线程：有界队列 + 按条数/时间攒批落库。
+
+    - 请求线程只做 submit()（非阻塞入队），不再等待磁盘 commit
+    - 队列满时丢弃新记录并计数（dropped），避免把压力反传给 WS/HTTP 线程
+    - 库被占用（多进程共用一个文件时 busy_timeout 也等不到写锁）不直接丢批次，退避后重试几次（retried）
+    - stop() 会先把队列里剩余的记录写完再退出
+    """
+
+    def __init__(self, max_queue: int = 10000, batch_max: int = 200, flush_interval_ms: int = 200):
+        self.max_queue = max(1, int(max_queue))
+        self.batch_max = max(1, int(batch_max))
+        self.flush_interval_s = max(0.01, int(flush_interval_ms) / 1000.0)
+
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=self.max_queue)
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Any] = {
+            "enqueued": 0,
+            "dropped": 0,
+            "written": 0,
+            "failed": 0,
+            "retried": 0,
+            "batches": 0,
+            "max_depth": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="sls-db-writer", daemon=True)
+        self._thread.start()
+
+    def is_running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive() and not self._stopping.is_set())
+
+    def submit(self, record: Dict[str, Any]) -> bool:
+        """非阻塞入队；队列已满或 writer 已停止时返回 False。"""
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["dropped"] += 1
+            return False
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats["enqueued"] += 1
+            if depth > self._stats["max_depth"]:
+                self._stats["max_depth"] = depth
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """停止写线程：不再接收新记录，剩余队列写完后退出。"""
+        self._stopping.set()
+        t = self._thread
+        if t and t.is_alive():
+            t.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["queue_depth"] = self._queue.qsize()
+        out["queue_max"] = self.max_queue
+        out["running"] = self.is_running()
+        return out
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        try:
+            first = self._queue.get(timeout=self.flush_interval_s)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval_s
+        while len(batch) < self.batch_max:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self._stopping.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            t0 = time.perf_counter()
+            written, failed = self._write(batch)
+            dt_ms = (time.perf_counter() - t0) * 1000.0
+
+            with self._stats_lock:
+                self._stats["written"] += written
+                self._stats["failed"] += failed
+                self._stats["batches"] += 1
+                self._stats["last_batch_size"] = len(batch)
+                self._stats["last_flush_ms"] = round(dt_ms, 3)
+
+    def _write(self, batch: List[Dict[str, Any]]) -> Tuple[int, int]:
+        """写一批，返回 (写入条数, 失败条数)；database is locked 之类的 OperationalError 退避重试。"""
+        delay = 0.1
+        for attempt in range(_WRITE_RETRIES + 1):
+            try:
+                return insert_telemetry_batch(batch), 0
+            except sqlite3.OperationalError:
+                if attempt == _WRITE_RETRIES:
+                    break
+                with self._stats_lock:
+                    self._stats["retried"] += 1
+                time.sleep(delay)
+                delay *= 2
+            except Exception:
+                break
+        return 0, len(batch)
+
+
+_writer: Optional[TelemetryWriter] = None
+_writer_lock = threading.Lock()
+
+
+def start_writer(max_queue: int = 10000, batch_max: int = 200, flush_interval_ms: int = 200) -> TelemetryWriter:
+    """启动（或返回已启动的）全局 write-behind 写线程。"""
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_running():
+            _writer = TelemetryWriter(max_queue=max_queue, batch_max=batch_max, flush_interval_ms=flush_interval_ms)
+            _writer.start()
+        return _writer
+
+
+def stop_writer(timeout: float = 5.0) -> None:
+    """停止全局写线程并排空队列（进程退出时调用）。"""
+    global _writer
+    with _writer_lock:
+        w, _writer = _writer, None
+    if w:
+        w.stop(timeout)
+
+
+def submit_telemetry(record: Dict[str, Any]) -> bool:
+    """异步写入入口：写线程可用时入队，否则退回同步写入。"""
+    # 明显的重复补发（最近刚写过）：直接确认，不占写队列
+    if _recent.seen((record.get("device_id") or "").strip(), _boot_id(record.get("boot_id")), _seq(record.get("seq"))):
+        return True
+    w = _writer
+    if w is not None and w.is_running():
+        return w.submit(record)
+    insert_telemetry(record)
+    return True
+
+
+def writer_running() -> bool:
+    """写线程是否在运行；不在运行时 submit_telemetry 会退回同步写入（在调用线程里等 commit）。"""
+    w = _writer
+    return bool(w and w.is_running())
+
+
+def writer_stats() -> Optional[Dict[str, Any]]:
+    w = _writer
+    return w.stats() if w else None
+
+
+def _delete_in_batches(
+    sql: str,
+    params: Tuple[Any, ...],
+    batch_size: int,
+    pause_s: float,
+    stop: threading.Event,
+    path: Optional[str] = None,
+) -> int:
+    """反复执行“删一小批”的语句直到删完；每批一个短事务，批间让出写锁。"""
+    total = 0
+    while not stop.is_set():
+        with _connect(path) as conn:
+            with conn:
+                n = conn.execute(sql, (*params, batch_size)).rowcount
+        total += max(0, n)
+        if n < batch_size:
+            break
+        if pause_s > 0:
+            stop.wait(pause_s)
+    return total
+
+
+def purge_expired(
+    retention_days: Dict[str, int],
+    batch_size: int = 2000,
+    pause_ms: int = 50,
+    vacuum_pages: int = 1000,
+    now_ts: Optional[int] = None,
+    stop: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    """按保留期删除过期数据，并做增量 vacuum。
+
+    retention_days：{"raw": 7, "1m": 30, "1h": 365, "1d": 0}，<=0 表示永久保留。
+    raw 按到达时间（server_ts）判断；rollup 按桶时间判断。
+    分区模式下，整个时间段都已过期的分区文件直接删除（raw_partitions 为删除的文件数）。
+    """
+    now_ts = int(now_ts if now_ts is not None else time.time())
+    stop = stop or threading.Event()
+    batch_size = max(1, int(batch_size))
+    pause_s = max(0, int(pause_ms)) / 1000.0
+    deleted: Dict[str, int] = {}
+
+    days = int(retention_days.get("raw") or 0)
+    if days > 0:
+        deleted["raw"] = _delete_in_batches(
+            "DELETE FROM telemetry WHERE id IN ("
+            "SELECT id FROM telemetry WHERE server_ts < ? ORDER BY server_ts LIMIT ?)",
+            (now_ts - days * 86400,),
+            batch_size,
+            pause_s,
+            stop,
         )
-        conn.commit()
-    finally:
-        conn.close()
+        dropped = 0
+        for _, end, path in list_partitions():
+            if end <= now_ts - days * 86400:
+                _drop_partition(path)
+                dropped += 1
+        if dropped:
+            deleted["raw_partitions"] = dropped
+
+    for name, res in ROLLUP_RESOLUTIONS.items():
+        days = int(retention_days.get(name) or 0)
+        if days <= 0:
+            continue
+        deleted[name] = _delete_in_batches(
+            "DELETE FROM telemetry_rollup WHERE (resolution, device_id, metric, bucket_ts) IN ("
+            "SELECT resolution, device_id, metric, bucket_ts FROM telemetry_rollup "
+            "WHERE resolution = ? AND bucket_ts < ? LIMIT ?)",
+            (res, now_ts - days * 86400),
+            batch_size,
+            pause_s,
+            stop,
+        )
+
+    freed = 0
+    if any(deleted.values()) and vacuum_pages > 0 and not stop.is_set():
+        with _connect() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                # execute() 只会 step 一次（只回收 1 页），executescript 才会执行到底
+                conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)});")
+                after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                freed = max(0, before - after)
+
+    return {"deleted": deleted, "vacuumed_pages": freed, "ts": now_ts}
+
+
+class RetentionWorker:
+    """后台保留期任务：每 interval 秒执行一次 purge_expired()。"""
+
+    def __init__(
+        self,
+        retention_days: Dict[str, int],
+        interval_sec: int = 600,
+        batch_size: int = 2000,
+        pause_ms: int = 50,
+        vacuum_pages: int = 1000,
+    ):
+        self.retention_days = dict(retention_days)
+        self.interval_sec = max(1, int(interval_sec))
+        self.batch_size = batch_size
+        self.pause_ms = pause_ms
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats: Dict[str, Any] = {"runs": 0, "errors": 0, "deleted_total": {}, "last": None, "last_error": None}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sls-db-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        t = self._thread
+        if t and t.is_alive():
+            t.join(timeout)
+
+    def run_once(self) -> Dict[str, Any]:
+        result = purge_expired(
+            self.retention_days,
+            batch_size=self.batch_size,
+            pause_ms=self.pause_ms,
+            vacuum_pages=self.vacuum_pages,
+            stop=self._stop,
+        )
+        totals = self._stats["deleted_total"]
+        for k, v in result["deleted"].items():
+            totals[k] = totals.get(k, 0) + v
+        self._stats["runs"] += 1
+        self._stats["last"] = result
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        out = dict(self._stats)
+        out["deleted_total"] = dict(self._stats["deleted_total"])
+        out["retention_days"] = dict(self.retention_days)
+        return out
+
+    def _run(self) -> None:
+        # 启动后先等一个周期，避免与启动期的迁移/回放抢写锁
+        while not self._stop.wait(self.interval_sec):
+            try:
+                self.run_once()
+            except Exception as exc:
+                self._stats["errors"] += 1
+                self._stats["last_error"] = str(exc)
+
+
+_retention: Optional[RetentionWorker] = None
+
+
+def start_retention(retention_days: Dict[str, int], **kwargs: Any) -> Optional[RetentionWorker]:
+    """启动保留期后台任务；所有分辨率都是永久保留时不启动。"""
+    global _retention
+    if not any(int(v or 0) > 0 for v in retention_days.values()):
+        return None
+    stop_retention()
+    _retention = RetentionWorker(retention_days, **kwargs)
+    _retention.start()
+    return _retention
+
+
+def stop_retention(timeout: float = 5.0) -> None:
+    global _retention
+    r, _retention = _retention, None
+    if r:
+        r.stop(timeout)
+
+
+def retention_stats() -> Optional[Dict[str, Any]]:
+    r = _retention
+    return r.stats() if r else None
+
+
+# 还原 item 需要的列（_row_to_item）
+_ITEM_COLUMNS = f"device_id, ts, server_ts, seq, is_buffered, event_ts, {_TYPED_COLUMNS}, sensor_mask, env_json"
+
+
+def _row_to_item(r: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "type": "telemetry",
+        "device_id": r["device_id"],
+        "seq": r["seq"],
+        "timestamp": r["ts"],
+        "environment": _row_environment(r),
+        "is_buffered": bool(r["is_buffered"]),
+        "server_ts": r["server_ts"],
+        "event_ts": r["event_ts"],
+    }
 
 
 def query_telemetry(
@@ -111,57 +1340,456 @@ def query_telemetry(
     since_ts: Optional[int] = None,
     until_ts: Optional[int] = None,
     limit: int = 200,
+    time_field: str = "event",
 ) -> List[Dict[str, Any]]:
-    """按设备查询 telemetry 历史（默认返回最近 limit 条，按时间升序）。"""
+    """按设备查询 telemetry 历史（默认返回最近 limit 条，按时间升序）。
+
+    time_field：event（默认，按 event_ts）或 arrival（按 server_ts）。
+    """
     device_id = (device_id or "").strip()
     if not device_id:
         return []
 
+    tcol = _time_column(time_field)
     limit = max(1, min(int(limit or 200), 2000))
 
     where = ["device_id = ?"]
     params: List[Any] = [device_id]
 
     if since_ts is not None:
-        where.append("ts >= ?")
+        where.append(f"{tcol} >= ?")
         params.append(int(since_ts))
     if until_ts is not None:
-        where.append("ts <= ?")
+        where.append(f"{tcol} <= ?")
         params.append(int(until_ts))
 
     sql = (
-        "SELECT device_id, ts, server_ts, seq, is_buffered, env_json "
+        f"SELECT id, {_ITEM_COLUMNS} "
         "FROM telemetry "
         f"WHERE {' AND '.join(where)} "
-        "ORDER BY ts DESC, id DESC "
+        f"ORDER BY {tcol} DESC, id DESC "
         "LIMIT ?"
     )
     params.append(limit)
 
-    conn = _connect()
-    try:
-        rows = conn.execute(sql, params).fetchall()
-    finally:
-        conn.close()
+    sources = _raw_sources(since_ts, until_ts, newest_first=True, time_col=tcol)
+    rows: List[sqlite3.Row] = []
+    from_parts = 0
+    for i, path in enumerate(sources):
+        with _connect(path) as conn:
+            got = conn.execute(sql, params).fetchall()
+        rows.extend(got)
+        if i > 0 and tcol == "event_ts":
+            # 分区按 event_ts 倒序访问：已拿够 limit 条后，更早的分区不可能再进入结果
+            from_parts += len(got)
+            if from_parts >= limit:
+                break
+    if len(sources) > 1:
+        rows.sort(key=lambda r: (r[tcol] is not None, r[tcol] or 0, r["id"]), reverse=True)
+        rows = rows[:limit]
 
-    items: List[Dict[str, Any]] = []
-    for r in rows:
-        try:
-            env = json.loads(r["env_json"]) if r["env_json"] else {}
-        except Exception:
-            env = {}
-        items.append(
-            {
-                "type": "telemetry",
-                "device_id": r["device_id"],
-                "seq": r["seq"],
-                "timestamp": r["ts"],
-                "environment": env,
-                "is_buffered": bool(r["is_buffered"]),
-                "server_ts": r["server_ts"],
-            }
-        )
+    items = [_row_to_item(r) for r in rows]
 
     # 反转为时间升序，利于前端画曲线
     items.reverse()
     return items
+
+
+# 单次多设备查询的上限：设备数与总行数
+MAX_MULTI_DEVICES = 200
+MAX_MULTI_ROWS = 20000
+
+
+def query_telemetry_multi(
+    device_ids: Iterable[str],
+    since_ts: Optional[int] = None,
+    until_ts: Optional[int] = None,
+    limit: int = 200,
+    time_field: str = "event",
+) -> Dict[str, List[Dict[str, Any]]]:
+    """一次 SQL 查询多个设备的历史：每个设备最近 limit 条（时间升序），按设备分组返回。
+
+    用 ROW_NUMBER() OVER (PARTITION BY device_id ...) 在一条语句里做“每组取前 N”，
+    每个设备走 (device_id, 时间列) 索引的一段倒序扫描。
+    """
+    ids = []
+    for d in device_ids:
+        d = (d or "").strip()
+        if d and d not in ids:
+            ids.append(d)
+    if not ids:
+        return {}
+    if len(ids) > MAX_MULTI_DEVICES:
+        raise ValueError("too_many_devices")
+
+    tcol = _time_column(time_field)
+    limit = max(1, min(int(limit or 200), 2000, MAX_MULTI_ROWS // len(ids)))
+
+    where = [f"device_id IN ({','.join('?' * len(ids))})"]
+    params: List[Any] = list(ids)
+    if since_ts is not None:
+        where.append(f"{tcol} >= ?")
+        params.append(int(since_ts))
+    if until_ts is not None:
+        where.append(f"{tcol} <= ?")
+        params.append(int(until_ts))
+    sql = (
+        f"SELECT * FROM ("
+        f"SELECT id, {_ITEM_COLUMNS}, "
+        f"ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY {tcol} DESC, id DESC) AS rn "
+        f"FROM telemetry WHERE {' AND '.join(where)}"
+        ") WHERE rn <= ?"
+    )
+    params.append(limit)
+
+    grouped: Dict[str, List[sqlite3.Row]] = {d: [] for d in ids}
+    sources = _raw_sources(since_ts, until_ts, newest_first=True, time_col=tcol)
+    for path in sources:
+        with _connect(path) as conn:
+            for r in conn.execute(sql, params):
+                grouped[r["device_id"]].append(r)
+
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    for d, rows in grouped.items():
+        rows.sort(key=lambda r: (r[tcol] is not None, r[tcol] or 0, r["id"]))
+        out[d] = [_row_to_item(r) for r in rows[-limit:]]
+    return out
+
+
+def _encode_cursor(ts: int, src: int, row_id: int, time_col: str = "event_ts") -> str:
+    raw = serialization.dumps_bytes([ts, src, row_id, time_col])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, time_col: str = "event_ts") -> Tuple[int, int, int]:
+    """解码游标；游标必须与本次查询的时间口径一致（不同口径的排序键不可比）。"""
+    try:
+        pad = "=" * (-len(cursor) % 4)
+        ts, src, row_id, col = serialization.loads(base64.urlsafe_b64decode(cursor + pad))
+        ok = col == time_col
+        out = int(ts), int(src), int(row_id)
+    except Exception:
+        raise ValueError("invalid_cursor")
+    if not ok:
+        raise ValueError("invalid_cursor")
+    return out
+
+
+def query_telemetry_page(
+    device_id: str,
+    since_ts: Optional[int] = None,
+    until_ts: Optional[int] = None,
+    limit: int = 200,
+    cursor: Optional[str] = None,
+    time_field: str = "event",
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """按 (device_id, 时间列, id) 做 keyset 分页，时间升序；返回 (items, next_cursor)。
+
+    不用 OFFSET：每页都从上一页最后一行之后开始走索引，翻到多深代价都一样。
+    分区模式下排序键为 (时间, 分区起始时间, id)，游标里带上分区信息；时间为空的行不参与分页。
+    time_field：event（默认，event_ts）或 arrival（server_ts），游标只能在同一口径下续翻。
+    next_cursor 为 None 表示已经到底。
+    """
+    device_id = (device_id or "").strip()
+    if not device_id:
+        return [], None
+    tcol = _time_column(time_field)
+    limit = max(1, min(int(limit or 200), 2000))
+    after = _decode_cursor(cursor, tcol) if cursor else None
+
+    base_where = ["device_id = ?", f"{tcol} IS NOT NULL"]
+    base_params: List[Any] = [device_id]
+    if since_ts is not None:
+        base_where.append(f"{tcol} >= ?")
+        base_params.append(int(since_ts))
+    if until_ts is not None:
+        base_where.append(f"{tcol} <= ?")
+        base_params.append(int(until_ts))
+    select = f"SELECT id, {_ITEM_COLUMNS} FROM telemetry"
+
+    lo = after[0] if after else since_ts
+    sources = [(0, get_db_path())] + [(start, p) for start, _, p in _query_partitions(lo, until_ts, tcol)]
+
+    merged: List[Tuple[Tuple[int, int, int], sqlite3.Row]] = []
+    from_parts = 0
+    for src, path in sources:
+        where = list(base_where)
+        params = list(base_params)
+        if after:
+            a_ts, a_src, a_id = after
+            if src < a_src:
+                where.append(f"{tcol} > ?")
+                params.append(a_ts)
+            elif src == a_src:
+                where.append(f"({tcol} > ? OR ({tcol} = ? AND id > ?))")
+                params.extend([a_ts, a_ts, a_id])
+            else:
+                where.append(f"{tcol} >= ?")
+                params.append(a_ts)
+        sql = f"{select} WHERE {' AND '.join(where)} ORDER BY {tcol}, id LIMIT ?"
+        with _connect(path) as conn:
+            got = conn.execute(sql, (*params, limit + 1)).fetchall()
+        merged.extend(((r[tcol], src, r["id"]), r) for r in got)
+        if src and tcol == "event_ts":
+            # 分区按 event_ts 正序访问：拿够之后更晚的分区不可能排在前面
+            from_parts += len(got)
+            if from_parts > limit:
+                break
+
+    if len(sources) > 1:
+        merged.sort(key=lambda x: x[0])
+    page = merged[:limit]
+    items = [_row_to_item(r) for _, r in page]
+    next_cursor = _encode_cursor(*page[-1][0], tcol) if len(merged) > limit and page else None
+    return items, next_cursor
+
+
+def iter_telemetry(
+    device_id: str,
+    since_ts: Optional[int] = None,
+    until_ts: Optional[int] = None,
+    page_size: int = 1000,
+    time_field: str = "event",
+) -> Iterator[Dict[str, Any]]:
+    """按时间升序逐条产出 telemetry（内部按 keyset 分页，内存占用与总行数无关）。
+
+    每页单独借还连接，不会在导出期间长时间占用连接或持有读事务。
+    """
+    cursor: Optional[str] = None
+    while True:
+        items, cursor = query_telemetry_page(
+            device_id, since_ts, until_ts, limit=page_size, cursor=cursor, time_field=time_field
+        )
+        yield from items
+        if not cursor:
+            return
+
+
+def _resolve_metrics(metrics: Optional[Iterable[str]]) -> List[str]:
+    if not metrics:
+        return list(METRICS)
+    out = [m for m in metrics if m in METRICS]
+    if not out:
+        raise ValueError("unknown_metrics")
+    return out
+
+
+def aggregate_telemetry(
+    device_id: str,
+    since_ts: int,
+    until_ts: int,
+    bucket_sec: int,
+    metrics: Optional[Iterable[str]] = None,
+    use_rollup: bool = True,
+    time_field: str = "event",
+) -> Dict[str, Any]:
+    """按固定桶宽聚合（SQL GROUP BY），每桶每指标返回 min/max/avg/count。
+
+    桶按时间列（默认 event_ts）对齐到 bucket_sec 的整数倍；桶数超过 MAX_AGGREGATE_BUCKETS 时自动放大桶宽。
+    桶宽是某个 rollup 分辨率的整数倍时直接读 rollup 表（rollup 按 event_ts 分桶，arrival 口径总是扫原始行）。
+    只统计已拆到类型化列的行（旧格式行需先 backfill）。
+    """
+    names = _resolve_metrics(metrics)
+    tcol = _time_column(time_field)
+    since_ts, until_ts = int(since_ts), int(until_ts)
+    bucket_sec = max(1, int(bucket_sec))
+    span = max(0, until_ts - since_ts)
+    if span // bucket_sec + 1 > MAX_AGGREGATE_BUCKETS:
+        bucket_sec = span // (MAX_AGGREGATE_BUCKETS - 1) + 1
+
+    if use_rollup and tcol == "event_ts":
+        res = _pick_rollup_resolution(bucket_sec)
+        if res is not None:
+            return aggregate_rollup(device_id, since_ts, until_ts, res, bucket_sec=bucket_sec, metrics=names)
+
+    cols = []
+    for name in names:
+        col = METRICS[name]
+        cols.append(f"MIN({col}), MAX({col}), SUM({col}), COUNT({col})")
+    sql = (
+        f"SELECT ({tcol} / ?) * ? AS bucket, COUNT(*) AS n, {', '.join(cols)} "
+        f"FROM telemetry WHERE device_id = ? AND {tcol} >= ? AND {tcol} <= ? "
+        "GROUP BY bucket ORDER BY bucket"
+    )
+    # 各文件（主库 + 相关分区）分别 GROUP BY，再按桶合并 min/max/sum/count
+    merged: Dict[int, List[Any]] = {}
+    for path in _raw_sources(since_ts, until_ts, time_col=tcol):
+        with _connect(path) as conn:
+            rows = conn.execute(sql, (bucket_sec, bucket_sec, device_id, since_ts, until_ts)).fetchall()
+        for r in rows:
+            cur = merged.get(r[0])
+            if cur is None:
+                merged[r[0]] = list(r[1:])
+                continue
+            cur[0] += r[1]
+            for i in range(len(names)):
+                base = 1 + i * 4
+                vmin, vmax, total, cnt = r[base + 1 : base + 5]
+                if vmin is not None and (cur[base] is None or vmin < cur[base]):
+                    cur[base] = vmin
+                if vmax is not None and (cur[base + 1] is None or vmax > cur[base + 1]):
+                    cur[base + 1] = vmax
+                if total is not None:
+                    cur[base + 2] = total if cur[base + 2] is None else cur[base + 2] + total
+                cur[base + 3] += cnt
+
+    buckets: List[Dict[str, Any]] = []
+    for bucket in sorted(merged):
+        r = merged[bucket]
+        item: Dict[str, Any] = {"ts": bucket, "count": r[0]}
+        for i, name in enumerate(names):
+            base = 1 + i * 4
+            cnt = r[base + 3]
+            avg = (r[base + 2] / cnt) if cnt else None
+            item[name] = {"min": r[base], "max": r[base + 1], "avg": avg, "count": cnt}
+        buckets.append(item)
+    return {"bucket": bucket_sec, "metrics": names, "buckets": buckets, "source": "raw"}
+
+
+def _pick_rollup_resolution(bucket_sec: int) -> Optional[int]:
+    """能整除桶宽的最粗 rollup 分辨率（用于把聚合请求转到 rollup 表）。"""
+    best = None
+    for res in ROLLUP_RESOLUTIONS.values():
+        if bucket_sec % res == 0:
+            best = res
+    return best
+
+
+def aggregate_rollup(
+    device_id: str,
+    since_ts: int,
+    until_ts: int,
+    resolution: int,
+    bucket_sec: Optional[int] = None,
+    metrics: Optional[Iterable[str]] = None,
+) -> Dict[str, Any]:
+    """从 rollup 表聚合（不扫原始行）。bucket_sec 须为 resolution 的整数倍，默认等于 resolution。
+
+    边界按 resolution 对齐：since/until 所在的桶整体计入。
+    """
+    names = _resolve_metrics(metrics)
+    resolution = int(resolution)
+    bucket_sec = int(bucket_sec or resolution)
+    lo = int(since_ts) - int(since_ts) % resolution
+    hi = int(until_ts)
+
+    sql = (
+        "SELECT (bucket_ts / ?) * ? AS bucket, metric, SUM(count), SUM(sum), MIN(min), MAX(max) "
+        "FROM telemetry_rollup WHERE resolution = ? AND device_id = ? AND bucket_ts >= ? AND bucket_ts <= ? "
+        f"AND metric IN ({','.join('?' * (len(names) + 1))}) "
+        "GROUP BY bucket, metric ORDER BY bucket"
+    )
+    params = [bucket_sec, bucket_sec, resolution, device_id, lo, hi, ROLLUP_ROWS_METRIC, *names]
+    with _connect() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    by_bucket: Dict[int, Dict[str, Any]] = {}
+    for bucket, metric, cnt, total, vmin, vmax in rows:
+        item = by_bucket.get(bucket)
+        if item is None:
+            item = {"ts": bucket, "count": 0}
+            for name in names:
+                item[name] = {"min": None, "max": None, "avg": None, "count": 0}
+            by_bucket[bucket] = item
+        if metric == ROLLUP_ROWS_METRIC:
+            item["count"] = cnt
+        else:
+            item[metric] = {"min": vmin, "max": vmax, "avg": (total / cnt) if cnt else None, "count": cnt}
+    buckets = [by_bucket[k] for k in sorted(by_bucket)]
+    return {"bucket": bucket_sec, "metrics": names, "buckets": buckets, "source": "rollup"}
+
+
+def estimate_row_count(device_id: str, since_ts: int, until_ts: int) -> int:
+    """用最粗的 rollup 估算时间范围内的原始行数（按天对齐，偏大估计）。"""
+    res = max(ROLLUP_RESOLUTIONS.values())
+    lo = int(since_ts) - int(since_ts) % res
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM telemetry_rollup "
+            "WHERE resolution = ? AND device_id = ? AND metric = ? AND bucket_ts >= ? AND bucket_ts <= ?",
+            (res, device_id, ROLLUP_ROWS_METRIC, lo, int(until_ts)),
+        ).fetchone()
+    return int(row[0] or 0)
+
+
+def choose_resolution(device_id: str, since_ts: int, until_ts: int, max_points: int) -> Optional[str]:
+    """在点数预算内选择分辨率：原始行数不超预算返回 None（直接查原始行），
+    否则返回桶数不超预算的最细 rollup；都超出时返回最粗的一档。"""
+    max_points = max(1, int(max_points))
+    if estimate_row_count(device_id, since_ts, until_ts) <= max_points:
+        return None
+    span = max(0, int(until_ts) - int(since_ts))
+    for name, res in ROLLUP_RESOLUTIONS.items():
+        if span // res + 1 <= max_points:
+            return name
+    return list(ROLLUP_RESOLUTIONS)[-1]
+
+
+def query_metric_points(
+    device_id: str,
+    since_ts: int,
+    until_ts: int,
+    metrics: Optional[Iterable[str]] = None,
+    time_field: str = "event",
+) -> Dict[str, List[Tuple[int, float]]]:
+    """取时间范围内各指标的原始点 (ts, value)，按时间升序（供 LTTB 降采样）。"""
+    names = _resolve_metrics(metrics)
+    tcol = _time_column(time_field)
+    cols = ", ".join(METRICS[n] for n in names)
+    sql = (
+        f"SELECT {tcol}, {cols} FROM telemetry "
+        f"WHERE device_id = ? AND {tcol} >= ? AND {tcol} <= ? ORDER BY {tcol}, id"
+    )
+    out: Dict[str, List[Tuple[int, float]]] = {n: [] for n in names}
+    sources = _raw_sources(since_ts, until_ts, time_col=tcol)
+    for path in sources:
+        with _connect(path) as conn:
+            for r in conn.execute(sql, (device_id, int(since_ts), int(until_ts))):
+                ts = r[0]
+                for i, name in enumerate(names):
+                    v = r[1 + i]
+                    if v is not None:
+                        out[name].append((ts, v))
+    if len(sources) > 1:
+        # 主库与分区的时间可能交错，合并后重新排序（sort 稳定，同 ts 保持写入顺序）
+        for pts in out.values():
+            pts.sort(key=lambda p: p[0])
+    return out
+
+
+def _main(argv: Optional[List[str]] = None) -> int:
+    """运维入口：python -m server.db <command>"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m server.db", description="SLS SQLite 维护工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("init", help="创建/迁移表结构")
+    p_backfill = sub.add_parser("backfill", help="把旧格式行拆分到类型化列")
+    p_backfill.add_argument("--batch-size", type=int, default=1000)
+    p_rollup = sub.add_parser("rebuild-rollups", help="从原始行重建 1m/1h/1d 预聚合")
+    p_rollup.add_argument("--device-id", default=None)
+    p_purge = sub.add_parser("purge", help="按保留期删除过期数据（天数<=0 表示不删）")
+    for name in ("raw", *ROLLUP_RESOLUTIONS):
+        p_purge.add_argument(f"--{name}-days", type=int, default=0)
+    sub.add_parser("vacuum", help="一次性 VACUUM 并启用增量 vacuum（旧库升级用，期间会锁库）")
+
+    args = parser.parse_args(argv)
+    init_db()
+    if args.command == "backfill":
+        n = backfill_typed_columns(batch_size=args.batch_size)
+        print(f"backfilled rows: {n}")
+    if args.command == "rebuild-rollups":
+        n = rebuild_rollups(device_id=args.device_id)
+        print(f"rolled up rows: {n}")
+    if args.command == "purge":
+        days = {name: getattr(args, f"{name}_days") for name in ("raw", *ROLLUP_RESOLUTIONS)}
+        print(purge_expired(days))
+    if args.command == "vacuum":
+        with _connect() as conn:
+            _enable_incremental_vacuum(conn)
+        print("vacuum done")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_main())
@@ -0,0 +1,119 @@
+"""JSON 后端基准：在 server 实际收发的 telemetry 负载上对比 orjson / ujson / 标准库 json。
+
+场景：
+- decode_frame：解析设备上报的一帧 telemetry（/ws/telemetry 每条消息）
+- encode_ack：编码 ack（每条消息回一次）
+- encode_broadcast：编码推给 dashboard 的 telemetry（每条消息一次，由所有客户端共用）
+- encode_snapshot：编码 N 台设备的 snapshot（dashboard 连接/重连、/api/devices）
+- env_json：overflow 字段的落库编码 + 读回解析（db.py）
+
+依赖：未安装的后端会跳过（pip install orjson ujson 后再跑可看到对比）
+
+运行：
+- 在 ESP32/iot_ai_monitor 目录下：python server/dev/bench_json.py
+
+环境变量：
+- SLS_BENCH_DEVICES (snapshot 设备数，默认 500)
+- SLS_BENCH_SECONDS (每个场景的测量时长，默认 0.5)
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from server.serialization import BACKEND, BACKENDS, load_backend  # noqa: E402
+
+
+def env(name: str, default: str) -> str:
+    v = os.getenv(name)
+    return default if v is None or v == "" else v
+
+
+DEVICES = int(env("SLS_BENCH_DEVICES", "500"))
+SECONDS = float(env("SLS_BENCH_SECONDS", "0.5"))
+
+
+def telemetry(device_id: str, seq: int) -> dict:
+    return {
+        "type": "telemetry",
+        "device_id": device_id,
+        "seq": seq,
+        "timestamp": 1760000000 + seq,
+        "environment": {
+            "bmp280": {"temp": 20.0 + (seq % 5) * 0.37, "pressure": 1013.25 + seq % 7, "status": "ok"},
+            "light": {"raw": 1000 + seq, "voltage": 1.1, "percent": 30},
+            "sht30": {"humidity": 45.6, "temp": 21.3},
+        },
+        "is_buffered": False,
+        "server_ts": 1760000001 + seq,
+        "version": 12345 + seq,
+    }
+
+
+def snapshot(n: int) -> dict:
+    devices = [
+        {
+            "device_id": f"ESP32_{i:04d}",
+            "status": "online",
+            "last_seen": 1760000000 + i,
+            "firmware_version": "1.4.2",
+            "capabilities": {"bmp280": True, "light": True, "config": {"sample_interval": 5}},
+            "version": i,
+        }
+        for i in range(n)
+    ]
+    latest = [telemetry(f"ESP32_{i:04d}", i) for i in range(n)]
+    return {"type": "snapshot", "epoch": "a1b2c3", "version": n, "devices": devices, "latest": latest}
+
+
+def measure(fn) -> float:
+    """每秒次数（跑满 SECONDS 秒）。"""
+    n = 0
+    batch = 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn()
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= SECONDS:
+            return n / elapsed
+        batch = min(batch * 2, 4096)
+
+
+def main() -> None:
+    msg = telemetry("ESP32_SIM_001", 42)
+    ack = {"type": "ack", "seq": 42, "server_ts": 1760000001}
+    snap = snapshot(DEVICES)
+    overflow = {"sht30": msg["environment"]["sht30"]}
+
+    backends = {}
+    for name in BACKENDS:
+        try:
+            backends[name] = load_backend(name)
+        except ImportError:
+            print(f"{name}: 未安装，跳过")
+    frame = backends["json"]["dumps"](msg)
+
+    cases = [
+        ("decode_frame", lambda b: (lambda: b["loads"](frame))),
+        ("encode_ack", lambda b: (lambda: b["dumps"](ack))),
+        ("encode_broadcast", lambda b: (lambda: b["dumps"](msg))),
+        (f"encode_snapshot[{DEVICES}]", lambda b: (lambda: b["dumps"](snap))),
+        ("env_json", lambda b: (lambda: b["loads"](b["dumps"](overflow)))),
+    ]
+
+    names = list(backends)
+    print(f"当前 server 使用：{BACKEND}")
+    print(f"{'case':<24}" + "".join(f"{n:>15}" for n in names) + "   (ops/s，括号内为相对 json 的倍数)")
+    for label, make in cases:
+        rates = {n: measure(make(backends[n])) for n in names}
+        base = rates["json"]
+        cells = "".join(f"{rates[n]:>9.0f}({rates[n] / base:>3.1f}x)" for n in names)
+        print(f"{label:<24}{cells}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,15 +14,21 @@
 - SLS_SIM_URL (默认 ws://127.0.0.1:5000/ws/telemetry)
 - SLS_SIM_DEVICE_ID (默认 ESP32_SIM_001)
 - SLS_SIM_API_KEY (默认 dev_key)
+- SLS_SIM_BINARY (1 = 协商 protocol=2 后用紧凑二进制帧上报，默认 0)
 """
 
 import asyncio
 import json
 import os
+import sys
 import time
 
 import websockets
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from server import codec  # noqa: E402
+
 
 def env(name: str, default: str) -> str:
     v = os.getenv(name)
@@ -32,6 +38,9 @@ def env(name: str, default: str) -> str:
 URL = env("SLS_SIM_URL", "ws://127.0.0.1:5000/ws/telemetry")
 DEVICE_ID = env("SLS_SIM_DEVICE_ID", "ESP32_SIM_001")
 API_KEY = env("SLS_SIM_API_KEY", "dev_key")
+BINARY = env("SLS_SIM_BINARY", "0") == "1"
+# 每次启动一个新的会话号：server 按 (device_id, boot_id, seq) 去重
+BOOT_ID = os.urandom(4).hex()
 
 
 async def main() -> None:
@@ -41,16 +50,18 @@ async def main() -> None:
             "device_id": DEVICE_ID,
             "api_key": API_KEY,
             "firmware_version": "sim-0.1.0",
-            "protocol": 1,
+            "protocol": codec.PROTOCOL if BINARY else 1,
             "capabilities": {"bmp280": True, "light": True},
         }
         await ws.send(json.dumps(hello, ensure_ascii=False))
         print("-> hello")
 
         # 读取 hello_ok / error
+        binary = False
         try:
             msg = await asyncio.wait_for(ws.recv(), timeout=2)
             print("<-", msg)
+            binary = BINARY and json.loads(msg).get("protocol", 1) >= 2
         except Exception as exc:
             print("no hello response:", exc)
 
@@ -61,6 +72,7 @@ async def main() -> None:
                 "type": "telemetry",
                 "device_id": DEVICE_ID,
                 "seq": seq,
+                "boot_id": BOOT_ID,
                 "timestamp": int(time.time()),
                 "environment": {
                     "bmp280": {"temp": 20.0 + (seq % 5), "pressure": 1013.0, "status": "ok"},
@@ -68,8 +80,13 @@ async def main() -> None:
                 },
                 "is_buffered": False,
             }
-            await ws.send(json.dumps(payload, ensure_ascii=False))
-            print("-> telemetry seq=", seq)
+            frame = codec.encode(payload) if binary else None
+            if frame is not None:
+                await ws.send(frame)
+                print("-> telemetry (binary, %d bytes) seq=" % len(frame), seq)
+            else:
+                await ws.send(json.dumps(payload, ensure_ascii=False))
+                print("-> telemetry seq=", seq)
 
             # 期望 ack
             try:
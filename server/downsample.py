@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""曲线降采样（LTTB）。
+
+Largest-Triangle-Three-Buckets：在保留曲线形状（峰谷）的前提下把 N 个点降到 threshold 个，
+用于历史曲线在长时间范围下控制返回点数。纯 Python 实现，不引入 numpy 依赖。
+"""
+
+from __future__ import annotations
+
+from typing import List, Sequence, Tuple
+
+Point = Tuple[float, float]
+
+
+def lttb(points: Sequence[Point], threshold: int) -> List[Point]:
+    """对按 x 升序的 (x, y) 点序列做 LTTB 降采样，返回不超过 threshold 个点。"""
+    n = len(points)
+    if threshold >= n or threshold <= 0:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    out: List[Point] = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # 下一个桶的平均点（作为三角形的第三个顶点）
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        span = avg_end - avg_start
+        avg_x = 0.0
+        avg_y = 0.0
+        for j in range(avg_start, avg_end):
+            avg_x += points[j][0]
+            avg_y += points[j][1]
+        avg_x /= span
+        avg_y /= span
+
+        # 当前桶内选出与 (a, 平均点) 构成最大三角形面积的点
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = points[a]
+        best = start
+        best_area = -1.0
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = j
+        out.append(points[best])
+        a = best
+
+    out.append(points[-1])
+    return out
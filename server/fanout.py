@@ -0,0 +1,546 @@
+"""Dashboard 广播（fan-out）：每个 dashboard 客户端一条有界发送队列 + 独立写线程。
+
+广播方只做“序列化一次 + 逐个入队”（O(1)/客户端，不碰网络），真正的 ws.send
+由各客户端自己的写线程完成；慢客户端只会让自己的队列堆积/丢弃，不会拖慢设备上报。
+
+丢弃策略（队列满时）：
+- drop_oldest：丢掉队列里最旧的一条
+- coalesce_latest：队列满时，若同一设备同类的 telemetry/device_status 还在排队，就把旧的那条作废、
+  新的排到队尾（不挤掉其他消息，也不改变先后顺序）；没有可合并的再丢最旧的一条；命令类事件不合并
+
+订阅：客户端可声明只关心的设备 / 指标 / 消息类型（Subscription）。hub 维护
+device_id -> 订阅者 的索引，广播只触达相关客户端；指标过滤按“指标集合”各序列化一次。
+未订阅过的客户端仍接收全部消息（兼容旧前端）。
+
+限速：订阅带 max_rate_hz 时，telemetry/device_status 不逐条下发，而是每个设备每种消息只保留最新一条，
+由该客户端的写线程每 1/max_rate_hz 秒合并成一条 telemetry_batch 发出（items 里每条保留自己的 type）；
+浏览器收到的帧数只取决于刷新频率，与设备数 × 采样频率无关。
+
+写端有两种：DashboardClient（每连接一个写线程，flask-sock 用）与
+AsyncDashboardClient（事件循环里的一个 task，asyncio 入口用）；队列与策略逻辑共用。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+try:
+    from . import serialization  # type: ignore
+except Exception:
+    import serialization  # type: ignore
+
+DROP_POLICIES = ("drop_oldest", "coalesce_latest")
+
+# dashboard 会收到的消息类型（subscribe.types 的合法取值）
+MESSAGE_TYPES = ("snapshot", "telemetry", "device_status", "command_sent", "command_ack")
+
+# 单个订阅最多声明的设备数 / 指标数
+MAX_SUBSCRIBE_DEVICES = 1000
+MAX_SUBSCRIBE_METRICS = 64
+# max_rate_hz 的上限（更高的刷新率对浏览器没有意义）
+MAX_RATE_HZ = 20.0
+
+# 可按设备合并的消息类型（其余消息每条都要送达）
+_COALESCE_TYPES = ("telemetry", "device_status")
+
+_Key = Optional[Tuple[str, str]]
+
+
+def _dumps(message: Dict[str, Any]) -> str:
+    return serialization.dumps(message)
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """dashboard 订阅条件；各字段为 None 表示不过滤。
+
+    metrics 取值为 "bmp280.temp" 这样的 sensor.field，或 "bmp280" 表示整个传感器；
+    只影响 telemetry 的 environment（其他字段原样保留）。
+    """
+
+    device_ids: Optional[FrozenSet[str]] = None
+    metrics: Optional[FrozenSet[str]] = None
+    types: Optional[FrozenSet[str]] = None
+    # telemetry 的最大推送频率（次/秒）；None 表示逐条实时推送
+    max_rate_hz: Optional[float] = None
+
+    def wants(self, msg_type: Optional[str]) -> bool:
+        return self.types is None or msg_type in self.types
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "device_ids": sorted(self.device_ids) if self.device_ids is not None else None,
+            "metrics": sorted(self.metrics) if self.metrics is not None else None,
+            "types": sorted(self.types) if self.types is not None else None,
+            "max_rate_hz": self.max_rate_hz,
+        }
+
+
+ALL = Subscription()
+
+
+def _str_set(value: Any, name: str, limit: int) -> Optional[FrozenSet[str]]:
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError(f"invalid_{name}")
+    out = frozenset(v.strip() for v in value if v.strip())
+    if len(out) > limit:
+        raise ValueError(f"too_many_{name}")
+    return out
+
+
+def parse_subscription(data: Dict[str, Any]) -> Subscription:
+    """解析 {"type":"subscribe","device_ids":[...],"metrics":[...],"types":[...],"max_rate_hz":2}；
+    字段缺省/为 null 表示全部（不限速）。"""
+    types = _str_set(data.get("types"), "types", len(MESSAGE_TYPES))
+    if types is not None and not types.issubset(MESSAGE_TYPES):
+        raise ValueError("invalid_types")
+    rate = data.get("max_rate_hz")
+    if rate is not None:
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError("invalid_max_rate_hz")
+        rate = min(float(rate), MAX_RATE_HZ)
+    return Subscription(
+        device_ids=_str_set(data.get("device_ids"), "device_ids", MAX_SUBSCRIBE_DEVICES),
+        metrics=_str_set(data.get("metrics"), "metrics", MAX_SUBSCRIBE_METRICS),
+        types=types,
+        max_rate_hz=rate,
+    )
+
+
+def project_metrics(message: Dict[str, Any], metrics: FrozenSet[str]) -> Dict[str, Any]:
+    """按指标集合裁剪 telemetry 的 environment（返回新 dict，不改原消息）。"""
+    env = message.get("environment")
+    if not isinstance(env, dict):
+        return message
+    out: Dict[str, Any] = {}
+    for m in metrics:
+        sensor, _, fld = m.partition(".")
+        data = env.get(sensor)
+        if data is None:
+            continue
+        if not fld or sensor in metrics:
+            out[sensor] = data
+        elif isinstance(data, dict) and fld in data:
+            out.setdefault(sensor, {})[fld] = data[fld]
+    msg = dict(message)
+    msg["environment"] = out
+    return msg
+
+
+def coalesce_key(message: Dict[str, Any]) -> _Key:
+    """消息的合并键：(type, device_id)；不可合并时返回 None。"""
+    msg_type = message.get("type")
+    device_id = message.get("device_id")
+    if msg_type in _COALESCE_TYPES and device_id:
+        return msg_type, str(device_id)
+    return None
+
+
+class DashboardClient:
+    """单个 dashboard 连接的发送端：有界队列 + 写线程（该 ws 只由写线程 send）。"""
+
+    def __init__(
+        self,
+        send: Callable[[str], Any],
+        max_queue: int = 256,
+        policy: str = "coalesce_latest",
+        close: Optional[Callable[[], Any]] = None,
+        on_dead: Optional[Callable[["DashboardClient"], Any]] = None,
+    ):
+        self.max_queue = max(1, int(max_queue))
+        self.policy = policy if policy in DROP_POLICIES else "coalesce_latest"
+        self._send = send
+        self._close = close
+        self._on_dead = on_dead
+
+        # 队列元素是 [key, payload]；合并时旧元素的 payload 置为 None（作废，写线程跳过），新元素排到队尾
+        self._queue: Deque[List[Any]] = deque()
+        self._pending: Dict[Tuple[str, str], List[Any]] = {}  # key -> 队列里该 key 最新的一条
+        self._dead = 0  # 队列里已作废的元素数
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self.subscription: Subscription = ALL
+        # 限速订阅：(type, device_id) -> 最新一条消息的 JSON；到点后合并成一条 telemetry_batch
+        self._batch: Dict[Tuple[str, str], str] = {}
+        self._batch_interval: Optional[float] = None
+        self._next_flush = 0.0
+        self.stats: Dict[str, int] = {
+            "enqueued": 0,
+            "sent": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "max_depth": 0,
+            "batches": 0,
+        }
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def depth(self) -> int:
+        return len(self._queue) - self._dead + len(self._batch)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="sls-dashboard-writer", daemon=True)
+        self._thread.start()
+
+    def _notify(self) -> None:
+        """唤醒写端（调用方持有 self._cond）。"""
+        self._cond.notify()
+
+    def enqueue(self, payload: str, key: _Key = None) -> bool:
+        """非阻塞入队；返回 False 表示客户端已关闭。"""
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._queue) - self._dead >= self.max_queue:
+                entry = self._pending.pop(key, None) if key is not None and self.policy == "coalesce_latest" else None
+                if entry is not None:
+                    # 同设备同类的旧消息作废，新消息排队尾：先后顺序不变，版本号单调
+                    entry[1] = None
+                    self._dead += 1
+                    self.stats["coalesced"] += 1
+                    self._compact()
+                else:
+                    self._drop_oldest()
+            entry = [key, payload]
+            self._queue.append(entry)
+            if key is not None:
+                self._pending[key] = entry
+            self.stats["enqueued"] += 1
+            depth = len(self._queue) - self._dead
+            if depth > self.stats["max_depth"]:
+                self.stats["max_depth"] = depth
+            self._notify()
+        return True
+
+    def _drop_oldest(self) -> None:
+        while self._queue:
+            old = self._queue.popleft()
+            if old[1] is None:
+                self._dead -= 1
+                continue
+            if old[0] is not None and self._pending.get(old[0]) is old:
+                del self._pending[old[0]]
+            self.stats["dropped"] += 1
+            return
+
+    def _compact(self) -> None:
+        # 写端卡住时作废元素会一直堆在队列里：超过上限就整体清理一次（均摊 O(1)）
+        if self._dead > self.max_queue:
+            self._queue = deque(e for e in self._queue if e[1] is not None)
+            self._dead = 0
+
+    def set_rate(self, max_rate_hz: Optional[float]) -> None:
+        """设置 telemetry 限速；取消限速时把已攒的批次立即发出。"""
+        with self._cond:
+            self._batch_interval = (1.0 / max_rate_hz) if max_rate_hz else None
+            self._next_flush = 0.0
+            self._notify()
+
+    def enqueue_latest(self, key: Tuple[str, str], payload: str) -> bool:
+        """限速模式下入队：同一 (type, device_id) 只保留最新一条，等下一个 tick 合并发送。"""
+        with self._cond:
+            if self._closed:
+                return False
+            if key in self._batch:
+                self.stats["coalesced"] += 1
+            elif not self._batch:
+                self._notify()
+            self._batch[key] = payload
+            self.stats["enqueued"] += 1
+        return True
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.clear()
+            self._pending.clear()
+            self._dead = 0
+            self._batch.clear()
+            self._notify()
+
+    def _take_batch(self) -> str:
+        """把攒下的各设备最新消息拼成一条 telemetry_batch（items 已是 JSON，直接拼接）。"""
+        items = ",".join(self._batch.values())
+        self._batch.clear()
+        self._next_flush = time.monotonic() + (self._batch_interval or 0.0)
+        self.stats["batches"] += 1
+        return f'{{"type":"telemetry_batch","server_ts":{int(time.time())},"items":[{items}]}}'
+
+    def _poll(self) -> Tuple[Optional[str], Optional[float]]:
+        """取下一条待发送内容（调用方持有 self._cond）。
+
+        返回 (payload, None)；暂无可发送内容时返回 (None, 最长等待秒数)，None 表示一直等到被唤醒。
+        """
+        while self._queue:
+            entry = self._queue.popleft()
+            key, payload = entry
+            if payload is None:
+                self._dead -= 1
+                continue
+            if key is not None and self._pending.get(key) is entry:
+                del self._pending[key]
+            return payload, None
+        if self._batch:
+            wait = self._next_flush - time.monotonic() if self._batch_interval else 0.0
+            if wait <= 0:
+                return self._take_batch(), None
+            return None, wait
+        return None, None
+
+    def _next(self) -> Optional[str]:
+        with self._cond:
+            while not self._closed:
+                payload, wait = self._poll()
+                if payload is not None:
+                    return payload
+                self._cond.wait(wait)
+            return None
+
+    def _run(self) -> None:
+        while True:
+            payload = self._next()
+            if payload is None:
+                break
+            try:
+                self._send(payload)
+                self.stats["sent"] += 1
+            except Exception:
+                break
+        # 发送失败或被 hub 移除（close_all 等）：都要关掉连接，读线程随之退出、前端重连；
+        # 只停写线程而不关连接，浏览器会一直连着却再也收不到消息
+        self.close()
+        if self._close:
+            try:
+                self._close()
+            except Exception:
+                pass
+        if self._on_dead:
+            self._on_dead(self)
+
+
+class AsyncDashboardClient(DashboardClient):
+    """asyncio 版写端：发送由事件循环里的一个 task 完成，不占线程。
+
+    enqueue() 仍可在任意线程调用（REST 线程池里的 HTTP 上报也会广播），
+    通过 call_soon_threadsafe 唤醒 task。
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[Any]],
+        loop: asyncio.AbstractEventLoop,
+        max_queue: int = 256,
+        policy: str = "coalesce_latest",
+        close: Optional[Callable[[], Awaitable[Any]]] = None,
+        on_dead: Optional[Callable[["DashboardClient"], Any]] = None,
+    ):
+        super().__init__(send, max_queue, policy, close=close, on_dead=on_dead)
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        # 需在事件循环线程内调用
+        self._task = self._loop.create_task(self._run_async())
+
+    def _notify(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # 事件循环已关闭（进程退出中）
+            pass
+
+    async def _run_async(self) -> None:
+        while True:
+            with self._cond:
+                if self._closed:
+                    break
+                payload, wait = self._poll()
+                if payload is None:
+                    self._wakeup.clear()
+            if payload is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._send(payload)
+                self.stats["sent"] += 1
+            except Exception:
+                break
+        self.close()
+        if self._close:
+            try:
+                await self._close()
+            except Exception:
+                pass
+        if self._on_dead:
+            self._on_dead(self)
+
+    async def wait_closed(self, timeout: float = 1.0) -> None:
+        """等发送 task 退出（已发出 websocket.close）；lifespan 关闭时用，最多等 timeout 秒。"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except Exception:
+            pass
+
+
+class DashboardHub:
+    """dashboard 客户端集合 + 订阅索引；broadcast() 每种输出只序列化一次并入队，不做网络 IO。"""
+
+    def __init__(
+        self,
+        max_queue: int = 256,
+        policy: str = "coalesce_latest",
+        dumps: Callable[[Dict[str, Any]], str] = _dumps,
+    ):
+        self.max_queue = max(1, int(max_queue))
+        self.policy = policy if policy in DROP_POLICIES else "coalesce_latest"
+        self._dumps = dumps
+        self._clients: Dict[int, DashboardClient] = {}
+        # 订阅索引：不限设备的客户端 + device_id -> 订阅了该设备的客户端
+        self._wildcard: Set[int] = set()
+        self._by_device: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"broadcasts": 0, "connected_total": 0, "deliveries": 0, "encodes": 0}
+        # 已断开客户端的累计计数，断开后并入 hub 统计
+        self._retired: Dict[str, int] = {"sent": 0, "dropped": 0, "coalesced": 0, "batches": 0}
+
+    def add(self, send: Callable[[str], Any], close: Optional[Callable[[], Any]] = None) -> DashboardClient:
+        """登记一个线程写端的客户端（send 为阻塞发送函数）。"""
+        return self._attach(DashboardClient(send, self.max_queue, self.policy, close=close, on_dead=self.remove))
+
+    def add_async(
+        self,
+        send: Callable[[str], Awaitable[Any]],
+        loop: asyncio.AbstractEventLoop,
+        close: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> DashboardClient:
+        """登记一个 asyncio 写端的客户端（send / close 为协程函数；需在事件循环线程内调用）。"""
+        return self._attach(AsyncDashboardClient(send, loop, self.max_queue, self.policy, close=close, on_dead=self.remove))
+
+    def _attach(self, client: DashboardClient) -> DashboardClient:
+        with self._lock:
+            self._clients[id(client)] = client
+            self._wildcard.add(id(client))
+            self._stats["connected_total"] += 1
+        client.start()
+        return client
+
+    def _unindex(self, cid: int, sub: Subscription) -> None:
+        if sub.device_ids is None:
+            self._wildcard.discard(cid)
+            return
+        for d in sub.device_ids:
+            ids = self._by_device.get(d)
+            if ids is not None:
+                ids.discard(cid)
+                if not ids:
+                    del self._by_device[d]
+
+    def remove(self, client: DashboardClient) -> None:
+        with self._lock:
+            if self._clients.pop(id(client), None) is None:
+                return
+            self._unindex(id(client), client.subscription)
+            for k in self._retired:
+                self._retired[k] += client.stats[k]
+        client.close()
+
+    def subscribe(self, client: DashboardClient, sub: Subscription) -> None:
+        """替换客户端的订阅（整体替换，不做增量合并）。"""
+        cid = id(client)
+        with self._lock:
+            if cid not in self._clients:
+                return
+            self._unindex(cid, client.subscription)
+            client.subscription = sub
+            client.set_rate(sub.max_rate_hz)
+            if sub.device_ids is None:
+                self._wildcard.add(cid)
+            else:
+                for d in sub.device_ids:
+                    self._by_device.setdefault(d, set()).add(cid)
+
+    def clients(self) -> List[DashboardClient]:
+        with self._lock:
+            return list(self._clients.values())
+
+    def _targets(self, device_id: Optional[str]) -> List[DashboardClient]:
+        with self._lock:
+            if not device_id:
+                return list(self._clients.values())
+            ids: Iterable[int] = self._wildcard
+            extra = self._by_device.get(device_id)
+            if extra:
+                ids = self._wildcard | extra
+            return [self._clients[i] for i in ids if i in self._clients]
+
+    def broadcast(self, message: Dict[str, Any]) -> int:
+        """把消息投递给订阅了它的客户端，返回投递数。
+
+        只查订阅索引里相关的客户端；同一指标集合的输出只序列化一次。
+        """
+        msg_type = message.get("type")
+        device_id = message.get("device_id")
+        key = coalesce_key(message)
+        payloads: Dict[Optional[FrozenSet[str]], str] = {}
+        n = 0
+        for client in self._targets(str(device_id) if device_id else None):
+            sub = client.subscription
+            if not sub.wants(msg_type):
+                continue
+            metrics = sub.metrics if msg_type == "telemetry" else None
+            payload = payloads.get(metrics)
+            if payload is None:
+                payload = self._dumps(project_metrics(message, metrics) if metrics is not None else message)
+                payloads[metrics] = payload
+            if sub.max_rate_hz and key is not None:
+                ok = client.enqueue_latest(key, payload)
+            else:
+                ok = client.enqueue(payload, key)
+            if ok:
+                n += 1
+        with self._lock:
+            self._stats["broadcasts"] += 1
+            self._stats["deliveries"] += n
+            self._stats["encodes"] += len(payloads)
+        return n
+
+    def close_all(self) -> None:
+        """移除并断开全部客户端（各写端退出时关闭自己的连接，前端随后重连拿快照）。"""
+        for client in self.clients():
+            self.remove(client)
+
+    def stats(self) -> Dict[str, Any]:
+        clients = self.clients()
+        depths = [c.depth() for c in clients]
+        with self._lock:
+            out: Dict[str, Any] = dict(self._stats)
+            totals = dict(self._retired)
+        for c in clients:
+            for k in totals:
+                totals[k] += c.stats[k]
+        out.update(totals)
+        out["clients"] = len(clients)
+        out["subscribed_devices"] = len(self._by_device)
+        out["queue_depth_total"] = sum(depths)
+        out["queue_depth_max"] = max(depths) if depths else 0
+        out["max_queue"] = self.max_queue
+        out["policy"] = self.policy
+        return out
@@ -0,0 +1,163 @@
+"""设备状态存储：按 device_id 分片加锁，替代 app.py 里覆盖所有状态的全局锁。
+
+- 写：只锁设备所在的分片；DeviceState 不可变，更新时整体替换（写时复制），
+  读方拿到的对象发布后不会再被修改，不需要持锁使用
+- 读：快照逐个分片复制引用（每个分片只短暂加锁），设备列表再大也不会长时间挡住上报
+- 离线判定：写入时预先算好 expires_at = last_seen + TTL，由时间轮（timers.py）到点置为 offline，
+  读状态只是取字段
+- 版本号：在分片锁内与状态写入一起分配；快照先读版本号再复制分片，
+  保证返回的设备集合不会漏掉 <= 该版本的变化（可能多带几条更新的，客户端按设备合并即可）
+"""
+
+from __future__ import annotations
+
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class DeviceState:
+    device_id: str
+    status: str = "offline"  # online/offline
+    last_seen: Optional[int] = None
+    firmware_version: Optional[str] = None
+    capabilities: Dict[str, Any] = field(default_factory=dict)
+    version: int = 0  # 该设备最后一次变化时的全局版本号
+    expires_at: Optional[int] = None  # 超过该时间应置为 offline；None 表示不做 TTL 判定
+
+
+class _Stripe:
+    __slots__ = ("lock", "devices", "latest")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.devices: Dict[str, DeviceState] = {}
+        self.latest: Dict[str, Dict[str, Any]] = {}
+
+
+class DeviceRegistry:
+    def __init__(self, ttl_sec: int = 30, stripes: int = 16):
+        self.ttl_sec = ttl_sec
+        self._stripes = [_Stripe() for _ in range(max(1, stripes))]
+        self._version = 0
+        self._version_lock = threading.Lock()
+
+    def _stripe(self, device_id: str) -> _Stripe:
+        return self._stripes[hash(device_id) % len(self._stripes)]
+
+    def _next_version(self, version: Optional[int]) -> int:
+        # 多进程模式下版本号由 broker 分配（version），本地只跟随
+        with self._version_lock:
+            if version is None:
+                version = self._version + 1
+            self._version = max(self._version, version)
+            return version
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def expires_at(self, last_seen: Optional[int]) -> Optional[int]:
+        """WS 断开会主动置 offline；HTTP 兜底没有断开事件，靠 last_seen + TTL 判定。"""
+        if self.ttl_sec <= 0:
+            return None
+        if not last_seen:
+            return 0
+        return int(last_seen) + self.ttl_sec
+
+    def get(self, device_id: str) -> Optional[DeviceState]:
+        return self._stripe(device_id).devices.get(device_id)
+
+    def get_latest(self, device_id: str) -> Optional[Dict[str, Any]]:
+        return self._stripe(device_id).latest.get(device_id)
+
+    def update(
+        self,
+        device_id: str,
+        patch: Optional[Dict[str, Any]] = None,
+        config: Optional[Dict[str, Any]] = None,
+        telemetry: Optional[Dict[str, Any]] = None,
+        version: Optional[int] = None,
+        expect: Optional[Dict[str, Any]] = None,
+    ) -> Optional[DeviceState]:
+        """应用一次设备变化并分配版本号，返回新的状态对象。
+
+        patch 覆盖字段；config 合并到 capabilities.config；telemetry 记为最新一条（写入其 version）。
+        expect 为条件更新：设备不存在或任一字段与之不符时不做修改，返回 None。
+        """
+        return self.apply(device_id, patch, config, telemetry, version, expect)[1]
+
+    def apply(
+        self,
+        device_id: str,
+        patch: Optional[Dict[str, Any]] = None,
+        config: Optional[Dict[str, Any]] = None,
+        telemetry: Optional[Dict[str, Any]] = None,
+        version: Optional[int] = None,
+        expect: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[Optional[DeviceState], Optional[DeviceState]]:
+        """同 update，但返回 (修改前, 修改后)：两者在同一把分片锁内取得，用于判断 status 是否变化。"""
+        stripe = self._stripe(device_id)
+        with stripe.lock:
+            before = state = stripe.devices.get(device_id)
+            if expect is not None and (state is None or any(getattr(state, k) != v for k, v in expect.items())):
+                return before, None
+            if state is None:
+                state = DeviceState(device_id=device_id)
+            changes = dict(patch or {})
+            if config is not None:
+                caps = dict(changes.get("capabilities", state.capabilities) or {})
+                merged = caps.get("config")
+                merged = dict(merged) if isinstance(merged, dict) else {}
+                merged.update(config)
+                caps["config"] = merged
+                changes["capabilities"] = caps
+            changes["expires_at"] = self.expires_at(changes.get("last_seen", state.last_seen))
+            changes["version"] = self._next_version(version)
+            state = replace(state, **changes)
+            stripe.devices[device_id] = state
+            if telemetry is not None:
+                telemetry["version"] = state.version
+                stripe.latest[device_id] = telemetry
+        return before, state
+
+    def snapshot(self, since_version: Optional[int] = None) -> Tuple[int, List[DeviceState], List[Dict[str, Any]]]:
+        """(版本号, 设备列表, 最新 telemetry 列表)；since_version 不为 None 时只返回该版本之后变化过的设备。"""
+        version = self._version
+        devices: List[DeviceState] = []
+        latest: List[Dict[str, Any]] = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                devs = list(stripe.devices.values())
+                lat = dict(stripe.latest)
+            if since_version is not None:
+                devs = [d for d in devs if d.version > since_version]
+                latest.extend(lat[d.device_id] for d in devs if d.device_id in lat)
+            else:
+                latest.extend(lat.values())
+            devices.extend(devs)
+        return version, devices, latest
+
+    def load(
+        self,
+        devices: Iterable[Dict[str, Any]],
+        latest: Iterable[Dict[str, Any]],
+        versions: Dict[str, int],
+        version: int,
+    ) -> None:
+        """整体替换（多进程模式下从 broker 的完整状态重建）。"""
+        stripes = [_Stripe() for _ in self._stripes]
+        for d in devices:
+            device_id = d["device_id"]
+            state = DeviceState(**d)
+            state = replace(state, version=int(versions.get(device_id) or 0), expires_at=self.expires_at(state.last_seen))
+            stripes[hash(device_id) % len(stripes)].devices[device_id] = state
+        for t in latest:
+            stripes[hash(t["device_id"]) % len(stripes)].latest[t["device_id"]] = t
+        for old, new in zip(self._stripes, stripes):
+            with old.lock:
+                old.devices = new.devices
+                old.latest = new.latest
+        with self._version_lock:
+            self._version = int(version)
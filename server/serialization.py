@@ -0,0 +1,104 @@
+"""JSON 编解码层：server 内所有 json 收发都走这里（WS 帧、ack、广播、快照、REST、env_json、broker）。
+
+- 后端按 orjson > ujson > 标准库 json 的顺序自动选择已安装的；SLS_JSON_BACKEND 可强制指定
+- 输出统一为紧凑格式（无空格）、不转义非 ASCII；各后端输出语义等价（字段顺序/浮点写法可能略有差异）
+- orjson 不支持的输入（超过 64 位的整数等）自动退回标准库，不会因为换后端而报错
+- dumps 返回 str（WebSocket 文本帧/Flask 需要 str）；dumps_bytes 返回 UTF-8 bytes（broker 连接、落盘）
+- loads 接受 str 或 bytes
+
+对比各后端：python server/dev/bench_json.py
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+BACKENDS = ("orjson", "ujson", "json")
+
+_Default = Optional[Callable[[Any], Any]]
+
+
+def _std_dumps(obj: Any, default: _Default = None) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=default)
+
+
+def _std_loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def _make_orjson() -> Dict[str, Callable[..., Any]]:
+    import orjson  # type: ignore
+
+    opts = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj: Any, default: _Default = None) -> bytes:
+        try:
+            return orjson.dumps(obj, default=default, option=opts)
+        except TypeError:
+            return _std_dumps(obj, default).encode("utf-8")
+
+    def dumps(obj: Any, default: _Default = None) -> str:
+        return dumps_bytes(obj, default).decode("utf-8")
+
+    return {"dumps": dumps, "dumps_bytes": dumps_bytes, "loads": orjson.loads}
+
+
+def _make_ujson() -> Dict[str, Callable[..., Any]]:
+    import ujson  # type: ignore
+
+    def dumps(obj: Any, default: _Default = None) -> str:
+        try:
+            if default is None:
+                return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, default=default)
+        except (TypeError, OverflowError):
+            return _std_dumps(obj, default)
+
+    def dumps_bytes(obj: Any, default: _Default = None) -> bytes:
+        return dumps(obj, default).encode("utf-8")
+
+    def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        return ujson.loads(data)
+
+    return {"dumps": dumps, "dumps_bytes": dumps_bytes, "loads": loads}
+
+
+def _make_json() -> Dict[str, Callable[..., Any]]:
+    def dumps_bytes(obj: Any, default: _Default = None) -> bytes:
+        return _std_dumps(obj, default).encode("utf-8")
+
+    return {"dumps": _std_dumps, "dumps_bytes": dumps_bytes, "loads": _std_loads}
+
+
+_FACTORIES = {"orjson": _make_orjson, "ujson": _make_ujson, "json": _make_json}
+
+
+def load_backend(name: str) -> Dict[str, Callable[..., Any]]:
+    """按名字构造后端（dumps / dumps_bytes / loads）；未安装时抛 ImportError。"""
+    if name not in _FACTORIES:
+        raise ValueError(f"unknown json backend: {name}")
+    return _FACTORIES[name]()
+
+
+def _select(preferred: str) -> Tuple[str, Dict[str, Callable[..., Any]]]:
+    names = BACKENDS if preferred in ("", "auto") else (preferred,) + BACKENDS
+    for name in names:
+        try:
+            return name, load_backend(name)
+        except (ImportError, ValueError):
+            continue
+    return "json", _make_json()
+
+
+# 当前使用的后端名（/api/metrics 里可见）
+BACKEND, _impl = _select(os.getenv("SLS_JSON_BACKEND", "auto").strip().lower())
+
+dumps: Callable[..., str] = _impl["dumps"]
+dumps_bytes: Callable[..., bytes] = _impl["dumps_bytes"]
+loads: Callable[[Union[str, bytes, bytearray, memoryview]], Any] = _impl["loads"]
@@ -0,0 +1,77 @@
+"""哈希时间轮：大量“到点触发一次”的定时器（设备离线判定）。
+
+- schedule / cancel 都是 O(1)：同一个 key 重新 schedule 会从旧槽移到新槽，每个 key 最多一个定时器
+- 后台线程每秒 tick 一次，只扫描当前槽；到期时间超过一圈的条目留在槽里等下一圈
+- 回调在 tick 线程里、锁外执行，应尽快返回
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class TimerWheel:
+    def __init__(self, on_expire: Callable[[Any, int], None], slots: int = 512):
+        self.on_expire = on_expire
+        self._slots: List[Dict[Hashable, int]] = [{} for _ in range(max(1, slots))]
+        self._where: Dict[Hashable, int] = {}  # key -> 槽下标
+        self._cursor = int(time.time())  # 已处理到的秒
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.stats = {"scheduled": 0, "fired": 0}
+
+    def schedule(self, key: Hashable, deadline: int) -> None:
+        """deadline（unix 秒）到达时触发 on_expire(key, deadline)；已有定时器则替换。"""
+        deadline = int(deadline)
+        with self._lock:
+            old = self._where.get(key)
+            if old is not None:
+                self._slots[old].pop(key, None)
+            # 已经过期的放到下一个 tick 处理
+            idx = max(deadline, self._cursor + 1) % len(self._slots)
+            self._slots[idx][key] = deadline
+            self._where[key] = idx
+            self.stats["scheduled"] += 1
+            if self._thread is None:
+                # 第一次使用时才启动后台线程
+                self._thread = threading.Thread(target=self._run, name="sls-timer-wheel", daemon=True)
+                self._thread.start()
+
+    def cancel(self, key: Hashable) -> None:
+        with self._lock:
+            idx = self._where.pop(key, None)
+            if idx is not None:
+                self._slots[idx].pop(key, None)
+
+    def advance(self, now: int) -> None:
+        """处理 (上次 tick, now] 之间的槽；停顿超过一圈时每个槽只扫一次。"""
+        due: List[Tuple[Hashable, int]] = []
+        with self._lock:
+            start = max(self._cursor + 1, now - len(self._slots) + 1)
+            for t in range(start, now + 1):
+                slot = self._slots[t % len(self._slots)]
+                for key, deadline in list(slot.items()):
+                    if deadline <= now:
+                        del slot[key]
+                        del self._where[key]
+                        due.append((key, deadline))
+            self._cursor = max(self._cursor, now)
+        for key, deadline in due:
+            self.stats["fired"] += 1
+            try:
+                self.on_expire(key, deadline)
+            except Exception:
+                pass
+
+    def _run(self) -> None:
+        while not self._stopped.wait(1.0 - (time.time() % 1.0)):
+            self.advance(int(time.time()))
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def __len__(self) -> int:
+        return len(self._where)
@@ -0,0 +1,38 @@
+"""SIGHUP 热加载：配置写错时保留原配置，不能把异常抛进信号处理。
+
+运行：python -m pytest tests/test_config_reload.py（不需要 SQLite）
+"""
+
+import os
+import sys
+
+os.environ.setdefault("SLS_ENABLE_SQLITE", "0")
+os.environ.setdefault("SLS_API_KEYS", "test_key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import app as core  # noqa: E402
+from server import config  # noqa: E402
+
+
+def test_malformed_value_keeps_previous_settings(monkeypatch):
+    before = core._settings
+    ttl = config.DEVICE_OFFLINE_TTL_SEC
+    try:
+        monkeypatch.setenv("SLS_API_KEYS", "rotated_key")
+        monkeypatch.setenv("SLS_COMMAND_STATUS_TTL_SEC", "ten minutes")
+        core.reload_settings()
+
+        assert core._settings is before
+        assert core._auth_ok("test_key")
+        assert not core._auth_ok("rotated_key")
+        # 出错前已重新赋值的项也要恢复
+        assert config.API_KEYS == set(before.api_keys)
+        assert config.DEVICE_OFFLINE_TTL_SEC == ttl
+
+        monkeypatch.setenv("SLS_COMMAND_STATUS_TTL_SEC", "600")
+        core.reload_settings()
+        assert core._auth_ok("rotated_key")
+    finally:
+        monkeypatch.undo()
+        core.reload_settings()
+    assert core._auth_ok("test_key")
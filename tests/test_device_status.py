@@ -0,0 +1,68 @@
+"""设备离线后再上报：dashboard 要收到 status=online 的 device_status。
+
+运行：python -m pytest tests/test_device_status.py（不需要 SQLite）
+"""
+
+import os
+import sys
+
+os.environ.setdefault("SLS_ENABLE_SQLITE", "0")
+os.environ.setdefault("SLS_API_KEYS", "test_key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import app as core  # noqa: E402
+
+AUTH = {"Authorization": "Bearer test_key"}
+
+
+def _post(client, device_id, seq):
+    resp = client.post(
+        "/api/telemetry",
+        json={"device_id": device_id, "seq": seq, "environment": {"light": {"raw": 100 + seq}}},
+        headers=AUTH,
+    )
+    assert resp.status_code == 200
+
+
+def test_offline_then_telemetry_pushes_online(monkeypatch):
+    pushed = []
+    monkeypatch.setattr(core, "_broadcast_dashboard", pushed.append)
+    client = core.app.test_client()
+    device_id = "test-offline-online"
+
+    _post(client, device_id, 1)
+    state = core._registry.get(device_id)
+    assert state is not None and state.status == "online"
+
+    del pushed[:]
+    # 模拟时间轮到期（与 _offline_timers 到点时的调用一致）
+    core._expire_device(device_id, state.expires_at + 1)
+    assert core._registry.get(device_id).status == "offline"
+    assert [m["status"] for m in pushed if m.get("type") == "device_status"] == ["offline"]
+
+    del pushed[:]
+    _post(client, device_id, 2)
+    statuses = [m for m in pushed if m.get("type") == "device_status"]
+    assert len(statuses) == 1
+    assert statuses[0]["device_id"] == device_id
+    assert statuses[0]["status"] == "online"
+    assert statuses[0]["version"] == core._registry.get(device_id).version
+
+
+def test_first_telemetry_announces_device(monkeypatch):
+    pushed = []
+    monkeypatch.setattr(core, "_broadcast_dashboard", pushed.append)
+    _post(core.app.test_client(), "test-new-device", 1)
+    assert [(m.get("type"), m.get("status")) for m in pushed] == [("telemetry", None), ("device_status", "online")]
+
+
+def test_telemetry_while_online_pushes_no_status(monkeypatch):
+    pushed = []
+    monkeypatch.setattr(core, "_broadcast_dashboard", pushed.append)
+    client = core.app.test_client()
+    device_id = "test-still-online"
+
+    _post(client, device_id, 1)
+    del pushed[:]
+    _post(client, device_id, 2)
+    assert [m.get("type") for m in pushed] == ["telemetry"]
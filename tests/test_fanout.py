@@ -0,0 +1,60 @@
+"""DashboardHub.close_all 之后，客户端的连接必须真正关闭（否则前端不会重连拿快照）。
+
+运行：python -m pytest tests/test_fanout.py
+"""
+
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.fanout import DashboardHub  # noqa: E402
+
+
+def test_close_all_closes_thread_client_socket():
+    hub = DashboardHub()
+    closed = threading.Event()
+    client = hub.add(lambda text: None, close=closed.set)
+
+    hub.close_all()
+    assert closed.wait(2.0)
+    assert client.closed
+    assert hub.stats()["clients"] == 0
+
+
+def test_close_all_sends_websocket_close_for_async_client():
+    sent = []
+
+    async def scenario():
+        hub = DashboardHub()
+
+        async def send(text):
+            sent.append(("send", text))
+
+        async def close():
+            sent.append(("close", None))
+
+        client = hub.add_async(send, asyncio.get_running_loop(), close=close)
+        hub.broadcast({"type": "command_sent", "cmd_id": "c1"})
+        await asyncio.sleep(0)
+        hub.close_all()
+        await client.wait_closed()
+        assert hub.stats()["clients"] == 0
+
+    asyncio.run(scenario())
+    assert sent[-1] == ("close", None)
+
+
+def test_send_failure_closes_socket_and_removes_client():
+    hub = DashboardHub()
+    closed = threading.Event()
+
+    def send(text):
+        raise ConnectionError("gone")
+
+    hub.add(send, close=closed.set)
+    hub.broadcast({"type": "command_sent", "cmd_id": "c1"})
+    assert closed.wait(2.0)
+    assert hub.stats()["clients"] == 0
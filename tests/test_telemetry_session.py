@@ -0,0 +1,69 @@
+"""/ws/telemetry 会话：认证失败的 hello 不能改变已认证连接的设备身份。
+
+运行：python -m pytest tests/test_telemetry_session.py（不需要 SQLite）
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+os.environ.setdefault("SLS_ENABLE_SQLITE", "0")
+os.environ.setdefault("SLS_API_KEYS", "test_key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import app as core  # noqa: E402
+from server.auth import ApiKeyAuth  # noqa: E402
+
+
+class _Sender:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, text):
+        self.sent.append(text)
+
+
+def _hello(session, device_id, api_key):
+    return [json.loads(m) for m in session.handle(json.dumps({"type": "hello", "device_id": device_id, "api_key": api_key}))]
+
+
+def _telemetry(session, seq):
+    return [json.loads(m) for m in session.handle(json.dumps({"type": "telemetry", "seq": seq, "environment": {"light": {"raw": seq}}}))]
+
+
+def _device_auth(monkeypatch):
+    keys = {"rehello-a": "key-a", "rehello-b": "key-b"}
+    digests = {d: hashlib.sha256(k.encode("utf-8")).hexdigest() for d, k in keys.items()}
+    monkeypatch.setattr(core, "_auth", ApiKeyAuth([], digests))
+    monkeypatch.setattr(core, "_broadcast_dashboard", lambda message: None)
+
+
+def test_rehello_as_other_device_is_rejected(monkeypatch):
+    _device_auth(monkeypatch)
+    session = core.TelemetrySession(_Sender())
+
+    assert _hello(session, "rehello-a", "key-a")[0]["type"] == "hello_ok"
+    # 用错误的 key 冒充另一台设备
+    assert _hello(session, "rehello-b", "key-a")[0]["error"] == "device_id_mismatch"
+    # 即使 key 正确，同一连接也不能切换设备
+    assert _hello(session, "rehello-b", "key-b")[0]["error"] == "device_id_mismatch"
+
+    assert _telemetry(session, 1)[0]["type"] == "ack"
+    assert session.device_id == "rehello-a"
+    assert core._registry.get_latest("rehello-b") is None
+    assert core._registry.get_latest("rehello-a") is not None
+
+    session.close()
+    assert "rehello-a" not in core._device_ws
+    assert core._registry.get("rehello-a").status == "offline"
+
+
+def test_failed_first_hello_leaves_session_unauthenticated(monkeypatch):
+    _device_auth(monkeypatch)
+    session = core.TelemetrySession(_Sender())
+
+    assert _hello(session, "rehello-b", "wrong")[0]["error"] == "unauthorized"
+    assert session.device_id is None
+    assert _telemetry(session, 1) == []
+    session.close()
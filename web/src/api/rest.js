@@ -31,18 +31,34 @@ export async function fetchSnapshot() {
   return { devices, latest };
 }
 
-export async function fetchTelemetryHistory({ deviceId, since, until, limit = 200 } = {}) {
-  if (!deviceId) throw new Error('deviceId required');
+export async function fetchTelemetryHistoryMulti({ deviceIds, since, until, limit = 200 } = {}) {
+  if (!deviceIds || !deviceIds.length) throw new Error('deviceIds required');
   const apiBase = getApiBase();
 
-  const params = new URLSearchParams({ device_id: String(deviceId) });
+  const params = new URLSearchParams({ device_ids: deviceIds.map(String).join(',') });
   if (since) params.set('since', String(since));
   if (until) params.set('until', String(until));
   if (limit) params.set('limit', String(limit));
 
   const data = await fetchJson(`${apiBase}/api/telemetry/history?${params.toString()}`);
   if (data.ok === false) throw new Error(data.error || 'history query failed');
-  return data.items || [];
+  return data.items_by_device || {};
+}
+
+export async function fetchTelemetryAggregate({ deviceId, since, until, bucket, metrics, lttb } = {}) {
+  if (!deviceId) throw new Error('deviceId required');
+  const apiBase = getApiBase();
+
+  const params = new URLSearchParams({ device_id: String(deviceId) });
+  if (since) params.set('since', String(since));
+  if (until) params.set('until', String(until));
+  if (bucket) params.set('bucket', String(bucket));
+  if (metrics && metrics.length) params.set('metrics', metrics.join(','));
+  if (lttb) params.set('lttb', String(lttb));
+
+  const data = await fetchJson(`${apiBase}/api/telemetry/aggregate?${params.toString()}`);
+  if (data.ok === false) throw new Error(data.error || 'aggregate query failed');
+  return data;
 }
 
 export async function sendCommand({ deviceId, command } = {}) {
@@ -1,5 +1,11 @@
 import { defineStore } from 'pinia';
-import { fetchTelemetryHistory } from '../api/rest';
+import { fetchTelemetryAggregate, fetchTelemetryHistoryMulti } from '../api/rest';
+
+// /api/telemetry/history 单次最多查询的设备数（device_ids）
+const HISTORY_MAX_DEVICES = 200;
+
+// 聚合曲线用到的指标（series 键 -> /api/telemetry/aggregate 的 metric 名）
+const AGGREGATE_METRICS = { temp: 'bmp280.temp', pressure: 'bmp280.pressure', light: 'light.percent' };
 
 function nowMs() {
   return Date.now();
@@ -24,6 +30,49 @@ function pushPoint(series, point, limit = 240) {
   if (series.length > limit) series.splice(0, series.length - limit);
 }
 
+// 曲线横轴：优先用 server 归一化的事件时间 event_ts（设备时钟不可信时已退回到达时间），旧数据/实时消息没有时用 timestamp
+function seriesTs(t) {
+  return toNumberOrNull(t.event_ts ?? t.timestamp);
+}
+
+// 从历史记录重建曲线数据（保持与 applyTelemetry 相同的数据结构）
+function buildSeries(items, limit) {
+  const series = { temp: [], pressure: [], light: [] };
+  for (const t of items) {
+    const env = t.environment || {};
+    const bmp = env.bmp280 || {};
+    const light = env.light || {};
+
+    const ts = seriesTs(t);
+    if (!ts) continue;
+
+    const temp = toNumberOrNull(bmp.temp);
+    const pressure = toNumberOrNull(bmp.pressure);
+    const lightPercent = toNumberOrNull(light.percent);
+
+    if (temp !== null) pushPoint(series.temp, [ts * 1000, temp], limit);
+    if (pressure !== null) pushPoint(series.pressure, [ts * 1000, pressure], limit);
+    if (lightPercent !== null) pushPoint(series.light, [ts * 1000, lightPercent], limit);
+  }
+  return series;
+}
+
+// 从聚合桶重建曲线：每桶取 avg，点落在桶中间
+function buildAggregateSeries(buckets, bucketSec) {
+  const series = { temp: [], pressure: [], light: [] };
+  const half = (bucketSec || 0) / 2;
+  for (const b of buckets) {
+    const ts = toNumberOrNull(b.ts);
+    if (ts === null) continue;
+    for (const [key, metric] of Object.entries(AGGREGATE_METRICS)) {
+      const m = b[metric];
+      const avg = m && m.avg != null ? toNumberOrNull(m.avg) : null;
+      if (avg !== null) series[key].push([(ts + half) * 1000, avg]);
+    }
+  }
+  return series;
+}
+
 export const useMonitorStore = defineStore('monitor', {
   state: () => ({
     devicesById: {},
@@ -122,7 +171,7 @@ export const useMonitorStore = defineStore('monitor', {
       const bmp = env.bmp280 || {};
       const light = env.light || {};
 
-      const ts = toNumberOrNull(t.timestamp);
+      const ts = seriesTs(t);
       if (!ts) return;
 
       if (!this.seriesById[t.device_id]) {
@@ -173,44 +222,55 @@ export const useMonitorStore = defineStore('monitor', {
       this.devicesById[evt.device_id] = { ...d, capabilities: caps };
     },
 
-    async loadHistory({ deviceId, sinceTs = null, untilTs = null, limit = 500 } = {}) {
+    // 总览：一次请求加载多个设备的历史（server 端单条 SQL 分组返回；超过 HISTORY_MAX_DEVICES 个设备时分批）
+    async loadHistoryForDevices({ deviceIds, sinceTs = null, untilTs = null, limit = 200 } = {}) {
+      const ids = deviceIds && deviceIds.length ? deviceIds : Object.keys(this.devicesById);
+      if (!ids.length) return 0;
+
+      const chunks = [];
+      for (let i = 0; i < ids.length; i += HISTORY_MAX_DEVICES) {
+        chunks.push(ids.slice(i, i + HISTORY_MAX_DEVICES));
+      }
+      const results = await Promise.all(
+        chunks.map((chunk) =>
+          fetchTelemetryHistoryMulti({
+            deviceIds: chunk,
+            since: sinceTs || undefined,
+            until: untilTs || undefined,
+            limit,
+          }),
+        ),
+      );
+
+      let total = 0;
+      for (const byDevice of results) {
+        for (const [id, items] of Object.entries(byDevice)) {
+          this.seriesById[id] = buildSeries(items, limit);
+          if (items.length) this.latestById[id] = items[items.length - 1];
+          total += items.length;
+        }
+      }
+      if (!this.selectedDeviceId) this.selectedDeviceId = ids[0];
+      return total;
+    },
+
+    // 长时间范围：server 按桶聚合，桶数与实时曲线的点数上限一致，返回体积与跨度无关
+    async loadAggregate({ deviceId, sinceTs, untilTs = null, buckets = 240 } = {}) {
       const id = deviceId || this.selectedDeviceId;
       if (!id) throw new Error('no device selected');
 
-      const items = await fetchTelemetryHistory({
+      const until = untilTs || Math.floor(nowMs() / 1000);
+      const data = await fetchTelemetryAggregate({
         deviceId: id,
-        since: sinceTs || undefined,
-        until: untilTs || undefined,
-        limit,
+        since: sinceTs,
+        until,
+        bucket: Math.max(1, Math.ceil((until - sinceTs) / buckets)),
+        metrics: Object.values(AGGREGATE_METRICS),
       });
 
-      // 重建曲线数据（保持与 applyTelemetry 相同的数据结构）
-      const series = { temp: [], pressure: [], light: [] };
-      for (const t of items) {
-        const env = t.environment || {};
-        const bmp = env.bmp280 || {};
-        const light = env.light || {};
-
-        const ts = toNumberOrNull(t.timestamp);
-        if (!ts) continue;
-
-        const temp = toNumberOrNull(bmp.temp);
-        const pressure = toNumberOrNull(bmp.pressure);
-        const lightPercent = toNumberOrNull(light.percent);
-
-        if (temp !== null) pushPoint(series.temp, [ts * 1000, temp], limit);
-        if (pressure !== null) pushPoint(series.pressure, [ts * 1000, pressure], limit);
-        if (lightPercent !== null) pushPoint(series.light, [ts * 1000, lightPercent], limit);
-      }
-
-      this.seriesById[id] = series;
-      // 同步 latest（如果 history 有数据）
-      if (items.length) {
-        this.latestById[id] = items[items.length - 1];
-      }
-      if (!this.selectedDeviceId) this.selectedDeviceId = id;
-
-      return items.length;
+      const items = data.buckets || [];
+      this.seriesById[id] = buildAggregateSeries(items, data.bucket);
+      return { count: items.length, bucket: data.bucket };
     },
   },
 });
@@ -6,10 +6,25 @@ export function connectDashboardWs({
   onError,
   onMessage,
   reconnectDelayMs = 1500,
+  // 订阅条件：{ device_ids, metrics, types }（字段缺省/null 表示全部）；不传则接收全部消息
+  subscription = null,
+  // 断线重连时的续传点：返回 { epoch, version }，server 只补发这之后变化的设备（snapshot_delta）
+  getResume = null,
 } = {}) {
   let ws = null;
   let closed = false;
   let reconnectTimer = null;
+  let currentSubscription = subscription;
+
+  function sendRaw(obj) {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return false;
+    try {
+      ws.send(JSON.stringify(obj));
+      return true;
+    } catch {
+      return false;
+    }
+  }
 
   function cleanup() {
     if (reconnectTimer) {
@@ -38,9 +53,19 @@ export function connectDashboardWs({
   function open() {
     cleanup();
     const url = getWsDashboardUrl();
-    ws = new WebSocket(url);
+    const resume = getResume ? getResume() : null;
+    let connectUrl = url;
+    if (resume && resume.epoch && resume.version != null) {
+      const sep = url.includes('?') ? '&' : '?';
+      connectUrl = `${url}${sep}epoch=${encodeURIComponent(resume.epoch)}&since_version=${resume.version}`;
+    }
+    ws = new WebSocket(connectUrl);
 
     ws.addEventListener('open', () => {
+      // 重连后服务端不记得旧订阅，需要重新发送（快照已在连接时按 URL 上的续传点推过，不再要）
+      if (currentSubscription) {
+        sendRaw({ type: 'subscribe', ...currentSubscription });
+      }
       onOpen && onOpen({ url });
     });
 
@@ -66,13 +91,12 @@ export function connectDashboardWs({
       cleanup();
     },
     sendJson(obj) {
-      if (!ws || ws.readyState !== WebSocket.OPEN) return false;
-      try {
-        ws.send(JSON.stringify(obj));
-        return true;
-      } catch {
-        return false;
-      }
+      return sendRaw(obj);
+    },
+    // 替换订阅（null 恢复为接收全部）；未连接时会在下次 open 时发送
+    subscribe(next) {
+      currentSubscription = next || null;
+      return sendRaw({ type: 'subscribe', ...(currentSubscription || {}) });
     },
     get readyState() {
       return ws ? ws.readyState : WebSocket.CLOSED;